@@ -1,11 +1,24 @@
 import logging
 import logging.config
 
-from flask import Flask, request, abort
+import time
+
+from flask import Flask, Response, g, request, abort, jsonify
 
 from amnezia_api.settings import settings
-from amnezia_api.controllers import ServerController
+from amnezia_api.controllers import public_ip_resolver
+from amnezia_api.commit_queue import get_commit_queue
+from amnezia_api.registry import configurator_registry
+from amnezia_api.clients_registry import clients_registry
+from amnezia_api.idempotency import idempotency_cache
+from amnezia_api.jobs import job_store
+from amnezia_api.fleet import fleet
+from amnezia_api.metrics import (
+        format_server_timing, metrics_registry, start_timings, stop_timings
+        )
+from amnezia_api.profiling import request_profiler
 import amnezia_api.utils as utils
+from amnezia_api.utils import PROTOCOLS, remove_line_breaks as _
 
 
 logging.config.dictConfig(settings.get_logging_config())
@@ -15,6 +28,40 @@ ctl_logger = logging.getLogger("controller")
 
 def create_app() -> Flask:
     app = Flask("amnezia_api")
+    public_ip_resolver.start()
+    if settings.warm_pool_size > 0:
+        for container_name in (utils.ContainerName.WIREGUARD,
+                               utils.ContainerName.AMNEZIA_WG):
+            get_commit_queue(container_name).start()
+            if fleet is not None:
+                for host in fleet.hosts.values():
+                    if container_name in host.protocols:
+                        host.get_commit_queue(container_name).start()
+
+
+    @app.before_request
+    def start_request_instrumentation():
+        if settings.server_timing:
+            g.started_at = time.perf_counter()
+            g.timings = start_timings()
+
+        if settings.profiling_enabled and request.endpoint != "profile_requests" \
+                and request_profiler.take():
+            request_profiler.start()
+
+
+    @app.after_request
+    def add_server_timing_header(response: Response) -> Response:
+        if "timings" in g:
+            g.timings["total"] = time.perf_counter() - g.started_at
+            response.headers["Server-Timing"] = format_server_timing(g.timings)
+        return response
+
+
+    @app.teardown_request
+    def stop_request_instrumentation(error: BaseException | None) -> None:
+        stop_timings()
+        request_profiler.stop(str(request.endpoint))
 
     
     @app.route(f"/{settings.secret_url_string}/xray/create-config", methods=["GET", "POST"])
@@ -24,8 +71,14 @@ def create_app() -> Flask:
             if client_name is None:
                 abort(400)
 
+            if request.args.get("async") == "1":
+                return _create_job(utils.ContainerName.XRAY, "xray", [client_name])
+
             try:
                 return _create_config(utils.ContainerName.XRAY, client_name)
+            except utils.LockTimeoutError as e:
+                ctl_logger.error(e)
+                abort(503)
             except Exception as e:
                 ctl_logger.error(e)
                 abort(500)
@@ -40,8 +93,14 @@ def create_app() -> Flask:
             if client_name is None or client_name == "":
                 abort(400)
 
+            if request.args.get("async") == "1":
+                return _create_job(utils.ContainerName.WIREGUARD, "wireguard", [client_name])
+
             try:
                 return _create_config(utils.ContainerName.WIREGUARD, client_name)
+            except utils.LockTimeoutError as e:
+                ctl_logger.error(e)
+                abort(503)
             except Exception as e:
                 ctl_logger.error(e)
                 abort(500)
@@ -56,8 +115,14 @@ def create_app() -> Flask:
             if client_name is None:
                 abort(400)
 
+            if request.args.get("async") == "1":
+                return _create_job(utils.ContainerName.AMNEZIA_WG, "amnezia-wg", [client_name])
+
             try:
                 return _create_config(utils.ContainerName.AMNEZIA_WG, client_name)
+            except utils.LockTimeoutError as e:
+                ctl_logger.error(e)
+                abort(503)
             except Exception as e:
                 ctl_logger.error(e)
                 abort(500)
@@ -65,6 +130,174 @@ def create_app() -> Flask:
             return "Hello there"
 
 
+    @app.route(f"/{settings.secret_url_string}/<protocol>/create-configs", methods=["POST"])
+    def create_configs(protocol: str):
+        container_name = PROTOCOLS.get(protocol)
+        if container_name is None:
+            abort(404)
+
+        client_names = request.form.getlist("client-name")
+        if not client_names or "" in client_names:
+            abort(400)
+
+        if len(client_names) > settings.max_batch_size:
+            abort(413)
+
+        if request.args.get("async") == "1":
+            return _create_job(container_name, protocol, client_names)
+
+        try:
+            return jsonify(_create_configs(container_name, client_names))
+        except utils.LockTimeoutError as e:
+            ctl_logger.error(e)
+            abort(503)
+        except Exception as e:
+            ctl_logger.error(e)
+            abort(500)
+
+
+    @app.route(f"/{settings.secret_url_string}/<protocol>/revoke-config", methods=["POST"])
+    def revoke_config(protocol: str):
+        container_name = PROTOCOLS.get(protocol)
+        if container_name is None:
+            abort(404)
+
+        client_id = request.form.get("client-id") or None
+        client_name = request.form.get("client-name") or None
+        if client_id is None and client_name is None:
+            abort(400)
+
+        logger.info(_(f"""New '/revoke-config' request: type: {container_name.name},
+                      client-id: '{client_id}', client-name: '{client_name}'."""))
+        try:
+            revoked = configurator_registry.run(
+                    container_name,
+                    lambda configurator: configurator.revoke_config(
+                        client_id=client_id, client_name=client_name))
+        except utils.ClientNotFoundError as e:
+            logger.info(e)
+            abort(404)
+        except utils.LockTimeoutError as e:
+            ctl_logger.error(e)
+            abort(503)
+        except Exception as e:
+            ctl_logger.error(e)
+            abort(500)
+
+        logger.info(f"Revoked clients: {revoked}.")
+        return jsonify(revoked)
+
+
+    @app.route(f"/{settings.secret_url_string}/<protocol>/clients", methods=["GET"])
+    def list_clients(protocol: str):
+        # Served from the local clients registry only.
+        container_name = PROTOCOLS.get(protocol)
+        if container_name is None:
+            abort(404)
+
+        try:
+            cursor = int(request.args.get("cursor", 0))
+            limit = int(request.args.get("limit", 100))
+        except ValueError:
+            abort(400)
+
+        if cursor < 0 or not 0 < limit <= 1000:
+            abort(400)
+
+        clients, next_cursor = clients_registry.list_clients(
+                container_name.value, cursor=cursor, limit=limit,
+                client_name=request.args.get("name") or None,
+                name_prefix=request.args.get("search") or None)
+        return jsonify({"clients": clients, "next_cursor": next_cursor})
+
+
+    @app.route(f"/{settings.secret_url_string}/<protocol>/sync-config", methods=["POST"])
+    def sync_config(protocol: str):
+        # Full resync of the running interface with the config file.
+        container_name = PROTOCOLS.get(protocol)
+        if container_name not in (utils.ContainerName.WIREGUARD,
+                                  utils.ContainerName.AMNEZIA_WG):
+            abort(404)
+
+        try:
+            with configurator_registry.use_configurator(container_name) as configurator:
+                configurator.reconcile()
+        except utils.LockTimeoutError as e:
+            ctl_logger.error(e)
+            abort(503)
+        except Exception as e:
+            ctl_logger.error(e)
+            abort(500)
+
+        return "Config synced."
+
+
+    @app.route(f"/{settings.secret_url_string}/fleet/<protocol>/create-config", methods=["POST"])
+    def create_fleet_config(protocol: str):
+        # Creates the config on the least loaded host of the fleet.
+        container_name = PROTOCOLS.get(protocol)
+        if fleet is None or container_name is None:
+            abort(404)
+
+        client_name = request.form.get("client-name")
+        if not client_name:
+            abort(400)
+
+        logger.info(f"New fleet '/create-config' request: type: {container_name.name}, client-name: '{client_name}'.")
+        try:
+            host_name, keys = fleet.create_configs(container_name, [client_name])
+        except (utils.FleetCapacityError, utils.LockTimeoutError) as e:
+            ctl_logger.error(e)
+            abort(503)
+        except Exception as e:
+            ctl_logger.error(e)
+            abort(500)
+
+        logger.info(f"Config created on fleet host '{host_name}'.")
+        return jsonify({"host": host_name,
+                        "config": utils.convert_string_to_base64_vpn_link(keys[0])})
+
+
+    @app.route(f"/{settings.secret_url_string}/fleet/status", methods=["GET"])
+    def show_fleet_status():
+        if fleet is None:
+            abort(404)
+        return jsonify(fleet.get_status())
+
+
+    @app.route(f"/{settings.secret_url_string}/jobs/<job_id>", methods=["GET"])
+    def show_job(job_id: str):
+        job = job_store.describe(job_id)
+        if job is None:
+            abort(404)
+        return jsonify(job)
+
+
+    @app.route(f"/{settings.secret_url_string}/metrics", methods=["GET"])
+    def show_metrics():
+        return Response(metrics_registry.render(),
+                        mimetype="text/plain; version=0.0.4")
+
+
+    @app.route(f"/{settings.secret_url_string}/profile", methods=["POST"])
+    def profile_requests():
+        # Profiles the next 'requests' requests, see README.
+        if not settings.profiling_enabled:
+            abort(404)
+
+        try:
+            count = int(request.form.get("requests", 1))
+        except ValueError:
+            abort(400)
+
+        if not 0 <= count <= 100:
+            abort(400)
+
+        request_profiler.arm(count)
+        logger.info(f"Profiling the next {count} requests.")
+        return jsonify({"requests": count, "dump_dir": request_profiler.dump_dir})
+
+
     @app.route(f"/{settings.secret_url_string}/status", methods=["GET"])
     def show_status_message():
         return "This message indicates that amnezia-api backend is accessible"
@@ -73,10 +306,75 @@ def create_app() -> Flask:
     def _create_config(container_name: utils.ContainerName, client_name: str) -> str:
 
         logger.info(f"New '/create-config' request: type: {container_name.name}, client-name: '{client_name}'.")
-        server = ServerController(container_name)
-        key = server.configurator.create_config(client_name)
+        key = _submit_idempotent(container_name, [client_name])[0]
         logger.info("Config created.")
         return utils.convert_string_to_base64_vpn_link(key)
 
 
+    def _create_configs(container_name: utils.ContainerName,
+                        client_names: list[str]) -> list[str]:
+
+        logger.info(_(f"""New '/create-configs' request: type: {container_name.name},
+                      number of clients: {len(client_names)}."""))
+        keys = _submit_idempotent(container_name, client_names)
+        logger.info(f"{len(keys)} configs created.")
+        return [utils.convert_string_to_base64_vpn_link(key) for key in keys]
+
+
+    def _create_job(container_name: utils.ContainerName, protocol: str,
+                    client_names: list[str]) -> tuple[Response, int]:
+        # The configs are created in the background, see README.
+        callback_url = request.form.get("callback-url") or None
+        if callback_url is not None and \
+                not callback_url.startswith(("http://", "https://")):
+            abort(400)
+
+        # A retried submit with the same idempotency key gets the job
+        # of the first one instead of a new job.
+        submit = lambda: [job_store.submit(
+                container_name, protocol, client_names, callback_url)["job_id"]]
+        key = _get_idempotency_key(container_name, client_names)
+        try:
+            job_id = idempotency_cache.run(("job", *key), submit)[0] \
+                    if key is not None else submit()[0]
+        except utils.JobLimitError as e:
+            logger.warning(e)
+            abort(429)
+
+        job = job_store.describe(job_id)
+        if job is None:
+            # The first job has already been evicted (see MAX_JOBS).
+            abort(409)
+
+        logger.info(_(f"""New async job {job['job_id']}: type: {container_name.name},
+                      number of clients: {len(client_names)}."""))
+        response = jsonify(job)
+        response.headers["Location"] = f"/{settings.secret_url_string}/jobs/{job['job_id']}"
+        return response, 202
+
+
+    def _submit_idempotent(container_name: utils.ContainerName,
+                           client_names: list[str]) -> list[str]:
+        # A retried request with the same key gets the configs created
+        # by the first one.
+        key = _get_idempotency_key(container_name, client_names)
+        if key is None:
+            return get_commit_queue(container_name).submit(client_names)
+
+        return idempotency_cache.run(
+                key, lambda: get_commit_queue(container_name).submit(client_names))
+
+
+    def _get_idempotency_key(container_name: utils.ContainerName,
+                             client_names: list[str]) -> tuple | None:
+        # The client names are part of the key, so reusing a key
+        # for other clients does not return someone else's configs.
+        idempotency_key = request.headers.get("Idempotency-Key")
+        if idempotency_key:
+            return (container_name, "key", idempotency_key, tuple(client_names))
+        if settings.idempotency_by_client_name:
+            return (container_name, "name", tuple(client_names))
+        return None
+
+
     return app
@@ -0,0 +1,82 @@
+import ipaddress
+
+from amnezia_api.utils import AddressPoolError
+
+
+class AddressPool:
+    # Bitmap of the addresses of a WireGuard interface subnet, one byte per
+    # address. The network, broadcast and server addresses are reserved.
+    # Free addresses are handed out lowest first, and released addresses
+    # are reused. The search for the next free address starts from a cursor,
+    # which is never past the lowest free address, so sequential allocation
+    # does not rescan the taken part of the subnet.
+
+    def __init__(self, interface_address: str):
+        # interface_address is the server address with a mask, e.g. 10.8.1.1/24
+        try:
+            interface = ipaddress.IPv4Interface(interface_address)
+        except ValueError as e:
+            raise AddressPoolError(f"Invalid interface address '{interface_address}'. Details: {e}")
+
+        self.network = interface.network
+        self.server_ip = str(interface.ip)
+        self._first = int(self.network.network_address)
+        self._size = self.network.num_addresses
+        self._taken = bytearray(self._size)
+        self._taken_count = 0
+        self._cursor = 0
+
+        self._reserved = {self._index(self.server_ip)}
+        if self._size > 2:
+            self._reserved.update((0, self._size - 1))
+        for index in self._reserved:
+            self._mark(index)
+
+
+    @property
+    def free_count(self) -> int:
+        return self._size - self._taken_count
+
+
+    def allocate(self) -> str:
+        index = self._taken.find(0, self._cursor)
+        if index == -1:
+            raise AddressPoolError(f"No available IP address left in {self.network}")
+
+        self._mark(index)
+        self._cursor = index + 1
+        return str(ipaddress.IPv4Address(self._first + index))
+
+
+    def take(self, ip: str) -> None:
+        # Marks an address which is already in use (e.g. read from the config).
+        self._mark(self._index(ip))
+
+
+    def release(self, ip: str) -> None:
+        index = self._index(ip)
+        if index in self._reserved or not self._taken[index]:
+            return
+
+        self._taken[index] = 0
+        self._taken_count -= 1
+        self._cursor = min(self._cursor, index)
+
+
+    def __contains__(self, ip: str) -> bool:
+        try:
+            return ipaddress.IPv4Address(ip) in self.network
+        except ValueError:
+            return False
+
+
+    def _index(self, ip: str) -> int:
+        if ip not in self:
+            raise AddressPoolError(f"Address '{ip}' is not in {self.network}")
+        return int(ipaddress.IPv4Address(ip)) - self._first
+
+
+    def _mark(self, index: int) -> None:
+        if not self._taken[index]:
+            self._taken[index] = 1
+            self._taken_count += 1
@@ -0,0 +1,171 @@
+from __future__ import annotations
+import json
+import os
+import sqlite3
+import threading
+
+from amnezia_api.settings import settings
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS clients (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    container TEXT NOT NULL,
+    client_id TEXT NOT NULL,
+    client_name TEXT,
+    creation_date TEXT,
+    entry TEXT NOT NULL,
+    exported INTEGER NOT NULL DEFAULT 1,
+    UNIQUE (container, client_id)
+);
+CREATE INDEX IF NOT EXISTS clients_by_name ON clients (container, client_name);
+CREATE INDEX IF NOT EXISTS clients_unexported ON clients (container, exported);
+"""
+
+
+class ClientsRegistry:
+    # Local SQLite mirror of the containers' clientsTable files, indexed by
+    # client id and client name. New clients are recorded here first and
+    # marked as not exported; the container's clientsTable is rewritten from
+    # the registry later, in batches (see Configurator.export_clients_table).
+    # 'entry' keeps the clientsTable entry as is, so nothing is lost on export.
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._connection: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+
+
+    def sync_from_clients_table(self, container: str, clients_table: list[dict]) -> None:
+        # Makes the registry match the clientsTable read from the container.
+        # Clients which are not exported yet are kept. Rows keep their order
+        # (and so pagination cursors stay valid) for clients that did not change.
+        rows = [self._entry_to_row(container, entry, exported=1)
+                for entry in clients_table if entry.get("clientId")]
+        new_ids = {row[1] for row in rows}
+
+        with self._lock:
+            connection = self._connect()
+            existing_ids = {client_id for (client_id,) in connection.execute(
+                "SELECT client_id FROM clients WHERE container = ? AND exported = 1",
+                (container,))}
+
+            with connection:
+                connection.executemany(
+                        "DELETE FROM clients WHERE container = ? AND client_id = ?",
+                        [(container, client_id) for client_id in existing_ids - new_ids])
+                connection.executemany(
+                        """INSERT INTO clients
+                        (container, client_id, client_name, creation_date, entry, exported)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                        ON CONFLICT (container, client_id) DO UPDATE SET
+                        client_name = excluded.client_name,
+                        creation_date = excluded.creation_date,
+                        entry = excluded.entry,
+                        exported = 1""", rows)
+
+
+    def add_clients(self, container: str, entries: list[dict],
+                    pending_export: bool = True) -> None:
+        rows = [self._entry_to_row(container, entry, exported=int(not pending_export))
+                for entry in entries]
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.executemany(
+                        """INSERT OR REPLACE INTO clients
+                        (container, client_id, client_name, creation_date, entry, exported)
+                        VALUES (?, ?, ?, ?, ?, ?)""", rows)
+
+
+    def remove_clients(self, container: str, client_ids: list[str]) -> None:
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.executemany(
+                        "DELETE FROM clients WHERE container = ? AND client_id = ?",
+                        [(container, client_id) for client_id in client_ids])
+
+
+    def find_client_ids(self, container: str, client_name: str) -> list[str]:
+        with self._lock:
+            return [client_id for (client_id,) in self._connect().execute(
+                """SELECT client_id FROM clients
+                WHERE container = ? AND client_name = ? ORDER BY seq""",
+                (container, client_name))]
+
+
+    def list_clients(self, container: str, cursor: int = 0, limit: int = 100,
+                     client_name: str | None = None,
+                     name_prefix: str | None = None) -> tuple[list[dict], int | None]:
+        # Returns a page of clientsTable entries and the cursor of the next
+        # page (None if this page is the last one).
+        query = "SELECT seq, entry FROM clients WHERE container = ? AND seq > ?"
+        params: list = [container, cursor]
+        if client_name is not None:
+            query += " AND client_name = ?"
+            params.append(client_name)
+        if name_prefix is not None:
+            query += " AND client_name LIKE ? ESCAPE '\\'"
+            params.append(_escape_like(name_prefix) + "%")
+        query += " ORDER BY seq LIMIT ?"
+        params.append(limit + 1)
+
+        with self._lock:
+            rows = self._connect().execute(query, params).fetchall()
+
+        next_cursor = rows[limit - 1][0] if len(rows) > limit else None
+        return [json.loads(entry) for seq, entry in rows[:limit]], next_cursor
+
+
+    def count_unexported(self, container: str) -> int:
+        with self._lock:
+            (count,) = self._connect().execute(
+                "SELECT COUNT(*) FROM clients WHERE container = ? AND exported = 0",
+                (container,)).fetchone()
+        return count
+
+
+    def export_clients_table(self, container: str) -> tuple[list[dict], int]:
+        # Returns the whole clientsTable in creation order, plus the last seq
+        # included, to be passed to mark_exported once the table is written.
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT seq, entry FROM clients WHERE container = ? ORDER BY seq",
+                (container,)).fetchall()
+
+        last_seq = rows[-1][0] if rows else 0
+        return [json.loads(entry) for seq, entry in rows], last_seq
+
+
+    def mark_exported(self, container: str, last_seq: int) -> None:
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.execute(
+                    "UPDATE clients SET exported = 1 WHERE container = ? AND seq <= ?",
+                    (container, last_seq))
+
+
+    def _entry_to_row(self, container: str, entry: dict, exported: int) -> tuple:
+        user_data = entry.get("userData") or {}
+        return (container, entry.get("clientId"), user_data.get("clientName"),
+                user_data.get("creationDate"), json.dumps(entry), exported)
+
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            directory = os.path.dirname(self.db_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._connection = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.executescript(SCHEMA)
+        return self._connection
+
+
+def _escape_like(string: str) -> str:
+    return string.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+clients_registry = ClientsRegistry(os.path.join(settings.data_dir, "clients.sqlite3"))
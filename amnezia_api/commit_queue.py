@@ -0,0 +1,252 @@
+from __future__ import annotations
+import logging
+import threading
+import time
+from typing import Callable
+
+from amnezia_api.clients_registry import clients_registry
+from amnezia_api.controllers import get_clients_key
+from amnezia_api.metrics import add_timings, collect_timings
+from amnezia_api.profiling import request_profiler
+from amnezia_api.registry import ConfiguratorRegistry, configurator_registry
+from amnezia_api.settings import settings
+from amnezia_api.utils import AddressPoolError, ContainerName, LockTimeoutError
+from amnezia_api.utils import remove_line_breaks as _
+from amnezia_api.warm_pool import warm_pool
+
+
+logger = logging.getLogger("controller")
+
+
+class PendingCommit:
+    def __init__(self, client_names: list[str], profiled: bool = False,
+                 on_done: Callable[[PendingCommit], None] | None = None):
+        self.client_names = client_names
+        self.user_configs: list[str] = []
+        self.error: Exception | None = None
+        self.done = threading.Event()
+        # Called in the commit worker thread once the commit is done
+        # (e.g. to complete an async job), nobody waits for done then.
+        self.on_done = on_done
+        # Whether the request is profiled, and the durations of the stages
+        # of its commit (shared by the whole batch).
+        self.profiled = profiled
+        self.submitted_at = time.perf_counter()
+        self.timings: dict[str, float] = {}
+
+
+class CommitQueue:
+    # Collects create-config requests for one container and applies them
+    # in batches: one server config write plus one sync/restart per batch.
+    # Requests that arrive while a batch is being committed (or during the
+    # commit window) go into the next batch together.
+
+    def __init__(self, container_name: ContainerName, window: float = 0,
+                 max_batch_size: int = 1000,
+                 registry: ConfiguratorRegistry = configurator_registry):
+        self.container_name = container_name
+        # The configurator registry of the container's host.
+        self.registry = registry
+        self.clients_key = get_clients_key(container_name.value, registry.host_name)
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self._pending: list[PendingCommit] = []
+        self._condition = threading.Condition()
+        self._worker: threading.Thread | None = None
+        self._refill_retry_at = 0.0
+
+
+    def submit(self, client_names: list[str]) -> list[str]:
+        pending = self.enqueue(client_names)
+        # The commit may still finish later, the caller gets 503 meanwhile.
+        if not pending.done.wait(timeout=settings.commit_timeout):
+            raise LockTimeoutError(_(f"""Commit of {len(client_names)} clients for
+                                     '{self.clients_key}' did not finish in
+                                     {settings.commit_timeout} seconds."""))
+        add_timings(pending.timings)
+        if pending.error is not None:
+            raise pending.error
+        return pending.user_configs
+
+
+    def enqueue(self, client_names: list[str],
+                on_done: Callable[[PendingCommit], None] | None = None) -> PendingCommit:
+        # Returns without waiting for the commit.
+        pending = PendingCommit(client_names, profiled=request_profiler.is_profiling(),
+                                on_done=on_done)
+        with self._condition:
+            self._pending.append(pending)
+            self._ensure_worker()
+            self._condition.notify()
+        return pending
+
+
+    def _ensure_worker(self) -> None:
+        if self._worker is not None and self._worker.is_alive():
+            return
+
+        self._worker = threading.Thread(
+                target=self._run, name=f"commit-{self.clients_key}",
+                daemon=True)
+        self._worker.start()
+
+
+    def _run(self) -> None:
+        # The warm pool is filled as soon as the worker starts, and topped
+        # up after every commit: with a steady stream of requests the queue
+        # may never stay idle for the export interval.
+        while True:
+            batch = []
+            try:
+                self._refill_warm_pool()
+                with self._condition:
+                    if not self._pending:
+                        self._condition.wait(timeout=settings.clients_table_export_interval)
+                    idle = not self._pending
+
+                if idle:
+                    self._export_clients_table()
+                    continue
+
+                if self.window > 0:
+                    time.sleep(self.window)
+
+                batch = self._take_batch()
+                self._commit(batch)
+            except Exception as e:
+                # The worker must survive, or every waiter would hang.
+                logger.error(f"Commit worker of '{self.clients_key}' failed. Details: {e}")
+                for pending in batch:
+                    if not pending.done.is_set():
+                        pending.error = e
+                        self._finish(pending)
+
+
+    def _take_batch(self) -> list[PendingCommit]:
+        # Requests are never split between batches, so a single request
+        # bigger than max_batch_size still makes its own batch.
+        batch = []
+        size = 0
+        with self._condition:
+            while self._pending:
+                next_size = len(self._pending[0].client_names)
+                if batch and size + next_size > self.max_batch_size:
+                    break
+                batch.append(self._pending.pop(0))
+                size += next_size
+        return batch
+
+
+    def _export_clients_table(self) -> None:
+        # Clients created since the last export are written
+        # to the container's clientsTable while nothing else is going on.
+        if clients_registry.count_unexported(self.clients_key) == 0:
+            return
+
+        try:
+            with self.registry.use_configurator(self.container_name) as configurator:
+                configurator.export_clients_table()
+        except Exception as e:
+            logger.error(f"Could not export clientsTable of '{self.clients_key}'. Details: {e}")
+
+
+    def _refill_warm_pool(self) -> None:
+        if settings.warm_pool_size <= 0 or self.container_name not in (
+                ContainerName.WIREGUARD, ContainerName.AMNEZIA_WG):
+            return
+
+        # Do not retry too often if e.g. the container is not installed.
+        if time.monotonic() < self._refill_retry_at:
+            return
+
+        try:
+            # Checked here too, so that a full pool does not lock the container.
+            if warm_pool.count(self.clients_key) >= settings.warm_pool_size:
+                return
+
+            self.registry.run(
+                    self.container_name,
+                    lambda configurator: configurator.refill_warm_pool())
+        except Exception as e:
+            logger.error(f"Could not refill warm pool of '{self.clients_key}'. Details: {e}")
+            self._refill_retry_at = time.monotonic() + 60
+
+
+    def start(self) -> None:
+        # The worker is also started by the first submit. Starting it earlier
+        # lets it do background work (e.g. fill the warm pool) right away.
+        with self._condition:
+            self._ensure_worker()
+
+
+    def _commit(self, batch: list[PendingCommit]) -> None:
+        client_names = [name for pending in batch for name in pending.client_names]
+        logger.debug(f"Committing {len(client_names)} clients for '{self.clients_key}'.")
+
+        started_at = time.perf_counter()
+        profiled = any(pending.profiled for pending in batch)
+        error = None
+        with collect_timings() as timings:
+            if profiled:
+                request_profiler.start()
+            try:
+                user_configs = self.registry.run(
+                        self.container_name,
+                        lambda configurator: configurator.create_configs(client_names))
+            except Exception as e:
+                error = e
+            finally:
+                if profiled:
+                    request_profiler.stop(f"commit-{self.clients_key}")
+
+        if isinstance(error, AddressPoolError) and len(batch) > 1:
+            # A batch without enough free addresses is committed again one
+            # request at a time, so that a request too big for them fails
+            # alone. Other errors (lock timeouts, a missing container etc.)
+            # would only repeat, they fail the whole batch.
+            logger.warning(_(f"""Batch of {len(client_names)} clients for '{self.clients_key}'
+                             failed, committing its requests one by one. Details: {error}"""))
+            for pending in batch:
+                self._commit([pending])
+            return
+
+        for pending in batch:
+            pending.timings = {"queue": started_at - pending.submitted_at, **timings}
+
+        if error is not None:
+            for pending in batch:
+                pending.error = error
+                self._finish(pending)
+            return
+
+        offset = 0
+        for pending in batch:
+            count = len(pending.client_names)
+            pending.user_configs = user_configs[offset:offset + count]
+            offset += count
+            self._finish(pending)
+
+
+    def _finish(self, pending: PendingCommit) -> None:
+        pending.done.set()
+        if pending.on_done is None:
+            return
+
+        try:
+            pending.on_done(pending)
+        except Exception as e:
+            logger.error(f"Could not complete a commit of '{self.clients_key}'. Details: {e}")
+
+
+_commit_queues: dict[ContainerName, CommitQueue] = {}
+_commit_queues_lock = threading.Lock()
+
+
+def get_commit_queue(container_name: ContainerName) -> CommitQueue:
+    with _commit_queues_lock:
+        queue = _commit_queues.get(container_name)
+        if queue is None:
+            queue = CommitQueue(container_name, window=settings.commit_window,
+                                max_batch_size=settings.max_batch_size)
+            _commit_queues[container_name] = queue
+        return queue
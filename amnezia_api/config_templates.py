@@ -1,3 +1,6 @@
+from amnezia_api.render_plan import RenderPlan
+
+
 # https://github.com/amnezia-vpn/amnezia-client/blob/dev/client/server_scripts/xray/template.json
 XRAY_CLIENT_TEMPLATE = """
 {
@@ -94,3 +97,47 @@ AllowedIPs = 0.0.0.0/0, ::/0
 Endpoint = $SERVER_IP_ADDRESS:$AWG_SERVER_PORT
 PersistentKeepalive = 25
 """
+
+
+# Interface lines of the extra interfaces (shards) the API adds next to wg0,
+# after the lines copied from wg0 (keys, MTU, AmneziaWG parameters).
+# The rules are the ones the container's start script sets up for wg0,
+# to the same egress interface as wg0's (see WgConfigurator._get_egress_interface).
+# wg-quick replaces %i with the interface name.
+WIREGUARD_SHARD_INTERFACE_TEMPLATE = """
+Address = $SHARD_ADDRESS
+ListenPort = $SHARD_PORT
+PostUp = iptables -A INPUT -i %i -j ACCEPT; iptables -A FORWARD -i %i -j ACCEPT; iptables -A OUTPUT -o %i -j ACCEPT; iptables -t nat -A POSTROUTING -s $SHARD_SUBNET -o $EGRESS_INTERFACE -j MASQUERADE
+PostDown = iptables -D INPUT -i %i -j ACCEPT; iptables -D FORWARD -i %i -j ACCEPT; iptables -D OUTPUT -o %i -j ACCEPT; iptables -t nat -D POSTROUTING -s $SHARD_SUBNET -o $EGRESS_INTERFACE -j MASQUERADE
+"""
+
+
+# Templates are compiled when the module is imported, so a template that
+# does not match its placeholders fails at startup instead of per request.
+XRAY_CLIENT_PLAN = RenderPlan(
+        XRAY_CLIENT_TEMPLATE,
+        placeholders=("$CLIENT_ID", "$SERVER_PUBLIC_KEY", "$SERVER_IP", "$SHORT_ID"))
+
+WIREGUARD_SERVER_PEER_PLAN = RenderPlan(
+        WIREGUARD_SERVER_PEER_TEMPLATE,
+        placeholders=("$CLIENT_PUBKEY", "$PRESHARED_KEY", "$PEER_IP"))
+
+WIREGUARD_CLIENT_CONFIG_PLAN = RenderPlan(
+        WIREGUARD_CLIENT_CONFIG_TEMPLATE,
+        placeholders=("$WIREGUARD_CLIENT_IP", "$PRIMARY_DNS", "$SECONDARY_DNS",
+                      "$WIREGUARD_CLIENT_PRIVATE_KEY", "$WIREGUARD_SERVER_PUBLIC_KEY",
+                      "$WIREGUARD_PSK", "$SERVER_IP_ADDRESS", "$WIREGUARD_SERVER_PORT"))
+
+AMNEZIA_WG_CLIENT_CONFIG_PLAN = RenderPlan(
+        AMNEZIA_WG_CLIENT_CONFIG_TEMPLATE,
+        placeholders=("$WIREGUARD_CLIENT_IP", "$PRIMARY_DNS", "$SECONDARY_DNS",
+                      "$JUNK_PACKET_COUNT", "$JUNK_PACKET_MIN_SIZE", "$JUNK_PACKET_MAX_SIZE",
+                      "$INIT_PACKET_JUNK_SIZE", "$RESPONSE_PACKET_JUNK_SIZE",
+                      "$INIT_PACKET_MAGIC_HEADER", "$RESPONSE_PACKET_MAGIC_HEADER",
+                      "$UNDERLOAD_PACKET_MAGIC_HEADER", "$TRANSPORT_PACKET_MAGIC_HEADER",
+                      "$WIREGUARD_CLIENT_PRIVATE_KEY", "$WIREGUARD_SERVER_PUBLIC_KEY",
+                      "$WIREGUARD_PSK", "$SERVER_IP_ADDRESS", "$AWG_SERVER_PORT"))
+
+WIREGUARD_SHARD_INTERFACE_PLAN = RenderPlan(
+        WIREGUARD_SHARD_INTERFACE_TEMPLATE,
+        placeholders=("$SHARD_ADDRESS", "$SHARD_PORT", "$SHARD_SUBNET", "$EGRESS_INTERFACE"))
@@ -1,26 +1,43 @@
 from __future__ import annotations
 import logging
+import hashlib
 import json
 import uuid
 import subprocess
+import io
+import ipaddress
+import posixpath
+import re
+import tarfile
+import time
+from functools import lru_cache, partial
 from typing import override
 
 import docker
+import docker.errors
 from docker.models.containers import Container, ExecResult
 
 import amnezia_api.utils as utils
 from amnezia_api.settings import settings
+from amnezia_api.address_pool import AddressPool
+from amnezia_api.wg_config import WgPeer, WgServerConfig
+from amnezia_api.clients_registry import clients_registry
+from amnezia_api.warm_pool import warm_pool
 from amnezia_api.config_templates import (
-        AMNEZIA_WG_CLIENT_CONFIG_TEMPLATE,
-        XRAY_CLIENT_TEMPLATE,
-        WIREGUARD_SERVER_PEER_TEMPLATE,
-        WIREGUARD_CLIENT_CONFIG_TEMPLATE
+        AMNEZIA_WG_CLIENT_CONFIG_PLAN,
+        XRAY_CLIENT_PLAN,
+        WIREGUARD_SERVER_PEER_PLAN,
+        WIREGUARD_CLIENT_CONFIG_PLAN,
+        WIREGUARD_SHARD_INTERFACE_PLAN
         )
+from amnezia_api.render_plan import RenderPlan
+from amnezia_api.metrics import measure, wg_free_addresses, wg_peers
 import amnezia_api.utils as utils
 from amnezia_api.utils import ServerControllerInitializationError, remove_line_breaks as _
 from amnezia_api.utils import (
-        AddressPoolError, ClientsTableError, ConfigReadingError, ContainerName,
-        ExecRunError, UserConfigError, ServerConfigError
+        AddressPoolError, ClientNotFoundError, ClientsTableError,
+        ConfigChangedError, ContainerName,
+        ExecRunError, ServerConfigError
         )
 
 
@@ -28,6 +45,14 @@ logger = logging.getLogger("controller")
 print(logger)
 
 
+public_ip_resolver = utils.PublicIpResolver(
+        override=settings.server_public_ip,
+        refresh_interval=settings.public_ip_refresh_interval,
+        resolve=partial(utils.get_server_public_ip,
+                        timeout=settings.public_ip_lookup_timeout)
+        )
+
+
 class Executor:
     def __init__(self):
         pass
@@ -43,15 +68,22 @@ class Executor:
 
 
 class ServerController(Executor):
-    def __init__(self, container_name: ContainerName):
+    def __init__(self, container_name: ContainerName,
+                 docker_client: docker.DockerClient | None = None,
+                 host_name: str | None = None):
+        # host_name is set for the hosts of a fleet (see fleet.py).
         self.configurator: Configurator
 
-        self.docker_client = docker.from_env()
+        if docker_client is None:
+            docker_client = docker.from_env()
+        self.docker_client = docker_client
+        self.host_name = host_name
         self._initialize_configurator(container_name)
 
 
     def get_installed_containers(self) -> list[Container]:
-        return self.docker_client.containers.list()
+        with measure("docker_list"):
+            return self.docker_client.containers.list()
 
 
     def _initialize_configurator(self, container_name: ContainerName):
@@ -60,15 +92,15 @@ class ServerController(Executor):
                 match container.name:
                     case ContainerName.XRAY:
                         self.configurator = XrayConfigurator(
-                                XrayContainerController(container))
+                                XrayContainerController(container, self.host_name))
 
                     case ContainerName.WIREGUARD:
                         self.configurator = WgConfigurator(
-                                WgContainerController(container))
+                                WgContainerController(container, self.host_name))
 
                     case ContainerName.AMNEZIA_WG:
                         self.configurator = AmneziaWgConfigurator(
-                                AmneziaWgContainerController(container))
+                                AmneziaWgContainerController(container, self.host_name))
 
                     case _:
                         pass
@@ -79,49 +111,265 @@ class ServerController(Executor):
             of installed containers."""))
 
 
+def get_clients_key(container_name: str, host_name: str | None = None) -> str:
+    return f"{host_name}/{container_name}" if host_name else container_name
+
+
+# Exit code of a guarded command whose config files have changed.
+CONFIG_CHANGED_EXIT_CODE = 75
+
+# Interface lines of wg0 that are not copied to the other WireGuard shards.
+SHARD_OWN_INTERFACE_KEYS = frozenset(
+        ("Address", "ListenPort", "PreUp", "PostUp", "PreDown", "PostDown"))
+
+# Egress interface of the NAT rule in wg0's PostUp, and the one used by
+# the start script of the Amnezia containers if wg0 has no such rule.
+EGRESS_INTERFACE_PATTERN = re.compile(r"POSTROUTING\b[^;]*?-o\s+(\S+)[^;]*-j\s+MASQUERADE")
+DEFAULT_EGRESS_INTERFACE = "eth0"
+
+
 class ContainerController(Executor):
-    def __init__(self, container: Container):
+    def __init__(self, container: Container, host_name: str | None = None):
         self.working_dir: str
         self.container = container
+        # Key of the container's clients in the local clients registry
+        # and warm pool, unique among the hosts of a fleet.
+        self.clients_key = get_clients_key(container.name, host_name)
+        # Hash of the config files as they were when last read. Set by the
+        # configurator registry before every operation; the first guarded
+        # write of the operation checks it (see execute_guarded_command).
+        self.expected_config_hash: str | None = None
+        # Hash of the config files as written by the last operation, if
+        # the API wrote all of them, so it is known without reading them.
+        self.written_config_hash: str | None = None
 
 
     def restart_container(self) -> None:
-        self.container.restart()
-
-
-    def execute_arbitrary_command_in_container(self, command: str) -> ExecResult:
-        result = self.container.exec_run(f"{command}")
-        if result[0] != 0:
-            raise ExecRunError(_(f"""Error performing exec_run.
-                                 Command: '{command}'. Result: {result}."""))
+        with measure("restart_container"):
+            self.container.restart()
+
+
+    def execute_arbitrary_command_in_container(self, command: str,
+                                               operation: str = "other") -> ExecResult:
+        # operation is a short fixed name of the command for the metrics.
+        with measure("exec", operation):
+            result = self.container.exec_run(f"{command}")
+            if result[0] != 0:
+                raise ExecRunError(_(f"""Error performing exec_run.
+                                     Command: '{command}'. Result: {result}."""))
         return result
 
 
     def get_text_file_from_container(self, filepath: str) -> str:
-        command = f"cat {filepath}"
-        result = self.execute_arbitrary_command_in_container(command)
-        return result[1].decode().strip()
+        return self.get_files_from_container([filepath])[filepath].strip()
+
+
+    def get_files_from_container(self, filepaths: list[str],
+                                 missing_ok: bool = False) -> dict[str, str]:
+        # Files are downloaded with the docker archive API: one request per
+        # directory, no matter how many files are read from it.
+        # With missing_ok, files that do not exist are left out of the result.
+        files = {}
+        directories: dict[str, list[str]] = {}
+        for filepath in filepaths:
+            directory, filename = posixpath.split(filepath)
+            directories.setdefault(directory, []).append(filename)
+
+        for directory, filenames in directories.items():
+            # A single file is downloaded by itself, several files are
+            # downloaded with their whole directory.
+            if len(filenames) == 1:
+                archive = self._get_archive(f"{directory}/{filenames[0]}")
+                prefix = ""
+            else:
+                archive = self._get_archive(directory)
+                prefix = posixpath.basename(directory) + "/"
+
+            with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+                for filename in filenames:
+                    try:
+                        member = tar.extractfile(prefix + filename)
+                    except KeyError:
+                        member = None
+                    if member is None:
+                        if missing_ok:
+                            continue
+                        raise ExecRunError(_(f"""File '{directory}/{filename}'
+                                             not found in container."""))
+                    files[f"{directory}/{filename}"] = member.read().decode()
+
+        return files
+
+
+    def get_config_paths(self) -> list[str]:
+        # Files whose hash is the config version of the container.
+        raise NotImplementedError
+
+
+    def get_server_config_hash(self) -> str:
+        return self.get_files_hash(self.get_config_paths())
+
+
+    def execute_guarded_command(self, command: str) -> None:
+        # Runs a shell command only if the config files still have
+        # expected_config_hash, in the same exec as the check. Otherwise
+        # raises ConfigChangedError and nothing is changed.
+        self.written_config_hash = None
+        if self.expected_config_hash is None:
+            self.execute_arbitrary_command_in_container(f"sh -c '{command}'",
+                                                        operation="write_config")
+            return
+
+        paths = " ".join(self.get_config_paths())
+        check = f"[ \"$(cat {paths} 2>/dev/null | sha256sum)\" = \"{self.expected_config_hash}  -\" ]"
+        guarded_command = f"sh -c '{check} || exit {CONFIG_CHANGED_EXIT_CODE}; {command}'"
+        with measure("exec", "write_config"):
+            result = self.container.exec_run(guarded_command)
+            if result[0] == CONFIG_CHANGED_EXIT_CODE:
+                raise ConfigChangedError(_(f"""Config of '{self.container.name}' has been
+                                           changed since it was read."""))
+            if result[0] != 0:
+                raise ExecRunError(_(f"""Error performing exec_run.
+                                     Command: '{guarded_command}'. Result: {result}."""))
+        self.expected_config_hash = None
+
+
+    def get_files_hash(self, filepaths: list[str]) -> str:
+        # One hash over all the files. Missing files are hashed as empty.
+        command = f"sh -c 'cat {' '.join(filepaths)} 2>/dev/null | sha256sum'"
+        result = self.execute_arbitrary_command_in_container(command, operation="hash")
+        return result[1].decode().split()[0]
+
+
+    def _get_snapshot(self, filepaths: dict[str, str],
+                      optional: tuple[str, ...] = ()) -> dict[str, str]:
+        # Reads several files at once. Returns their stripped contents
+        # under the same keys as in filepaths.
+        files = self.get_files_from_container(list(filepaths.values()), missing_ok=True)
+
+        snapshot = {}
+        for key, filepath in filepaths.items():
+            if filepath not in files:
+                if key in optional:
+                    continue
+                raise ExecRunError(f"File '{filepath}' not found in container.")
+            snapshot[key] = files[filepath].strip()
+
+        return snapshot
+
+
+    def write_string_to_file(self, filepath: str, string: str) -> None:
+        self.write_files_to_container({filepath: string})
+
+
+    def write_files_to_container(self, files: dict[str, str],
+                                 guarded: bool = False) -> None:
+        # All files are uploaded in one tar archive, so the content is never
+        # passed through a shell and may contain anything.
+        # A trailing line break is added, like the heredoc writes used to.
+        # Guarded files are uploaded next to the originals and moved in place
+        # by one guarded command.
+        if guarded:
+            self.write_files_to_container(
+                    {f"{filepath}.new": string for filepath, string in files.items()})
+            self.execute_guarded_command(" && ".join(
+                    f"mv {filepath}.new {filepath}" for filepath in files))
+            config_paths = self.get_config_paths()
+            if files.keys() >= set(config_paths):
+                # Same as get_files_hash() would return.
+                self.written_config_hash = hashlib.sha256("".join(
+                    files[filepath] + "\n" for filepath in config_paths).encode()).hexdigest()
+            return
+
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode="w") as tar:
+            for filepath, string in files.items():
+                data = (string + "\n").encode()
+                info = tarfile.TarInfo(name=filepath.lstrip("/"))
+                info.size = len(data)
+                info.mode = 0o600
+                info.mtime = int(time.time())
+                tar.addfile(info, io.BytesIO(data))
 
+        try:
+            with measure("write_files"):
+                uploaded = self.container.put_archive("/", buffer.getvalue())
+        except docker.errors.APIError as e:
+            raise ExecRunError(f"Could not upload files {list(files)} to container. Details: {e}")
+
+        if not uploaded:
+            raise ExecRunError(f"Could not upload files {list(files)} to container.")
+        # The config files have changed, so there is nothing to compare with.
+        if not files.keys().isdisjoint(self.get_config_paths()):
+            self.expected_config_hash = None
+            self.written_config_hash = None
+
+
+    def append_string_to_file(self, filepath: str, string: str,
+                              guarded: bool = False) -> None:
+        # The chunk is uploaded next to the file and appended by one exec.
+        chunk_path = f"{filepath}.append"
+        self.write_string_to_file(chunk_path, string)
+        if guarded:
+            self.execute_guarded_command(f"cat {chunk_path} >> {filepath} && rm {chunk_path}")
+        else:
+            command = f"sh -c 'cat {chunk_path} >> {filepath} && rm {chunk_path}'"
+            self.execute_arbitrary_command_in_container(command, operation="append")
+            if filepath in self.get_config_paths():
+                self.expected_config_hash = None
+                self.written_config_hash = None
 
-    def write_string_to_file(self, filepath: str, string: str) -> str:
-        command = f""" sh -c 'cat > {filepath} <<EOF\n{string}\nEOF'"""
 
-        result = self.execute_arbitrary_command_in_container(command)
-        return result[1]
+    def _get_archive(self, path: str) -> bytes:
+        try:
+            with measure("read_files"):
+                stream, stat = self.container.get_archive(path)
+                return b"".join(stream)
+        except docker.errors.APIError as e:
+            raise ExecRunError(f"Could not download '{path}' from container. Details: {e}")
 
 
 class Configurator:
     def __init__(self, controller: "XrayContainerController | WgContainerController"):
         self.controller = controller
         logger.debug(f"Initialization for container '{controller.container.name}' started...")
-        self.server_public_ip = utils.get_server_public_ip()
-        self.server_config = self.controller.get_server_config()
+        # All files needed for initialization are read in one round-trip.
+        self._snapshot = self.controller.get_config_snapshot()
+        self.server_config = self._snapshot["server_config"]
+        # Whether the container's clientsTable is kept in sync
+        # with the local clients registry.
+        self.exports_clients_table = True
+        # Public IP of the host, set for the hosts of a fleet.
+        self.public_ip: str | None = None
+
+
+    @property
+    def server_public_ip(self) -> str:
+        if self.public_ip is not None:
+            return self.public_ip
+        return public_ip_resolver.get()
+
+
+    def get_load(self) -> tuple[int, int | None]:
+        # Number of clients in the server config, and the number of clients
+        # that can still be added (None if not limited).
+        raise Exception("This method should be overriden by a child class")
 
 
     def create_config(self, client_name: str) -> str:
+        return self.create_configs([client_name])[0]
+
+
+    def create_configs(self, client_names: list[str]) -> list[str]:
         # TODO
         raise Exception("This method should be overriden by a child class")
 
+
+    def revoke_config(self, client_id: str | None = None,
+                      client_name: str | None = None) -> list[str]:
+        # Returns ids of the revoked clients.
+        raise Exception("This method should be overriden by a child class")
+
     
     def _read_text_file(self, filepath: str) -> str:
         with open(filepath, "r") as file:
@@ -130,72 +378,96 @@ class Configurator:
 
     def _replace_variables_in_config(self, template: str,
                                      variables_values: dict) -> str:
-        config = template
+        # Compiled templates from config_templates should be rendered
+        # directly, this is for arbitrary templates. The result is stripped.
+        return _get_render_plan(template, frozenset(variables_values)).render(
+                variables_values)
 
-        for var, value in variables_values.items():
-            if config.find(var) == -1:
-                raise UserConfigError(
-                        f"The variable {var} is not present in the config template.")
 
-            if value is None:
-                raise UserConfigError(f"Value of variable {var} is None.")
+    def _add_entry_to_clients_table(self, client_id: str, client_name: str) -> None:
+        self._add_entries_to_clients_table([(client_id, client_name)])
 
-            config = config.replace(var, value)
 
-        return config
+    def _add_entries_to_clients_table(self, clients: list[tuple[str, str]]) -> None:
+        # clients is a list of (client_id, client_name) pairs. They are
+        # recorded in the local clients registry, and the container's
+        # clientsTable is rewritten from it in batches.
 
+        creation_date = utils.get_current_datetime()
+        new_clients = [{
+                "clientId": f"{client_id}",
+                "userData": {
+                    "clientName": f"{client_name}",
+                    "creationDate": f"{creation_date}"
+                    }
+                } for client_id, client_name in clients]
+        
+        container_name = self.controller.clients_key
+        clients_registry.add_clients(container_name, new_clients,
+                                     pending_export=self.exports_clients_table)
 
-    def _get_lines_from_config(self, strings_to_search: list[str]) -> list[str]:
-        out = []
-        if not strings_to_search:
-            raise ConfigReadingError(_(f"""Attempted to search in server config,
-                    but nothing to search for - strings_to_search is empty."""))
+        if self.exports_clients_table and clients_registry.count_unexported(
+                container_name) >= settings.clients_table_export_batch:
+            self.export_clients_table()
 
-        if self.server_config is None:
-            raise ConfigReadingError(_("""Attempted to search in server config, 
-                           but the server_config property is None."""))
 
-        for line in self.server_config.splitlines():
-            for string in strings_to_search:
-                if line.strip().startswith(string):
-                    out.append(line)
-        return out
+    def export_clients_table(self) -> None:
+        if not self.exports_clients_table:
+            return
 
+        container_name = self.controller.clients_key
+        clients_table, last_seq = clients_registry.export_clients_table(container_name)
+        self._write_clients_table(self._dump_clients_table(clients_table))
+        clients_registry.mark_exported(container_name, last_seq)
+        logger.debug(f"clientsTable of {container_name} has been exported.")
 
-    def _add_entry_to_clients_table(self, client_id: str, client_name: str) -> None:
 
-        filepath = self.controller.working_dir + "/clientsTable"
+    def _find_client_ids_in_clients_table(self, client_name: str) -> list[str]:
+        return clients_registry.find_client_ids(self.controller.clients_key,
+                                                client_name)
+
+
+    def _sync_clients_registry(self, clients_table_string: str | None) -> None:
+        # Called at init with the clientsTable read from the container.
+        # If the clientsTable can not be read, it is never overwritten.
+        if clients_table_string is None:
+            return
+
         try:
-            clients_table = json.loads(
-                    self.controller.get_text_file_from_container(filepath)
-                    )
+            clients_table = json.loads(clients_table_string)
         except Exception as e:
-            raise ClientsTableError(f"Could not load clientTable.  Details: {e}")
+            clients_table = None
+            logger.error(f"Could not load clientTable.  Details: {e}")
 
-        new_client = {
-                "clientId": f"{client_id}",
-                "userData": {
-                    "clientName": f"{client_name}",
-                    "creationDate": f"{utils.get_current_datetime()}"
-                    }
-                }
-        
-        # assuming that clients_table is always a list. If the file is empty, 
-        # than an exception is thrown when trying to load it.
-        try:
-            clients_table.append(new_client)
-        except AttributeError:
-            raise ClientsTableError("Unexpected format of clientsTable.")
-        
+        # assuming that clients_table is always a list. 
+        if not isinstance(clients_table, list):
+            logger.error(_(f"""Unexpected format of clientsTable in
+                           {self.controller.container.name}, it will not be updated."""))
+            self.exports_clients_table = False
+            return
+
+        clients_registry.sync_from_clients_table(self.controller.clients_key,
+                                                 clients_table)
+
+
+    def _dump_clients_table(self, clients_table: list[dict]) -> str:
         try:
-            clients_table_string = json.dumps(clients_table, indent=4)
+            return json.dumps(clients_table, indent=4)
         except Exception as e:
             raise ClientsTableError(_(f"""An error occured when trying to dump 
                            updated clientsTable to json. Details: {e}"""))
 
+
+    def _write_clients_table(self, clients_table_string: str) -> None:
+        filepath = self.controller.working_dir + "/clientsTable"
         self.controller.write_string_to_file(filepath, clients_table_string)
 
 
+    def update_metrics(self) -> None:
+        # Sets the gauges that describe the container's config.
+        pass
+
+
     def _log_init_complete(self) -> None:
         logger.debug(_(f"""{self.controller.container.name} 
                        configurator has been initialized."""))
@@ -206,9 +478,14 @@ class Configurator:
                        container has been updated."""))
 
 
+@lru_cache(maxsize=32)
+def _get_render_plan(template: str, placeholders: frozenset[str]) -> RenderPlan:
+    return RenderPlan(template, placeholders)
+
+
 class XrayContainerController(ContainerController):
-    def __init__(self, container: Container) -> None:
-        super().__init__(container)
+    def __init__(self, container: Container, host_name: str | None = None) -> None:
+        super().__init__(container, host_name)
         self.working_dir = "/opt/amnezia/xray"
 
 
@@ -217,10 +494,21 @@ class XrayContainerController(ContainerController):
         return self.get_text_file_from_container(filepath=filepath)
 
 
+    def get_config_paths(self) -> list[str]:
+        return [f"{self.working_dir}/server.json"]
+
+
+    def get_config_snapshot(self) -> dict[str, str]:
+        return self._get_snapshot({
+            "server_config": f"{self.working_dir}/server.json",
+            "server_public_key": f"{self.working_dir}/xray_public.key",
+            "server_short_id": f"{self.working_dir}/xray_short_id.key"
+            })
+
+
     def update_server_config(self, new_config: str) -> None:
         config_path = f"{self.working_dir}/server.json"
-        self.write_string_to_file(filepath=config_path,
-                                   string=new_config)
+        self.write_files_to_container({config_path: new_config}, guarded=True)
 
 
     def get_server_public_key(self) -> str:
@@ -233,6 +521,31 @@ class XrayContainerController(ContainerController):
         return self.get_text_file_from_container(filepath=filepath)
 
 
+    def add_clients_via_api(self, api_address: str, inbound: dict) -> None:
+        # Adds users to the running inbound through the xray HandlerService,
+        # using the xray binary inside the container as the API client.
+        # The inbound must contain 'tag', 'protocol' and 'settings.clients'.
+        filepath = f"{self.working_dir}/api_add_users.json"
+        self.write_string_to_file(filepath=filepath,
+                                  string=json.dumps({"inbounds": [inbound]}))
+
+        # The users file is removed whether the call succeeds or not.
+        command = (f"sh -c 'xray api adu --server={api_address} {filepath}; "
+                   f"status=$?; rm -f {filepath}; exit $status'")
+        result = self.execute_arbitrary_command_in_container(command, operation="xray_api_add")
+
+        expected = len(inbound["settings"]["clients"])
+        if f"Added {expected} user(s)" not in result[1].decode():
+            raise ExecRunError(_(f"""Xray API did not add all users.
+                                 Expected {expected}. Result: {result}."""))
+
+
+    def remove_clients_via_api(self, api_address: str, inbound_tag: str,
+                               emails: list[str]) -> None:
+        command = f"xray api rmu --server={api_address} -tag={inbound_tag} {' '.join(emails)}"
+        self.execute_arbitrary_command_in_container(command, operation="xray_api_remove")
+
+
 class XrayConfigurator(Configurator):
 # https://github.com/amnezia-vpn/amnezia-client/blob/dev/client/configurators/xray.cpp
 
@@ -240,38 +553,164 @@ class XrayConfigurator(Configurator):
         super().__init__(controller)
         self.controller: XrayContainerController
 
-        self.server_public_key = self.controller.get_server_public_key()
-        self.server_short_id = self.controller.get_server_short_id_key()
+        self.server_public_key = self._snapshot["server_public_key"]
+        self.server_short_id = self._snapshot["server_short_id"]
+        # The config is parsed once and then changed in memory. It is
+        # parsed again only with a new configurator, i.e. when the config
+        # hash in the container differs from the one the API wrote.
+        self.server_config_dict = self._parse_server_config()
+        self.client_ids = {client.get("id") for client in
+                           self.server_config_dict["inbounds"][0]["settings"]["clients"]}
+        self.api_address = self._get_api_address_from_server_config()
+        # Xray container has no clientsTable, so client names
+        # are kept only in the local clients registry.
+        self.exports_clients_table = False
         self._log_init_complete()
 
 
-    def _prepare_server_config(self) -> uuid.UUID:
+    def _prepare_server_config(self, count: int = 1) -> list[uuid.UUID]:
 
-        # Generate new UUID for client
-        client_id = uuid.uuid1()
+        # Generate new UUIDs for clients
+        client_ids = [uuid.uuid1() for i in range(count)]
 
         server_config_dict = self._validate_server_config()
 
-        # Add a new user to the config
-        client_config = {"id": str(client_id), "flow": "xtls-rprx-vision"}
-        server_config_dict["inbounds"][0].get(
-                            "settings").get("clients").append(client_config)
+        # Add new users to the config
+        inbound = server_config_dict["inbounds"][0]
+        clients = inbound.get("settings").get("clients")
+        # The email is what xray API uses to identify a user on removal.
+        new_clients = [{"id": str(client_id), "flow": "xtls-rprx-vision",
+                        "email": str(client_id)}
+                       for client_id in client_ids]
+        clients.extend(new_clients)
         try:
-            new_server_config = json.dumps(server_config_dict, indent=4)
-        except Exception as e:
-            raise ServerConfigError(_(f"""Error when trying to json.dumps() an 
-                                      updated server config. Details: {e}"""))
+            # Load the new config into the container
+            self._update_server_config(self._dump_server_config(server_config_dict))
+        except Exception:
+            # Keep the config in memory the same as in the container.
+            del clients[len(clients) - len(new_clients):]
+            raise
+        self.client_ids.update(client["id"] for client in new_clients)
+
+        self._apply_new_clients(inbound, new_clients)
+
+        return client_ids
+
 
-        # Load the new config into the container
-        self._update_server_config(new_server_config)
+    @override
+    def revoke_config(self, client_id: str | None = None,
+                      client_name: str | None = None) -> list[str]:
+        # Client names are looked up in the local clients registry.
+        if client_id is not None:
+            client_ids = {client_id}
+        elif client_name is not None:
+            client_ids = set(self._find_client_ids_in_clients_table(client_name))
+        else:
+            client_ids = set()
+
+        client_ids &= self.client_ids
+        if not client_ids:
+            raise ClientNotFoundError(_(f"""No xray clients found for client
+                                      id '{client_id}', name '{client_name}'."""))
+
+        server_config_dict = self._validate_server_config()
+        inbound = server_config_dict["inbounds"][0]
+        clients = inbound["settings"]["clients"]
+        removed = [client for client in clients if client.get("id") in client_ids]
+        inbound["settings"]["clients"] = [client for client in clients
+                                          if client.get("id") not in client_ids]
+        try:
+            self._update_server_config(self._dump_server_config(server_config_dict))
+        except Exception:
+            inbound["settings"]["clients"] = clients
+            raise
+        self.client_ids -= client_ids
+
+        self._apply_removed_clients(inbound, removed)
+
+        removed_ids = [client["id"] for client in removed]
+        clients_registry.remove_clients(self.controller.clients_key, removed_ids)
+        return removed_ids
+
+
+    def _apply_removed_clients(self, inbound: dict, removed_clients: list[dict]) -> None:
+        # Users are removed from the running inbound by their email. Clients
+        # created without one (e.g. by the desktop app) need a restart.
+        emails = [client.get("email") for client in removed_clients]
+        if self.api_address is not None and all(emails):
+            try:
+                self.controller.remove_clients_via_api(
+                        self.api_address, inbound["tag"], emails)
+                logger.debug(f"Removed {len(emails)} clients through xray API.")
+                return
+            except ExecRunError as e:
+                logger.warning(f"Could not remove clients through xray API, restarting container. Details: {e}")
+                self.api_address = None
 
-        # Restart container
         self.controller.restart_container()
 
-        return client_id
+
+    def _apply_new_clients(self, inbound: dict, new_clients: list[dict]) -> None:
+        # server.json is already persisted at this point. Hot-adding users
+        # through the API keeps live sessions, the restart is the fallback.
+        if self.api_address is not None:
+            try:
+                self.controller.add_clients_via_api(
+                        self.api_address,
+                        {
+                            "tag": inbound["tag"],
+                            "protocol": inbound.get("protocol"),
+                            "settings": {"clients": new_clients}
+                            })
+                logger.debug(f"Added {len(new_clients)} clients through xray API.")
+                return
+            except ExecRunError as e:
+                # Do not try the API again until the configurator is
+                # re-initialized (which happens after the restart anyway).
+                logger.warning(f"Could not add clients through xray API, restarting container. Details: {e}")
+                self.api_address = None
+
+        self.controller.restart_container()
+
+
+    def _get_api_address_from_server_config(self) -> str | None:
+        # The API is usable only if HandlerService is enabled and the
+        # clients inbound has a tag to address it by.
+        if not settings.xray_use_api:
+            return None
+
+        server_config_dict = self._validate_server_config()
+        api = server_config_dict.get("api")
+        if api is None or "HandlerService" not in api.get("services", []):
+            logger.debug("Xray API HandlerService is not enabled in server config.")
+            return None
+
+        if server_config_dict["inbounds"][0].get("tag") is None:
+            logger.debug("Xray clients inbound has no tag, xray API will not be used.")
+            return None
+
+        if api.get("listen"):
+            return api["listen"]
+
+        # Older way to expose the API: a dokodemo-door inbound with the api tag.
+        for inbound in server_config_dict["inbounds"]:
+            if api.get("tag") is not None and inbound.get("tag") == api.get("tag"):
+                return f"{inbound.get('listen', '127.0.0.1')}:{inbound.get('port')}"
+
+        return None
+
+
+    @override
+    def get_load(self) -> tuple[int, int | None]:
+        return len(self.client_ids), None
 
 
     def _validate_server_config(self) -> dict[str, list]:
+        # The parsed config, see __init__.
+        return self.server_config_dict
+
+
+    def _parse_server_config(self) -> dict[str, list]:
         # Validate server config structure
         if self.server_config is None:
             raise ServerConfigError("Could not read server config.")
@@ -302,50 +741,96 @@ class XrayConfigurator(Configurator):
         return server_config_dict
 
 
+    def _dump_server_config(self, server_config_dict: dict) -> str:
+        # Compact, as the config is only read by xray and the AmneziaVPN app.
+        try:
+            return json.dumps(server_config_dict, separators=(",", ":"))
+        except Exception as e:
+            raise ServerConfigError(_(f"""Error when trying to json.dumps() an 
+                                      updated server config. Details: {e}"""))
+
+
     @override
-    def create_config(self, client_name: str) -> str:
-        client_id = self._prepare_server_config()
-        variables = {
-                "$CLIENT_ID": str(client_id),
-                "$SERVER_PUBLIC_KEY": self.server_public_key,
-                "$SERVER_IP": self.server_public_ip,
-                "$SHORT_ID": self.server_short_id
-                }
-        user_config = self._replace_variables_in_config(
-                self._get_client_config_template(),
-                variables).strip()
+    def create_configs(self, client_names: list[str]) -> list[str]:
+        # Resolved before the server config is changed: clients without
+        # configs must not be left behind if the lookup fails.
+        server_ip = self.server_public_ip
+        client_ids = self._prepare_server_config(count=len(client_names))
+        user_configs = self._compose_new_user_configs(client_ids, server_ip)
 
         # Seems like xray container does not have clientsTable at this point, 
-        # so I comment out this method.
-
-        # self.add_entry_to_clients_table(client_id=str(client_id),
-        #                                 client_name=client_name)
+        # so the clients are only recorded in the local registry.
+        self._add_entries_to_clients_table(
+                [(str(client_id), client_name)
+                 for client_id, client_name in zip(client_ids, client_names)])
                     
-        return user_config
-            
+        return user_configs
+
+
+    def _compose_new_user_configs(self, client_ids: list[uuid.UUID],
+                                  server_ip: str) -> list[str]:
+        return self._get_client_config_plan().render_many(
+                common_values={
+                    "$SERVER_PUBLIC_KEY": self.server_public_key,
+                    "$SERVER_IP": server_ip,
+                    "$SHORT_ID": self.server_short_id
+                    },
+                values_list=[{"$CLIENT_ID": str(client_id)} for client_id in client_ids])
 
 
     def _update_server_config(self, new_server_config: str) -> None:
+        # The config is not read back: the registry checks the config hash
+        # in the container against the hash of what was written.
         self.controller.update_server_config(new_server_config)
-        self.server_config = self.controller.get_server_config()
+        self.server_config = new_server_config
         self._log_server_config_updated()
 
     
-    def _get_client_config_template(self) -> str:
+    def _get_client_config_plan(self) -> RenderPlan:
         
-        return XRAY_CLIENT_TEMPLATE
+        return XRAY_CLIENT_PLAN
 
 
 class WgContainerController(ContainerController):
-    def __init__(self, container: Container) -> None:
-        self.container = container
+    def __init__(self, container: Container, host_name: str | None = None) -> None:
+        super().__init__(container, host_name)
         self.working_dir = "/opt/amnezia/wireguard"
+        # Amnezia awg container ships its tools under the same names,
+        # so this is only overriden if that ever changes.
+        self.wg_tool = "wg"
 
 
     def get_server_config(self) -> str:
-        filepath = f"{self.working_dir}/wg0.conf"
+        filepath = self.get_interface_config_path("wg0")
         return super().get_text_file_from_container(filepath=filepath)
 
+
+    def get_interface_config_path(self, interface: str) -> str:
+        return f"{self.working_dir}/{interface}.conf"
+
+
+    def get_config_paths(self) -> list[str]:
+        # The configs of all the shards, including the ones not created yet
+        # (missing files are hashed as empty), so that a shard created by
+        # another process changes the hash too.
+        return [self.get_interface_config_path(f"wg{index}")
+                for index in range(settings.wg_max_shards)] + \
+               [f"{self.working_dir}/clientsTable"]
+
+
+    def get_config_snapshot(self) -> dict[str, str]:
+        filepaths = {
+            "server_config": self.get_interface_config_path("wg0"),
+            "server_public_key": f"{self.working_dir}/wireguard_server_public_key.key",
+            "server_psk": f"{self.working_dir}/wireguard_psk.key",
+            "clients_table": f"{self.working_dir}/clientsTable"
+            }
+        # Configs of the other shards, if they have been created.
+        shard_keys = tuple(f"shard_config_{index}" for index in range(1, settings.wg_max_shards))
+        for index, key in enumerate(shard_keys, start=1):
+            filepaths[key] = self.get_interface_config_path(f"wg{index}")
+        return super()._get_snapshot(filepaths, optional=("clients_table", *shard_keys))
+
     
     def get_server_public_key(self) -> str:
         filepath = f"{self.working_dir}/wireguard_server_public_key.key"
@@ -357,16 +842,86 @@ class WgContainerController(ContainerController):
         return super().get_text_file_from_container(filepath=filepath)
 
 
-    def update_server_config(self, new_config: str) -> None:
-        config_path = f"{self.working_dir}/wg0.conf"
-        super().write_string_to_file(filepath=config_path,
-                                   string=new_config)
+    def update_server_config(self, new_config: str, interface: str = "wg0") -> None:
+        config_path = self.get_interface_config_path(interface)
+        super().write_files_to_container({config_path: new_config}, guarded=True)
+
+
+    def append_to_server_config(self, string: str, interface: str = "wg0") -> None:
+        config_path = self.get_interface_config_path(interface)
+        super().append_string_to_file(filepath=config_path, string=string, guarded=True)
+
+
+    def sync_config(self, interface: str = "wg0") -> None:
+        config_path = self.get_interface_config_path(interface)
+        command = f"bash -c '{self.wg_tool} syncconf {interface} <({self.wg_tool}-quick strip {config_path})'"
+        super().execute_arbitrary_command_in_container(command, operation="wg_syncconf")
+
+
+    def create_interface(self, interface: str, config: str) -> None:
+        # The write is guarded, and the new config file is one of the config
+        # paths, so this fails if another process has created it meanwhile.
+        config_path = self.get_interface_config_path(interface)
+        super().write_files_to_container({config_path: config}, guarded=True)
+        self.bring_up_interface(interface)
+
+
+    def bring_up_interface(self, interface: str) -> None:
+        # The container only brings up wg0 when it starts, the other
+        # interfaces are brought up by the API. Does nothing if it is up.
+        config_path = self.get_interface_config_path(interface)
+        command = f"sh -c '{self.wg_tool} show {interface} >/dev/null 2>&1 || {self.wg_tool}-quick up {config_path}'"
+        super().execute_arbitrary_command_in_container(command, operation="wg_up")
+
+
+    def update_server_config_and_clients_table(self, new_configs: dict[str, str],
+                                               clients_table: str | None) -> None:
+        # new_configs are the server configs by interface. All the files
+        # are uploaded in one archive.
+        files = {self.get_interface_config_path(interface): config
+                 for interface, config in new_configs.items()}
+        if clients_table is not None:
+            files[f"{self.working_dir}/clientsTable"] = clients_table
+        super().write_files_to_container(files, guarded=True)
 
 
-    def sync_config(self) -> None:
-        config_path = f"{self.working_dir}/wg0.conf"
-        command = f"bash -c 'wg syncconf wg0 <(wg-quick strip {config_path})'"
-        super().execute_arbitrary_command_in_container(command)
+    def remove_peers(self, public_keys: list[str], interface: str = "wg0") -> None:
+        chunk_size = 100
+        for start in range(0, len(public_keys), chunk_size):
+            command = f"{self.wg_tool} set {interface}"
+            for public_key in public_keys[start:start + chunk_size]:
+                command += f" peer {public_key} remove"
+            super().execute_arbitrary_command_in_container(command, operation="wg_remove_peers")
+
+
+    def add_peers(self, peers: list[tuple[str, str]], interface: str = "wg0") -> None:
+        # Adds (public_key, client_ip) peers to the running interface without
+        # making the kernel diff the whole peer list, as syncconf does.
+        # All peers share the server preshared key file.
+        psk_path = f"{self.working_dir}/wireguard_psk.key"
+        chunk_size = 100
+
+        for start in range(0, len(peers), chunk_size):
+            command = f"{self.wg_tool} set {interface}"
+            for public_key, client_ip in peers[start:start + chunk_size]:
+                command += f" peer {public_key} preshared-key {psk_path} allowed-ips {client_ip}/32"
+            super().execute_arbitrary_command_in_container(command, operation="wg_add_peers")
+
+
+class WgShard:
+    # One WireGuard interface of the container: wg0, which the container
+    # sets up, or one that the API has added when the others were full.
+    # Every shard has its own config file, listen port and client subnet,
+    # the server keys are the same.
+
+    def __init__(self, interface: str, wg_config: WgServerConfig,
+                 listen_port: int, address_pool: AddressPool):
+        self.interface = interface
+        self.wg_config = wg_config
+        self.listen_port = listen_port
+        self.address_pool = address_pool
+        # New peers added with 'wg set' since the last 'wg syncconf'.
+        self.peers_since_full_sync = 0
 
 
 class WgConfigurator(Configurator):
@@ -375,158 +930,452 @@ class WgConfigurator(Configurator):
     def __init__(self, controller: WgContainerController):
         super().__init__(controller)
         self.controller: WgContainerController
-        self.server_public_key = self.controller.get_server_public_key()
-        self.server_psk        = self.controller.get_server_preshared_key()
-        self.listen_port       = self._get_port_from_server_config()
+        self.server_public_key = self._snapshot["server_public_key"]
+        self.server_psk        = self._snapshot["server_psk"]
+        self._sync_clients_registry(self._snapshot.pop("clients_table", None))
         self.dns               = settings.dns
-        self.subnet_part       = self._get_subnet_ip_from_server_config()
+        self.shards            = self._build_shards()
         self._log_init_complete()
 
 
     @override
-    def create_config(self, client_name: str) -> str:
-        private_key, public_key, client_ip = self._prepare_wg_config()
-        user_config = self._compose_new_user_config(client_ip, private_key)
-        self._add_entry_to_clients_table(client_id=public_key, client_name=client_name)
+    def create_configs(self, client_names: list[str]) -> list[str]:
+        # Resolved before any peer is claimed or added: peers without
+        # configs must not be left behind if the lookup fails.
+        server_ip = self.server_public_ip
+        # Spare peers from the warm pool are used first, they are already
+        # in the server config and on the interface.
+        peers = self._claim_warm_peers(count=len(client_names))
+        if len(peers) < len(client_names):
+            try:
+                peers += self._prepare_wg_configs(count=len(client_names) - len(peers))
+            except Exception:
+                # The claimed peers were not given out, put them back.
+                if peers:
+                    warm_pool.add(self.controller.clients_key, peers)
+                raise
+        user_configs = self._compose_new_user_configs(
+                [(client_ip, private_key) for private_key, public_key, client_ip in peers],
+                server_ip)
+        self._add_entries_to_clients_table(
+                [(public_key, client_name) for (private_key, public_key, client_ip),
+                 client_name in zip(peers, client_names)])
+
+        return user_configs
+
+
+    @property
+    def server_config(self) -> str | None:
+        # For WireGuard the parsed config is the source of truth,
+        # the text is serialized from it (and cached) when needed.
+        # This is wg0's config, the other shards have their own.
+        return self.wg_config.serialize()
+
+
+    @server_config.setter
+    def server_config(self, value: str | None) -> None:
+        if value is None:
+            raise ServerConfigError("Could not read server config.")
+        self.wg_config = WgServerConfig(value)
+
+
+    def _build_shards(self) -> list[WgShard]:
+        shards = [self._build_shard("wg0", self.wg_config)]
+        for index in range(1, settings.wg_max_shards):
+            shard_config = self._snapshot.pop(f"shard_config_{index}", None)
+            if shard_config is None:
+                continue
+            shard = self._build_shard(f"wg{index}", WgServerConfig(shard_config))
+            # E.g. after the container has been restarted.
+            self.controller.bring_up_interface(shard.interface)
+            shards.append(shard)
+        return shards
 
-        return user_config
 
+    def _build_shard(self, interface: str, wg_config: WgServerConfig) -> WgShard:
+        return WgShard(interface, wg_config,
+                       listen_port=self._get_port_from_server_config(wg_config),
+                       address_pool=self._build_address_pool(wg_config))
 
-    def _get_port_from_server_config(self) -> int:
-        listen_port_line = self._get_lines_from_config(["ListenPort"])
 
-        if not listen_port_line:
+    def _get_port_from_server_config(self, wg_config: WgServerConfig) -> int:
+        listen_ports = wg_config.get_interface_values("ListenPort")
+
+        if not listen_ports:
             raise ServerConfigError(_(f"""Listen port not found in the server config. 
                            Does the config contain 'ListenPort'?"""))
 
-        if len(listen_port_line) > 1:
+        if len(listen_ports) > 1:
             raise ServerConfigError(_(f"""More than one 'ListenPort' lines 
                                       found in server config. Expected exactly one."""))
         
-        return int(listen_port_line[0].split("=")[1].strip())
+        return int(listen_ports[0])
 
 
-    def _get_subnet_ip_from_server_config(self) -> str:
-        address_lines = self._get_lines_from_config(["Address"])
-        if not address_lines:
+    def _get_interface_address_from_server_config(self, wg_config: WgServerConfig) -> str:
+        # Returns the server address with the subnet mask, e.g. '10.8.1.1/24'.
+        addresses = wg_config.get_interface_values("Address")
+        if not addresses:
             raise ServerConfigError(_(f"""Could not find ip in server config. 
                            Does it contain the 'Address' field?"""))
 
-        if address_lines[0].split("/")[-1] != "24":
-            raise ServerConfigError(
-            _(f"""Server subnet mask is not 24 bit. This API does not support it for now."""))
+        # Only the first (IPv4) address is used if there are several.
+        return addresses[0].split(",")[0].strip()
 
-        server_ip = address_lines[0].split("=")[1].strip().split("/")[0]
 
-        # Exactly this line does not work if subnet mask in the address is not 24. 
-        # TODO for arbitrary subnet mask
-        subnet_part = server_ip[:server_ip.rfind(".")]
+    def _build_address_pool(self, wg_config: WgServerConfig) -> AddressPool:
+        try:
+            address_pool = AddressPool(self._get_interface_address_from_server_config(wg_config))
+        except AddressPoolError as e:
+            raise ServerConfigError(f"Could not read server subnet. Details: {e}")
 
-        return subnet_part
+        for ip in self._get_existed_client_ips_from_server_config(wg_config, address_pool):
+            address_pool.take(ip)
 
+        return address_pool
 
-    def _get_existed_client_ips_from_server_config(self) -> list[str]:
-        out = []
-        allowed_ips_lines = self._get_lines_from_config(["AllowedIPs"])
-        if not allowed_ips_lines:
-            return []
 
-        for line in allowed_ips_lines:
-            if line == "":
-                raise ServerConfigError(
-                _(f"""Error while reading allowed ips from server config: 
-                  got an empty line."""))
-
-            ips_string = line.split("=")[1].replace("/32", "")
-            if ips_string is None or ips_string == "":
+    def _get_existed_client_ips_from_server_config(self, wg_config: WgServerConfig,
+                                                   address_pool: AddressPool) -> list[str]:
+        out = []
+        for peer in wg_config.peers.values():
+            if not peer.ip:
                 raise ServerConfigError(_(f"""Error while reading allowed ips from 
-                               server config: could not parse AllowedIPs line."""))
+                               server config: could not parse AllowedIPs of
+                               peer '{peer.public_key}'."""))
 
-            # Get only the first one, in case user configured other AllowedIPs here.
-            ip = ips_string.split(",")[0].strip()
-            if not ip.startswith(self.subnet_part):
+            if peer.ip not in address_pool:
                 raise ServerConfigError(
                 _(f"""Error while reading allowed ips from server config:
                     parsed AllowedIP does not match with server's address.
-                    Parsed ip is '{ip}', while server's subnet is '{self.subnet_part}'."""))
+                    Parsed ip is '{peer.ip}', while server's subnet is '{address_pool.network}'."""))
 
-            out.append(ip)
+            out.append(peer.ip)
                 
         return out
 
 
-    def _update_server_config(self, new_config: str) -> None:
+    def _get_shard_of_peer(self, public_key: str) -> WgShard | None:
+        for shard in self.shards:
+            if public_key in shard.wg_config.peers:
+                return shard
+        return None
+
+
+    def _get_shard_of_ip(self, client_ip: str) -> WgShard:
+        for shard in self.shards:
+            if client_ip in shard.address_pool:
+                return shard
+        raise AddressPoolError(f"Address '{client_ip}' is not in any subnet of the server.")
 
-        self.controller.update_server_config(new_config=new_config)
-        self.server_config = self.controller.get_server_config()
-        self.controller.sync_config()
-        self._log_server_config_updated()
 
+    def _get_shard_room(self, shard: WgShard) -> int:
+        # Number of peers that can still be added to the shard.
+        room = shard.address_pool.free_count
+        if settings.wg_shard_max_peers > 0:
+            room = min(room, settings.wg_shard_max_peers - len(shard.wg_config.peers))
+        return max(room, 0)
 
-    def _prepare_wg_config(self) -> tuple[str, str, str]:
-        private_key, public_key = utils.generate_wg_key_pair()
-        client_ip = self._calculate_next_vacant_ip()
-        new_config = self._compose_new_server_config(client_pubkey=public_key, 
-                                                           client_ip=client_ip)
-        self._update_server_config(new_config)
 
-        return private_key, public_key, client_ip
+    def _get_new_shard_room(self) -> int:
+        # Number of peers a shard that is not created yet will take. Its
+        # subnet is as big as wg0's, without the network, broadcast
+        # and server addresses.
+        room = self.shards[0].address_pool.network.num_addresses - 3
+        if settings.wg_shard_max_peers > 0:
+            room = min(room, settings.wg_shard_max_peers)
+        return max(room, 0)
 
 
-    def _calculate_next_vacant_ip(self) -> str:
-        taken_ips = self._get_existed_client_ips_from_server_config()
-        if not taken_ips:
-            next_ip_number = 2
+    def _update_server_config(self, shard: WgShard) -> None:
+
+        self.controller.update_server_config(new_config=shard.wg_config.serialize(),
+                                             interface=shard.interface)
+        self.reconcile([shard])
+        self._log_server_config_updated()
+
+
+    @override
+    def revoke_config(self, client_id: str | None = None,
+                      client_name: str | None = None) -> list[str]:
+        # Peers are removed from the config files and from the running
+        # interfaces, their addresses go back to the pool, and the entries
+        # are removed from clientsTable. All files are written at once.
+        if client_id is not None:
+            client_ids = [client_id]
+        elif client_name is not None:
+            client_ids = self._find_client_ids_in_clients_table(client_name)
         else:
-            # Here we asssume that peers in the config stay in the accending order,
-            # and we just take the last one plus one.
-            # This does not feel right. Is this guaranteed by Amnezia client?
-            # Seems so, but it's quite implicit.
-            next_ip_number = int(taken_ips[-1].split(".")[-1]) + 1
-            if next_ip_number > 254: 
-                raise AddressPoolError("No available IP address left")
+            client_ids = []
+
+        keys_by_shard: dict[WgShard, list[str]] = {}
+        for key in client_ids:
+            shard = self._get_shard_of_peer(key)
+            if shard is not None:
+                keys_by_shard.setdefault(shard, []).append(key)
+        client_ids = [key for key in client_ids if self._get_shard_of_peer(key) is not None]
+        if not client_ids:
+            raise ClientNotFoundError(_(f"""No peers found for client
+                                      id '{client_id}', name '{client_name}'."""))
+
+        # The registry is changed only after the files are written, in case
+        # the write fails (e.g. the config was changed by someone else).
+        container_name = self.controller.clients_key
+        clients_table, last_seq = clients_registry.export_clients_table(container_name)
+        clients_table = [entry for entry in clients_table
+                         if entry.get("clientId") not in client_ids]
+        clients_table_string = self._dump_clients_table(clients_table) \
+                if self.exports_clients_table else None
+
+        removed_peers = [(shard, shard.wg_config.remove_peer(key))
+                         for shard, keys in keys_by_shard.items() for key in keys]
+        self.controller.update_server_config_and_clients_table(
+                {shard.interface: shard.wg_config.serialize() for shard in keys_by_shard},
+                clients_table_string)
+        clients_registry.remove_clients(container_name, client_ids)
+        if clients_table_string is not None:
+            clients_registry.mark_exported(container_name, last_seq)
+
+        for shard, keys in keys_by_shard.items():
+            if settings.wg_apply_mode == "incremental":
+                try:
+                    self.controller.remove_peers(keys, interface=shard.interface)
+                except ExecRunError as e:
+                    logger.warning(f"Could not remove peers incrementally, doing a full sync. Details: {e}")
+                    self.reconcile([shard])
+            else:
+                self.reconcile([shard])
+
+        for shard, peer in removed_peers:
+            if peer is not None and peer.ip is not None:
+                shard.address_pool.release(peer.ip)
 
-        subnet_part = self._get_subnet_ip_from_server_config()
-        return subnet_part + "." + str(next_ip_number)
+        self._log_server_config_updated()
+        return client_ids
 
 
-    def _compose_new_server_config(self, client_pubkey: str, client_ip: str) -> str:
-        if self.server_config is None:
-            raise ServerConfigError("Server config is None.")
-
-        new_server_config = self.server_config + \
-                self._replace_variables_in_config(
-                    template=WIREGUARD_SERVER_PEER_TEMPLATE,
-                    variables_values={
-                        "$CLIENT_PUBKEY": client_pubkey,
-                        "$PRESHARED_KEY": self.server_psk,
-                        "$PEER_IP": client_ip
-                        }
-                    )
-        return new_server_config
-
-
-    def _compose_new_user_config(self, client_ip: str, private_key) -> str:
-        template = WIREGUARD_CLIENT_CONFIG_TEMPLATE
-        user_config = self._replace_variables_in_config(
-                template=template,
-                variables_values={
-                    "$WIREGUARD_CLIENT_IP": client_ip,
+    @override
+    def get_load(self) -> tuple[int, int | None]:
+        # Shards that can still be created count as free room.
+        peers = sum(len(shard.wg_config.peers) for shard in self.shards)
+        free = sum(self._get_shard_room(shard) for shard in self.shards) + \
+               (settings.wg_max_shards - len(self.shards)) * self._get_new_shard_room()
+        return peers, free
+
+
+    @override
+    def update_metrics(self) -> None:
+        container_name = self.controller.clients_key
+        for shard in self.shards:
+            wg_peers.set(len(shard.wg_config.peers), container_name, shard.interface)
+            wg_free_addresses.set(shard.address_pool.free_count, container_name, shard.interface)
+
+
+    def refill_warm_pool(self) -> int:
+        # Adds up to settings.warm_pool_batch spare peers to the warm pool,
+        # returns the number of added peers.
+        container_name = self.controller.clients_key
+        count = min(settings.warm_pool_batch,
+                    settings.warm_pool_size - warm_pool.count(container_name))
+        if count <= 0:
+            return 0
+
+        peers = self._prepare_wg_configs(count=count)
+        warm_pool.add(container_name, peers)
+        logger.debug(f"Added {count} peers to the warm pool of {container_name}.")
+        return count
+
+
+    def _claim_warm_peers(self, count: int) -> list[tuple[str, str, str]]:
+        if settings.warm_pool_size <= 0:
+            return []
+
+        peers = []
+        for private_key, public_key, client_ip in warm_pool.claim(
+                self.controller.clients_key, count):
+            # The config could have been changed outside of the API.
+            shard = self._get_shard_of_peer(public_key)
+            peer = shard.wg_config.peers[public_key] if shard is not None else None
+            if peer is None or peer.ip != client_ip:
+                logger.warning(f"Warm pool peer '{public_key}' is not in server config, skipping it.")
+                continue
+            peers.append((private_key, public_key, client_ip))
+
+        return peers
+
+
+    def _prepare_wg_configs(self, count: int) -> list[tuple[str, str, str]]:
+        # All peers are added to the parsed configs in memory first,
+        # then the config of every shard that got new peers is written
+        # and synced once.
+        peers = []
+        new_peers: dict[WgShard, list[WgPeer]] = {}
+        try:
+            for i in range(count):
+                private_key, public_key = utils.generate_wg_key_pair()
+                shard, client_ip = self._calculate_next_vacant_ip()
+                peers.append((private_key, public_key, client_ip))
+                new_peers.setdefault(shard, []).append(shard.wg_config.add_peer_section(
+                    self._compose_new_peer_section(client_pubkey=public_key,
+                                                   client_ip=client_ip)))
+
+            for shard, shard_peers in new_peers.items():
+                if settings.wg_apply_mode == "incremental":
+                    self._append_peers_to_server_config(shard, shard_peers)
+                else:
+                    self._update_server_config(shard)
+        except Exception:
+            # Give the addresses back, the peers were not added.
+            for private_key, public_key, client_ip in peers:
+                shard = self._get_shard_of_ip(client_ip)
+                shard.wg_config.remove_peer(public_key)
+                shard.address_pool.release(client_ip)
+            raise
+
+        return peers
+
+
+    def _append_peers_to_server_config(self, shard: WgShard,
+                                       new_peers: list[WgPeer]) -> None:
+        # Only the new peer sections are appended to the config file, and only
+        # the new peers are added to the running interface. A full syncconf is
+        # still made every settings.wg_full_sync_every peers to reconcile
+        # the interface with the config file.
+        self.controller.append_to_server_config(
+                "\n" + shard.wg_config.serialize_peers(new_peers), interface=shard.interface)
+
+        shard.peers_since_full_sync += len(new_peers)
+        try:
+            self.controller.add_peers([(peer.public_key, peer.ip) for peer in new_peers],
+                                      interface=shard.interface)
+        except ExecRunError as e:
+            logger.warning(f"Could not add peers incrementally, doing a full sync. Details: {e}")
+            self.reconcile([shard])
+
+        if 0 < settings.wg_full_sync_every <= shard.peers_since_full_sync:
+            self.reconcile([shard])
+        self._log_server_config_updated()
+
+
+    def reconcile(self, shards: list[WgShard] | None = None) -> None:
+        # Syncs the given shards, or all of them.
+        for shard in self.shards if shards is None else shards:
+            self.controller.sync_config(interface=shard.interface)
+            shard.peers_since_full_sync = 0
+        logger.debug(f"Full config sync for {self.controller.container.name} done.")
+
+
+    def _calculate_next_vacant_ip(self) -> tuple[WgShard, str]:
+        # New peers go to the shard with the fewest peers that has room,
+        # a new shard is created if none has.
+        shards = [shard for shard in self.shards if self._get_shard_room(shard) > 0]
+        if shards:
+            shard = min(shards, key=lambda shard: len(shard.wg_config.peers))
+        elif len(self.shards) < settings.wg_max_shards and self._get_new_shard_room() > 0:
+            shard = self._create_shard()
+        else:
+            networks = ", ".join(str(shard.address_pool.network) for shard in self.shards)
+            raise AddressPoolError(f"No available IP address left in {networks}")
+        return shard, shard.address_pool.allocate()
+
+
+    def _create_shard(self) -> WgShard:
+        # The new interface gets wg0's interface lines (keys, MTU, AmneziaWG
+        # parameters) with the next vacant subnet of the same size, the
+        # server address at the same offset in it, and the next vacant port.
+        base = self.shards[0]
+        interfaces = {shard.interface for shard in self.shards}
+        interface = next(f"wg{index}" for index in range(1, settings.wg_max_shards)
+                         if f"wg{index}" not in interfaces)
+        network = self._get_vacant_shard_network()
+        server_ip = ipaddress.IPv4Address(int(network.network_address) + (
+                int(ipaddress.IPv4Address(base.address_pool.server_ip))
+                - int(base.address_pool.network.network_address)))
+        listen_port = self._get_vacant_shard_port()
+
+        lines = [line for line in base.wg_config.interface_lines
+                 if line.split("=", 1)[0].strip() not in SHARD_OWN_INTERFACE_KEYS]
+        lines.append(WIREGUARD_SHARD_INTERFACE_PLAN.render({
+                    "$SHARD_ADDRESS": f"{server_ip}/{network.prefixlen}",
+                    "$SHARD_PORT": str(listen_port),
+                    "$SHARD_SUBNET": str(network),
+                    "$EGRESS_INTERFACE": self._get_egress_interface()
+                    }))
+        wg_config = WgServerConfig("\n".join(lines))
+
+        self.controller.create_interface(interface, wg_config.serialize())
+        shard = self._build_shard(interface, wg_config)
+        self.shards.append(shard)
+        logger.info(_(f"""Created interface {interface} ({network}, port {listen_port})
+                      in {self.controller.container.name}."""))
+        return shard
+
+
+    def _get_egress_interface(self) -> str:
+        # The interface wg0's traffic is masqueraded to, if its config
+        # has the rule, e.g. 'PostUp = iptables -t nat -A POSTROUTING
+        # -s 10.8.1.0/24 -o ens3 -j MASQUERADE'. Amnezia containers set the
+        # rule up in their start script instead, for eth0.
+        for rules in self.shards[0].wg_config.get_interface_values("PostUp"):
+            match = EGRESS_INTERFACE_PATTERN.search(rules)
+            if match is not None:
+                return match.group(1)
+        return DEFAULT_EGRESS_INTERFACE
+
+
+    def _get_vacant_shard_network(self) -> ipaddress.IPv4Network:
+        # The subnets following wg0's, of the same size.
+        base = self.shards[0].address_pool.network
+        networks = [shard.address_pool.network for shard in self.shards]
+        for index in range(1, 256):
+            address = int(base.network_address) + index * base.num_addresses
+            if address + base.num_addresses > 2 ** 32:
+                break
+            network = ipaddress.IPv4Network((address, base.prefixlen))
+            if not any(network.overlaps(other) for other in networks):
+                return network
+        raise AddressPoolError(f"No vacant subnet for a new interface next to {base}.")
+
+
+    def _get_vacant_shard_port(self) -> int:
+        # The ports following wg0's.
+        ports = {shard.listen_port for shard in self.shards}
+        for port in range(self.shards[0].listen_port + 1, 65536):
+            if port not in ports:
+                return port
+        raise ServerConfigError("No vacant port for a new interface.")
+
+
+    def _compose_new_peer_section(self, client_pubkey: str, client_ip: str) -> str:
+        return WIREGUARD_SERVER_PEER_PLAN.render({
+                    "$CLIENT_PUBKEY": client_pubkey,
+                    "$PRESHARED_KEY": self.server_psk,
+                    "$PEER_IP": client_ip
+                    })
+
+
+    def _compose_new_user_configs(self, clients: list[tuple[str, str]],
+                                  server_ip: str) -> list[str]:
+        # clients are (client_ip, private_key). The port is the one
+        # of the client's shard.
+        return WIREGUARD_CLIENT_CONFIG_PLAN.render_many(
+                common_values={
                     "$PRIMARY_DNS": self.dns[0],
                     "$SECONDARY_DNS": self.dns[1],
-                    "$WIREGUARD_CLIENT_PRIVATE_KEY": private_key,
                     "$WIREGUARD_SERVER_PUBLIC_KEY": self.server_public_key,
                     "$WIREGUARD_PSK": self.server_psk,
-                    "$SERVER_IP_ADDRESS": self.server_public_ip,
-                    "$WIREGUARD_SERVER_PORT": str(self.listen_port)
-                    }
-                )
-        return user_config.strip()
+                    "$SERVER_IP_ADDRESS": server_ip
+                    },
+                values_list=[{
+                    "$WIREGUARD_CLIENT_IP": client_ip,
+                    "$WIREGUARD_CLIENT_PRIVATE_KEY": private_key,
+                    "$WIREGUARD_SERVER_PORT": str(self._get_shard_of_ip(client_ip).listen_port)
+                    } for client_ip, private_key in clients])
 
 
 class AmneziaWgContainerController(WgContainerController):
-    def __init__(self, container: Container):
-        self.container = container
+    def __init__(self, container: Container, host_name: str | None = None):
+        super().__init__(container, host_name)
         self.working_dir = "/opt/amnezia/awg"
 
 
@@ -540,12 +1389,10 @@ class AmneziaWgConfigurator(WgConfigurator):
 
 
     @override
-    def _compose_new_user_config(self, client_ip: str, private_key) -> str:
-        template = AMNEZIA_WG_CLIENT_CONFIG_TEMPLATE
-        user_config = self._replace_variables_in_config(
-                template=template,
-                variables_values={
-                    "$WIREGUARD_CLIENT_IP": client_ip,
+    def _compose_new_user_configs(self, clients: list[tuple[str, str]],
+                                  server_ip: str) -> list[str]:
+        return AMNEZIA_WG_CLIENT_CONFIG_PLAN.render_many(
+                common_values={
                     "$PRIMARY_DNS": self.dns[0],
                     "$SECONDARY_DNS": self.dns[1],
                     "$JUNK_PACKET_COUNT": self.awg_params.get("Jc"),
@@ -557,14 +1404,15 @@ class AmneziaWgConfigurator(WgConfigurator):
                     "$RESPONSE_PACKET_MAGIC_HEADER": self.awg_params.get("H2"),
                     "$UNDERLOAD_PACKET_MAGIC_HEADER": self.awg_params.get("H3"),
                     "$TRANSPORT_PACKET_MAGIC_HEADER": self.awg_params.get("H4"),
-                    "$WIREGUARD_CLIENT_PRIVATE_KEY": private_key,
                     "$WIREGUARD_SERVER_PUBLIC_KEY": self.server_public_key,
                     "$WIREGUARD_PSK": self.server_psk,
-                    "$SERVER_IP_ADDRESS": self.server_public_ip,
-                    "$AWG_SERVER_PORT": str(self.listen_port)
-                    }
-                )
-        return user_config.strip()
+                    "$SERVER_IP_ADDRESS": server_ip
+                    },
+                values_list=[{
+                    "$WIREGUARD_CLIENT_IP": client_ip,
+                    "$WIREGUARD_CLIENT_PRIVATE_KEY": private_key,
+                    "$AWG_SERVER_PORT": str(self._get_shard_of_ip(client_ip).listen_port)
+                    } for client_ip, private_key in clients])
 
 
     def _read_awg_params_from_server_config(self) -> dict[str, str]:
@@ -572,8 +1420,11 @@ class AmneziaWgConfigurator(WgConfigurator):
         lines_to_search = ["Jc", "Jmin", "Jmax", "S1", "S2",
                              "H1", "H2", "H3", "H4"]
 
-        for line in self._get_lines_from_config(lines_to_search):
-            key, value = (i.strip() for i in line.split("="))
+        for key in lines_to_search:
+            values = self.wg_config.get_interface_values(key)
+            if not values:
+                continue
+            value = values[0]
 
             # check that value is a number. If not, python throw an exception.
             # TODO: do not make it that stupidly
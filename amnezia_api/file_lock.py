@@ -0,0 +1,41 @@
+import fcntl
+import os
+import time
+
+from amnezia_api.utils import LockTimeoutError
+
+
+class FileLock:
+    # Exclusive lock on a file in the API's data directory, shared by all
+    # the API processes (e.g. several gunicorn workers). Threads of one
+    # process must not share a FileLock without their own lock around it:
+    # flock is held by the open file, not by a thread.
+
+    def __init__(self, path: str, poll_interval: float = 0.05):
+        self.path = path
+        self.poll_interval = poll_interval
+        self._fd: int | None = None
+
+
+    def acquire(self, timeout: float) -> None:
+        if self._fd is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._fd = os.open(self.path, os.O_CREAT | os.O_RDWR, 0o600)
+
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    raise LockTimeoutError(
+                            f"Could not lock '{self.path}' in {timeout} seconds.")
+                time.sleep(self.poll_interval)
+
+
+    def release(self) -> None:
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
@@ -0,0 +1,224 @@
+from __future__ import annotations
+import json
+import logging
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from amnezia_api.commit_queue import CommitQueue, get_commit_queue
+from amnezia_api.registry import ConfiguratorRegistry, configurator_registry
+from amnezia_api.settings import settings
+from amnezia_api.utils import PROTOCOLS, AppSettingsError, ContainerName, FleetCapacityError
+from amnezia_api.utils import remove_line_breaks as _
+
+
+logger = logging.getLogger("controller")
+
+
+# Host names are used in file names (lock files) and registry keys.
+HOST_NAME_PATTERN = re.compile(r"[A-Za-z0-9][A-Za-z0-9_.-]*")
+
+
+class FleetHost:
+    # One Amnezia server of the fleet. A host without docker_url is the local
+    # Docker host: it shares the configurators, locks and commit queues with
+    # the regular (non-fleet) routes, and its public IP is SERVER_PUBLIC_IP
+    # or the looked up one.
+
+    def __init__(self, name: str, protocols: set[ContainerName],
+                 docker_url: str | None = None, public_ip: str | None = None):
+        self.name = name
+        self.protocols = protocols
+        self.docker_url = docker_url
+        if docker_url is None:
+            self.registry = configurator_registry
+        else:
+            self.registry = ConfiguratorRegistry(
+                    host_name=name, docker_url=docker_url, public_ip=public_ip)
+        self._commit_queues: dict[ContainerName, CommitQueue] = {}
+        self._lock = threading.Lock()
+
+
+    def get_commit_queue(self, container_name: ContainerName) -> CommitQueue:
+        if self.docker_url is None:
+            return get_commit_queue(container_name)
+
+        with self._lock:
+            queue = self._commit_queues.get(container_name)
+            if queue is None:
+                queue = CommitQueue(container_name, window=settings.commit_window,
+                                    max_batch_size=settings.max_batch_size,
+                                    registry=self.registry)
+                self._commit_queues[container_name] = queue
+            return queue
+
+
+    def read_load(self, container_name: ContainerName) -> tuple[int, int | None]:
+        return self.registry.run(container_name, lambda configurator: configurator.get_load())
+
+
+class _Load:
+    def __init__(self, clients: int | None, free: int | None, available: bool = True):
+        self.clients = clients
+        # None if not limited (e.g. XRay).
+        self.free = free
+        self.available = available
+        self.updated_at = time.monotonic()
+
+
+class Fleet:
+    # Places new clients of a protocol on the least loaded host that has it.
+    # The load of a host is the share of its client addresses in use (for
+    # WireGuard/AmneziaWG), then the number of clients. Loads are read from
+    # the hosts' configurators at most every load_ttl seconds, and clients
+    # placed in the meantime are added to them right away, so concurrent
+    # requests are spread too. Hosts that are unreachable or do not run the
+    # container are skipped until the next read.
+
+    def __init__(self, hosts: list[FleetHost], load_ttl: float = 30):
+        self.hosts = {host.name: host for host in hosts}
+        self.load_ttl = load_ttl
+        self._loads: dict[tuple[str, ContainerName], _Load] = {}
+        self._lock = threading.Lock()
+
+
+    def create_configs(self, container_name: ContainerName,
+                       client_names: list[str]) -> tuple[str, list[str]]:
+        # Returns the name of the chosen host and the configs.
+        host = self.place(container_name, len(client_names))
+        try:
+            return host.name, host.get_commit_queue(container_name).submit(client_names)
+        except Exception:
+            # The reserved clients were not added, read the load again.
+            with self._lock:
+                self._loads.pop((host.name, container_name), None)
+            raise
+
+
+    def place(self, container_name: ContainerName, count: int = 1) -> FleetHost:
+        candidates = [host for host in self.hosts.values()
+                      if container_name in host.protocols]
+        self._refresh_loads(candidates, container_name)
+
+        with self._lock:
+            best_host = None
+            best_score = None
+            for host in candidates:
+                load = self._loads.get((host.name, container_name))
+                if load is None or not load.available:
+                    continue
+                if load.free is not None and load.free < count:
+                    continue
+
+                if load.free is None:
+                    used = 0.0
+                else:
+                    used = load.clients / (load.clients + load.free) if load.free else 1.0
+                score = (used, load.clients)
+                if best_score is None or score < best_score:
+                    best_host, best_score = host, score
+
+            if best_host is None:
+                raise FleetCapacityError(
+                        f"No fleet host can take {count} new {container_name.value} clients.")
+
+            load = self._loads[(best_host.name, container_name)]
+            load.clients += count
+            if load.free is not None:
+                load.free -= count
+            return best_host
+
+
+    def get_status(self) -> dict[str, dict[str, dict]]:
+        # Loads of all the hosts by host name and container name.
+        for container_name in ContainerName:
+            self._refresh_loads([host for host in self.hosts.values()
+                                 if container_name in host.protocols], container_name)
+
+        with self._lock:
+            return {host.name: {
+                container_name.value: {
+                    "clients": load.clients,
+                    "free": load.free,
+                    "available": load.available
+                    }
+                for container_name in host.protocols
+                if (load := self._loads.get((host.name, container_name))) is not None
+                } for host in self.hosts.values()}
+
+
+    def _refresh_loads(self, hosts: list[FleetHost], container_name: ContainerName) -> None:
+        # Reads the loads older than load_ttl, from all the hosts at once.
+        now = time.monotonic()
+        with self._lock:
+            stale = [host for host in hosts
+                     if (load := self._loads.get((host.name, container_name))) is None
+                     or now - load.updated_at >= self.load_ttl]
+        if not stale:
+            return
+
+        with ThreadPoolExecutor(max_workers=len(stale)) as executor:
+            loads = list(executor.map(
+                    lambda host: self._read_load(host, container_name), stale))
+
+        with self._lock:
+            for host, load in zip(stale, loads):
+                self._loads[(host.name, container_name)] = load
+
+
+    def _read_load(self, host: FleetHost, container_name: ContainerName) -> _Load:
+        try:
+            clients, free = host.read_load(container_name)
+        except Exception as e:
+            logger.error(f"Could not read the load of {container_name.value} on fleet host '{host.name}'. Details: {e}")
+            return _Load(None, None, available=False)
+        return _Load(clients, free)
+
+
+def load_fleet(path: str | None) -> Fleet | None:
+    # The fleet config is a JSON file:
+    # {"hosts": [{"name": "de-1", "docker_url": "tcp://203.0.113.10:2375",
+    #             "public_ip": "203.0.113.10", "protocols": ["wireguard"]}]}
+    if path is None:
+        return None
+
+    try:
+        with open(path, "r") as file:
+            config = json.load(file)
+    except (OSError, ValueError) as e:
+        raise AppSettingsError(f"Could not read fleet config '{path}'. Details: {e}")
+
+    hosts = []
+    for entry in config.get("hosts", []):
+        name = entry.get("name")
+        if not isinstance(name, str) or not HOST_NAME_PATTERN.fullmatch(name):
+            raise AppSettingsError(f"Invalid fleet host name: '{name}'.")
+        if name in (host.name for host in hosts):
+            raise AppSettingsError(f"Fleet host '{name}' is listed more than once.")
+
+        protocols = entry.get("protocols", list(PROTOCOLS))
+        unknown = [protocol for protocol in protocols if protocol not in PROTOCOLS]
+        if unknown:
+            raise AppSettingsError(f"Unknown protocols {unknown} of fleet host '{name}'.")
+
+        docker_url = entry.get("docker_url") or None
+        public_ip = entry.get("public_ip") or None
+        if docker_url is None and public_ip is not None:
+            raise AppSettingsError(_(f"""Fleet host '{name}' is the local Docker host
+                                     (no docker_url), its public IP is SERVER_PUBLIC_IP."""))
+        if docker_url is not None and public_ip is None:
+            raise AppSettingsError(f"Fleet host '{name}' needs a public_ip.")
+
+        hosts.append(FleetHost(name, {PROTOCOLS[protocol] for protocol in protocols},
+                               docker_url=docker_url, public_ip=public_ip))
+
+    if not hosts:
+        raise AppSettingsError(f"No hosts in fleet config '{path}'.")
+    if sum(host.docker_url is None for host in hosts) > 1:
+        raise AppSettingsError("Only one fleet host can be the local Docker host.")
+
+    return Fleet(hosts, load_ttl=settings.fleet_load_ttl)
+
+
+fleet = load_fleet(settings.fleet_config)
@@ -0,0 +1,84 @@
+from __future__ import annotations
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Hashable
+
+from amnezia_api.settings import settings
+
+
+class _Entry:
+    def __init__(self):
+        self.result: list[str] | None = None
+        self.error: Exception | None = None
+        self.done = threading.Event()
+        self.expires_at = float("inf")
+
+
+class IdempotencyCache:
+    # Remembers the results of create-config requests by idempotency key for
+    # ttl seconds, so a retried request gets the configs created by the first
+    # one instead of new peers. A duplicate that arrives while the first
+    # request is still running waits for it. Failed requests are not
+    # remembered, their retries run again.
+    # The cache is kept in memory, so it works within one worker process.
+
+    def __init__(self, ttl: float = 600, max_size: int = 10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        # Completed entries are kept in the order of completion,
+        # which is also the order in which they expire.
+        self._entries: OrderedDict[Hashable, _Entry] = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def run(self, key: Hashable, operation: Callable[[], list[str]]) -> list[str]:
+        with self._lock:
+            self._evict()
+            entry = self._entries.get(key)
+            is_first = entry is None
+            if is_first:
+                entry = _Entry()
+                self._entries[key] = entry
+
+        if not is_first:
+            entry.done.wait()
+            if entry.error is not None:
+                raise entry.error
+            return entry.result
+
+        try:
+            entry.result = operation()
+        except Exception as e:
+            entry.error = e
+            with self._lock:
+                self._entries.pop(key, None)
+            raise
+        finally:
+            entry.done.set()
+
+        with self._lock:
+            entry.expires_at = time.monotonic() + self.ttl
+            self._entries.move_to_end(key)
+        return entry.result
+
+
+    def _evict(self) -> None:
+        # Requests that are still running are never evicted, but they do not
+        # hold back the completed entries behind them either.
+        now = time.monotonic()
+        evicted = []
+        for key, entry in self._entries.items():
+            if not entry.done.is_set():
+                continue
+            if entry.expires_at > now and \
+                    len(self._entries) - len(evicted) <= self.max_size:
+                break
+            evicted.append(key)
+
+        for key in evicted:
+            del self._entries[key]
+
+
+idempotency_cache = IdempotencyCache(ttl=settings.idempotency_ttl,
+                                     max_size=settings.idempotency_cache_size)
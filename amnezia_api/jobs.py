@@ -0,0 +1,176 @@
+from __future__ import annotations
+import json
+import logging
+import queue
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from collections import OrderedDict
+
+from amnezia_api.commit_queue import PendingCommit, get_commit_queue
+from amnezia_api.settings import settings
+from amnezia_api.utils import (
+        ContainerName, JobLimitError, convert_string_to_base64_vpn_link,
+        get_current_datetime
+        )
+
+
+logger = logging.getLogger("amnezia_api")
+
+
+# Attempts to deliver a callback. The pauses between the attempts
+# start at CALLBACK_RETRY_DELAY seconds and double every time.
+CALLBACK_ATTEMPTS = 3
+CALLBACK_RETRY_DELAY = 1
+
+
+class Job:
+    def __init__(self, protocol: str, client_names: list[str],
+                 callback_url: str | None = None):
+        self.id = uuid.uuid4().hex
+        self.protocol = protocol
+        self.client_names = client_names
+        self.callback_url = callback_url
+        self.status = "pending"
+        self.configs: list[str] | None = None
+        self.error: str | None = None
+        self.created_at = get_current_datetime()
+        self.finished_at: str | None = None
+        self.expires_at = float("inf")
+
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.id,
+            "protocol": self.protocol,
+            "status": self.status,
+            "client_names": self.client_names,
+            "configs": self.configs,
+            "error": self.error,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at
+            }
+
+
+class JobStore:
+    # Async create-config requests: the clients are put into the container's
+    # commit queue (so they are committed in the same batches as the other
+    # requests) and the request returns a job at once. The result is polled
+    # at /jobs/<id> or posted to the job's callback URL.
+    # Finished jobs are kept for ttl seconds, and at most max_jobs jobs are
+    # kept at all: the oldest finished jobs go first, and new jobs are
+    # refused if all of them are still pending.
+    # Jobs are kept in memory of the worker process, so with several
+    # WORKERS a job is only found by the worker that created it.
+
+    def __init__(self, ttl: float = 3600, max_jobs: int = 10000,
+                 callback_timeout: float = 10):
+        self.ttl = ttl
+        self.max_jobs = max_jobs
+        self.callback_timeout = callback_timeout
+        self._jobs: OrderedDict[str, Job] = OrderedDict()
+        # Finished jobs by id, in the order in which they expire.
+        self._finished: OrderedDict[str, Job] = OrderedDict()
+        self._lock = threading.Lock()
+        self._callbacks: queue.Queue[Job] = queue.Queue()
+        self._callback_worker: threading.Thread | None = None
+
+
+    def submit(self, container_name: ContainerName, protocol: str,
+               client_names: list[str], callback_url: str | None = None) -> dict:
+        # Returns the job as served at /jobs/<id>.
+        job = Job(protocol, client_names, callback_url)
+        with self._lock:
+            self._evict(room=1)
+            if len(self._jobs) >= self.max_jobs:
+                raise JobLimitError(f"Too many pending jobs, the limit is {self.max_jobs}.")
+            self._jobs[job.id] = job
+
+        get_commit_queue(container_name).enqueue(
+                client_names, on_done=lambda pending: self._finish(job, pending))
+        with self._lock:
+            return job.to_dict()
+
+
+    def describe(self, job_id: str) -> dict | None:
+        with self._lock:
+            self._evict()
+            job = self._jobs.get(job_id)
+            return job.to_dict() if job is not None else None
+
+
+    def _finish(self, job: Job, pending: PendingCommit) -> None:
+        # Called in the commit queue worker.
+        if pending.error is None:
+            configs = [convert_string_to_base64_vpn_link(config)
+                       for config in pending.user_configs]
+            error = None
+            logger.info(f"Job {job.id}: {len(configs)} configs created.")
+        else:
+            configs = None
+            error = str(pending.error).strip()
+            logger.error(f"Job {job.id} failed. Details: {error}")
+
+        with self._lock:
+            job.configs = configs
+            job.error = error
+            job.status = "failed" if error is not None else "done"
+            job.finished_at = get_current_datetime()
+            job.expires_at = time.monotonic() + self.ttl
+            self._finished[job.id] = job
+
+        if job.callback_url is not None:
+            self._callbacks.put(job)
+            self._ensure_callback_worker()
+
+
+    def _evict(self, room: int = 0) -> None:
+        # Expired jobs are evicted, and the oldest finished ones until
+        # there is room for this many new jobs.
+        now = time.monotonic()
+        while self._finished:
+            job_id, job = next(iter(self._finished.items()))
+            if job.expires_at > now and len(self._jobs) + room <= self.max_jobs:
+                break
+            del self._finished[job_id]
+            self._jobs.pop(job_id, None)
+
+
+    def _ensure_callback_worker(self) -> None:
+        with self._lock:
+            if self._callback_worker is not None and self._callback_worker.is_alive():
+                return
+            self._callback_worker = threading.Thread(
+                    target=self._deliver_callbacks, name="job-callbacks", daemon=True)
+            self._callback_worker.start()
+
+
+    def _deliver_callbacks(self) -> None:
+        while True:
+            job = self._callbacks.get()
+            with self._lock:
+                body = json.dumps(job.to_dict()).encode()
+
+            for attempt in range(CALLBACK_ATTEMPTS):
+                if attempt > 0:
+                    time.sleep(CALLBACK_RETRY_DELAY * 2 ** (attempt - 1))
+                try:
+                    self._post(job.callback_url, body)
+                    logger.debug(f"Job {job.id}: callback delivered.")
+                    break
+                except (urllib.error.URLError, OSError) as e:
+                    logger.warning(f"Job {job.id}: could not deliver callback, attempt {attempt + 1}. Details: {e}")
+
+
+    def _post(self, url: str, body: bytes) -> None:
+        request = urllib.request.Request(
+                url, data=body, method="POST",
+                headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request, timeout=self.callback_timeout) as response:
+            response.read()
+
+
+job_store = JobStore(ttl=settings.job_ttl, max_jobs=settings.max_jobs,
+                     callback_timeout=settings.job_callback_timeout)
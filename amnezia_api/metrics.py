@@ -0,0 +1,259 @@
+from __future__ import annotations
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, TypeVar
+
+
+# Metrics in the Prometheus text format, served at /<secret>/metrics.
+# https://prometheus.io/docs/instrumenting/exposition_formats/
+# Only what the API needs is implemented, so there is no extra dependency.
+# Metrics are kept per process: with several workers, each worker
+# reports its own numbers.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class _Metric:
+    type_name: str
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...]):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+
+
+    def collect(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}",
+                 f"# TYPE {self.name} {self.type_name}"]
+        with self._lock:
+            lines += self._collect_samples()
+        return lines
+
+
+    def _collect_samples(self) -> list[str]:
+        raise NotImplementedError
+
+
+    def _format_labels(self, labelvalues: tuple[str, ...],
+                       extra: tuple[tuple[str, str], ...] = ()) -> str:
+        pairs = list(zip(self.labelnames, labelvalues)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{_escape(str(value))}"'
+                              for name, value in pairs) + "}"
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple[str, ...], float] = {}
+
+
+    def inc(self, *labelvalues: str, amount: float = 1) -> None:
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+
+    def _collect_samples(self) -> list[str]:
+        return [f"{self.name}{self._format_labels(labelvalues)} {value}"
+                for labelvalues, value in self._values.items()]
+
+
+class Gauge(_Metric):
+    type_name = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple[str, ...], float] = {}
+
+
+    def set(self, value: float, *labelvalues: str) -> None:
+        with self._lock:
+            self._values[labelvalues] = value
+
+
+    def _collect_samples(self) -> list[str]:
+        return [f"{self.name}{self._format_labels(labelvalues)} {value}"
+                for labelvalues, value in self._values.items()]
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = buckets
+        # Per label values: counts per bucket (not cumulative), sum.
+        self._counts: dict[tuple[str, ...], list[int]] = {}
+        self._sums: dict[tuple[str, ...], float] = {}
+
+
+    def observe(self, value: float, *labelvalues: str) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._counts.get(labelvalues)
+            if counts is None:
+                counts = self._counts[labelvalues] = [0] * (len(self.buckets) + 1)
+                self._sums[labelvalues] = 0.0
+            counts[index] += 1
+            self._sums[labelvalues] += value
+
+
+    def _collect_samples(self) -> list[str]:
+        lines = []
+        for labelvalues, counts in self._counts.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                labels = self._format_labels(labelvalues, (("le", le),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+
+            labels = self._format_labels(labelvalues)
+            lines.append(f"{self.name}_sum{labels} {self._sums[labelvalues]}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+M = TypeVar("M", bound=_Metric)
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: list[_Metric] = []
+
+
+    def register(self, metric: M) -> M:
+        self._metrics.append(metric)
+        return metric
+
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines += metric.collect()
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+metrics_registry = MetricsRegistry()
+
+stage_duration = metrics_registry.register(Histogram(
+        "amnezia_api_stage_duration_seconds",
+        "Duration of the stages of config operations.",
+        ("stage", "operation")))
+
+stage_errors = metrics_registry.register(Counter(
+        "amnezia_api_stage_errors_total",
+        "Number of failed stages of config operations.",
+        ("stage", "operation")))
+
+wg_peers = metrics_registry.register(Gauge(
+        "amnezia_api_wg_peers",
+        "Number of peers in the WireGuard/AmneziaWG server config.",
+        ("container", "interface")))
+
+wg_free_addresses = metrics_registry.register(Gauge(
+        "amnezia_api_wg_free_addresses",
+        "Number of free client addresses in the WireGuard/AmneziaWG subnet.",
+        ("container", "interface")))
+
+
+# Durations of the stages of the current request (for the Server-Timing
+# header), per thread. Only collected inside collect_timings().
+_local = threading.local()
+
+# Server-Timing names of the stages, by (stage, operation). The stages are
+# summed up per kind: Docker listing, reading and writing container files,
+# applying the changes to the running VPN service, restarts and rendering.
+# Other stages are named after the stage and operation.
+SERVER_TIMING_NAMES = {
+    ("docker_list", ""): "docker-list",
+    ("read_files", ""): "exec-read",
+    ("exec", "hash"): "exec-read",
+    ("write_files", ""): "exec-write",
+    ("exec", "write_config"): "exec-write",
+    ("exec", "append"): "exec-write",
+    ("exec", "wg_add_peers"): "sync",
+    ("exec", "wg_remove_peers"): "sync",
+    ("exec", "wg_syncconf"): "sync",
+    ("exec", "wg_up"): "sync",
+    ("exec", "xray_api_add"): "sync",
+    ("exec", "xray_api_remove"): "sync",
+    ("restart_container", ""): "restart",
+    ("render", ""): "render",
+    }
+
+
+@contextmanager
+def measure(stage: str, operation: str = "") -> Iterator[None]:
+    # Observes the duration of the block in stage_duration,
+    # failed blocks are counted in stage_errors as well.
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        stage_errors.inc(stage, operation)
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        stage_duration.observe(duration, stage, operation)
+
+        timings = getattr(_local, "timings", None)
+        if timings is not None:
+            name = _get_server_timing_name(stage, operation)
+            timings[name] = timings.get(name, 0) + duration
+
+
+def start_timings() -> dict[str, float]:
+    # Starts collecting the total duration of each stage measured in this
+    # thread, in seconds, by stage name, into the returned dict.
+    timings: dict[str, float] = {}
+    _local.timings = timings
+    return timings
+
+
+def stop_timings() -> None:
+    _local.timings = None
+
+
+@contextmanager
+def collect_timings() -> Iterator[dict[str, float]]:
+    timings = start_timings()
+    try:
+        yield timings
+    finally:
+        stop_timings()
+
+
+def add_timings(timings: dict[str, float]) -> None:
+    # Adds timings collected in another thread (e.g. the commit queue worker)
+    # to the timings collected in this thread, if any.
+    current = getattr(_local, "timings", None)
+    if current is None:
+        return
+    for name, duration in timings.items():
+        current[name] = current.get(name, 0) + duration
+
+
+def _get_server_timing_name(stage: str, operation: str) -> str:
+    name = SERVER_TIMING_NAMES.get((stage, operation))
+    if name is None:
+        name = f"{stage}-{operation}" if operation else stage
+    return name.replace("_", "-")
+
+
+def format_server_timing(timings: dict[str, float]) -> str:
+    # https://www.w3.org/TR/server-timing/ (durations in milliseconds)
+    return ", ".join(f"{name};dur={duration * 1000:.1f}"
+                     for name, duration in timings.items())
@@ -0,0 +1,77 @@
+from __future__ import annotations
+import cProfile
+import datetime
+import logging
+import os
+import threading
+
+from amnezia_api.settings import settings
+
+
+logger = logging.getLogger("amnezia_api")
+
+
+class RequestProfiler:
+    # Profiles the next N requests with cProfile once armed through the
+    # /profile endpoint, and dumps the stats (pstats format) to dump_dir.
+    # Config changes of create-config requests run in the commit queue
+    # worker, which is profiled separately for the batches of profiled
+    # requests (see CommitQueue._commit).
+
+    def __init__(self, dump_dir: str):
+        self.dump_dir = dump_dir
+        self._remaining = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+
+    def arm(self, count: int) -> None:
+        with self._lock:
+            self._remaining = count
+
+
+    def take(self) -> bool:
+        # Returns whether the current request is to be profiled.
+        with self._lock:
+            if self._remaining <= 0:
+                return False
+            self._remaining -= 1
+            return True
+
+
+    def is_profiling(self) -> bool:
+        # Whether the current thread is being profiled.
+        return getattr(self._local, "profile", None) is not None
+
+
+    def start(self) -> None:
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError as e:
+            # Since python 3.12 only one profiler may be active at a time,
+            # and it sees all the threads, so e.g. the commit of a profiled
+            # request is already in the request's profile.
+            logger.debug(f"Could not start profiling. Details: {e}")
+            return
+        self._local.profile = profile
+
+
+    def stop(self, name: str) -> str | None:
+        # Returns the path of the dump.
+        profile = getattr(self._local, "profile", None)
+        if profile is None:
+            return None
+
+        profile.disable()
+        self._local.profile = None
+
+        os.makedirs(self.dump_dir, exist_ok=True)
+        timestamp = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%dT%H%M%S.%f")
+        path = os.path.join(self.dump_dir, f"{timestamp}-{name}.pstats")
+        profile.dump_stats(path)
+        logger.info(f"Profile of '{name}' saved to '{path}'.")
+        return path
+
+
+request_profiler = RequestProfiler(os.path.join(settings.data_dir, "profiles"))
@@ -0,0 +1,178 @@
+from __future__ import annotations
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from typing import Callable, Iterator, TypeVar
+
+import docker
+from docker.errors import DockerException, NotFound
+
+from amnezia_api.controllers import Configurator, ServerController
+from amnezia_api.file_lock import FileLock
+from amnezia_api.settings import settings
+from amnezia_api.utils import remove_line_breaks as _
+from amnezia_api.utils import (
+        ClientsTableError, ConfigChangedError, ContainerName, ExecRunError, ServerConfigError
+        )
+
+
+T = TypeVar("T")
+
+
+# Errors after which the configurator may not match the container any more.
+# Others (e.g. ClientNotFoundError, AddressPoolError) leave both unchanged,
+# so the configurator is kept.
+STALE_CONFIGURATOR_ERRORS = (ConfigChangedError, ExecRunError, ServerConfigError,
+                             ClientsTableError, DockerException)
+
+
+logger = logging.getLogger("controller")
+
+
+class ConfiguratorRegistry:
+    # Keeps one warm configurator per container for the whole process.
+    # A configurator is reused as long as the container fingerprint
+    # (container id, start time and server config hash) stays the same.
+    # Operations on a container are serialized between the threads of this
+    # process and, with a lock file in the data directory, between
+    # all the API processes.
+    # The default registry manages the local Docker host. The hosts of
+    # a fleet (see fleet.py) have a registry each, with their name, Docker
+    # endpoint and public IP.
+
+    def __init__(self, host_name: str | None = None, docker_url: str | None = None,
+                 public_ip: str | None = None):
+        self.host_name = host_name
+        self.docker_url = docker_url
+        self.public_ip = public_ip
+        self.docker_client: docker.DockerClient | None = None
+        self._configurators: dict[ContainerName, Configurator] = {}
+        self._fingerprints: dict[ContainerName, tuple[str, str, str]] = {}
+        self._container_locks: dict[ContainerName, threading.Lock] = {}
+        self._file_locks: dict[ContainerName, FileLock] = {}
+        self._lock = threading.Lock()
+
+
+    @contextmanager
+    def use_configurator(self, container_name: ContainerName) -> Iterator[Configurator]:
+        # Mutations of one container are serialized, and the fingerprint is
+        # taken again afterwards, so that our own changes (new peers, xray
+        # restarts) do not invalidate the cached configurator.
+        # The config hash of the fingerprint is the config version: the first
+        # write of the operation fails with ConfigChangedError if the config
+        # has been changed after the fingerprint was taken.
+        with self._get_container_lock(container_name):
+            file_lock = self._get_file_lock(container_name)
+            file_lock.acquire(timeout=settings.lock_timeout)
+            try:
+                configurator = self._get_warm_configurator(container_name)
+                configurator.controller.expected_config_hash = \
+                        self._fingerprints[container_name][2]
+                configurator.controller.written_config_hash = None
+                try:
+                    yield configurator
+                except STALE_CONFIGURATOR_ERRORS:
+                    self._drop(container_name)
+                    raise
+
+                configurator.update_metrics()
+                try:
+                    self._fingerprints[container_name] = self._take_fingerprint(
+                            configurator, use_written_hash=True)
+                except (NotFound, ExecRunError):
+                    self._drop(container_name)
+            finally:
+                file_lock.release()
+
+
+    def run(self, container_name: ContainerName,
+            operation: Callable[[Configurator], T]) -> T:
+        # Runs the operation with the container's configurator. If the server
+        # config was changed by someone else meanwhile, the configurator is
+        # initialized from the new config and the operation is run again.
+        attempt = 1
+        while True:
+            try:
+                with self.use_configurator(container_name) as configurator:
+                    return operation(configurator)
+            except ConfigChangedError as e:
+                if attempt > settings.config_change_retries:
+                    raise
+                logger.warning(f"{str(e).strip()} Retrying, attempt {attempt}.")
+                attempt += 1
+
+
+    def _get_warm_configurator(self, container_name: ContainerName) -> Configurator:
+        configurator = self._configurators.get(container_name)
+        if configurator is not None:
+            try:
+                fingerprint = self._take_fingerprint(configurator)
+            except (NotFound, ExecRunError):
+                fingerprint = None
+
+            if fingerprint is not None and \
+                    fingerprint == self._fingerprints.get(container_name):
+                logger.debug(f"Using cached configurator for '{container_name.value}'.")
+                return configurator
+
+            logger.debug(_(f"""Container '{container_name.value}' has changed
+                           since the last request, re-initializing configurator."""))
+
+        server = ServerController(container_name, self._get_docker_client(),
+                                  host_name=self.host_name)
+        configurator = server.configurator
+        configurator.public_ip = self.public_ip
+        self._configurators[container_name] = configurator
+        self._fingerprints[container_name] = self._take_fingerprint(configurator)
+        return configurator
+
+
+    def _take_fingerprint(self, configurator: Configurator,
+                          use_written_hash: bool = False) -> tuple[str, str, str]:
+        # With use_written_hash, the config hash of the files the operation
+        # has just written is not read from the container again.
+        controller = configurator.controller
+        controller.container.reload()
+        config_hash = controller.written_config_hash if use_written_hash else None
+        return (
+                controller.container.id,
+                controller.container.attrs["State"]["StartedAt"],
+                config_hash or controller.get_server_config_hash()
+                )
+
+
+    def _drop(self, container_name: ContainerName) -> None:
+        self._configurators.pop(container_name, None)
+        self._fingerprints.pop(container_name, None)
+
+
+    def _get_docker_client(self) -> docker.DockerClient:
+        with self._lock:
+            if self.docker_client is None and self.docker_url is not None:
+                self.docker_client = docker.DockerClient(
+                        base_url=self.docker_url,
+                        max_pool_size=max(settings.worker_threads, 10))
+            elif self.docker_client is None:
+                self.docker_client = docker.from_env(
+                        max_pool_size=max(settings.worker_threads, 10))
+            return self.docker_client
+
+
+    def _get_container_lock(self, container_name: ContainerName) -> threading.Lock:
+        with self._lock:
+            return self._container_locks.setdefault(container_name, threading.Lock())
+
+
+    def _get_file_lock(self, container_name: ContainerName) -> FileLock:
+        with self._lock:
+            file_lock = self._file_locks.get(container_name)
+            if file_lock is None:
+                lock_dir = os.path.join(settings.data_dir, "locks", *(
+                    [self.host_name] if self.host_name else []))
+                file_lock = FileLock(os.path.join(lock_dir, f"{container_name.value}.lock"))
+                self._file_locks[container_name] = file_lock
+            return file_lock
+
+
+configurator_registry = ConfiguratorRegistry()
@@ -0,0 +1,85 @@
+import re
+
+from amnezia_api.metrics import measure
+from amnezia_api.utils import UserConfigError
+
+
+class RenderPlan:
+    # A config template compiled once: the template is split into literal
+    # parts and placeholder slots, so rendering is a single join instead of
+    # a find and a replace over the whole template for every variable.
+    # The template is stripped, like the rendered configs always were.
+
+    def __init__(self, template: str, placeholders: tuple[str, ...] | frozenset[str]):
+        self.template = template.strip()
+        self.placeholders = frozenset(placeholders)
+
+        if not self.placeholders:
+            raise UserConfigError("Render plan needs at least one placeholder.")
+
+        # Longer names go first, so e.g. '$SERVER_IP_ADDRESS'
+        # is never matched as '$SERVER_IP' followed by '_ADDRESS'.
+        pattern = "|".join(re.escape(placeholder) for placeholder in
+                           sorted(self.placeholders, key=len, reverse=True))
+        # With a capturing group, odd items are the matched placeholders.
+        self._parts: list[str] = re.split(f"({pattern})", self.template)
+        self._slots: list[tuple[int, str]] = [
+                (index, self._parts[index]) for index in range(1, len(self._parts), 2)]
+
+        missing = self.placeholders - {placeholder for index, placeholder in self._slots}
+        if missing:
+            raise UserConfigError(
+                    f"The variables {sorted(missing)} are not present in the config template.")
+
+
+    def render(self, values: dict[str, str]) -> str:
+        return self.render_many({}, [values])[0]
+
+
+    def render_many(self, common_values: dict[str, str],
+                    values_list: list[dict[str, str]]) -> list[str]:
+        # common_values are the same for all configs (server keys, address
+        # etc.) and are filled in once, values_list has the per-client values.
+        with measure("render"):
+            return self._render_many(common_values, values_list)
+
+
+    def _render_many(self, common_values: dict[str, str],
+                     values_list: list[dict[str, str]]) -> list[str]:
+        if not common_values.keys() <= self.placeholders:
+            self._raise_for_variables(common_values.keys())
+
+        parts = list(self._parts)
+        client_slots = []
+        for index, placeholder in self._slots:
+            if placeholder in common_values:
+                parts[index] = self._check_value(placeholder, common_values[placeholder])
+            else:
+                client_slots.append((index, placeholder))
+
+        client_placeholders = {placeholder for index, placeholder in client_slots}
+        out = []
+        for values in values_list:
+            if values.keys() != client_placeholders:
+                self._raise_for_variables(common_values.keys() | values.keys())
+
+            for index, placeholder in client_slots:
+                parts[index] = self._check_value(placeholder, values[placeholder])
+            out.append("".join(parts))
+
+        return out
+
+
+    def _check_value(self, placeholder: str, value: str | None) -> str:
+        if value is None:
+            raise UserConfigError(f"Value of variable {placeholder} is None.")
+        return value
+
+
+    def _raise_for_variables(self, variables: set[str]) -> None:
+        unknown = variables - self.placeholders
+        if unknown:
+            raise UserConfigError(
+                    f"The variables {sorted(unknown)} are not present in the config template.")
+        raise UserConfigError(
+                f"No values given for variables {sorted(self.placeholders - variables)}.")
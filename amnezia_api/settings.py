@@ -1,6 +1,6 @@
 import os
 
-from amnezia_api.utils import AppSettingsError
+from amnezia_api.utils import AppSettingsError, remove_line_breaks as _
 
 class Settings:
     def __init__(self):
@@ -8,6 +8,96 @@ class Settings:
         self.logging_mode = self._load_env_var("LOGGING_MODE")
         self.dns = ("1.1.1.1", "1.0.0.1")
 
+        # If SERVER_PUBLIC_IP is set, it is used as is and never looked up.
+        self.server_public_ip = self._load_optional_env_var("SERVER_PUBLIC_IP")
+        self.public_ip_refresh_interval = int(
+                self._load_optional_env_var("PUBLIC_IP_REFRESH_INTERVAL", "3600"))
+        self.public_ip_lookup_timeout = float(
+                self._load_optional_env_var("PUBLIC_IP_LOOKUP_TIMEOUT", "5"))
+
+        self.max_batch_size = int(self._load_optional_env_var("MAX_BATCH_SIZE", "1000"))
+        # Seconds to wait for more concurrent create-config requests
+        # before committing them to a container as one batch.
+        self.commit_window = float(self._load_optional_env_var("COMMIT_WINDOW", "0"))
+
+        # 'incremental' adds new peers with 'wg set', 'syncconf' rebuilds the
+        # whole interface from the config file on every change.
+        self.wg_apply_mode = self._load_optional_env_var("WG_APPLY_MODE", "incremental")
+        if self.wg_apply_mode not in ("incremental", "syncconf"):
+            raise AppSettingsError(_(f"""Got an unknown WG_APPLY_MODE: '{self.wg_apply_mode}'.
+                                     Expected either 'incremental' or 'syncconf'."""))
+        self.wg_full_sync_every = int(self._load_optional_env_var("WG_FULL_SYNC_EVERY", "100"))
+        # WireGuard/AmneziaWG clients can be spread over up to wg_max_shards
+        # interfaces of the container (wg0, wg1, ...), each with its own port
+        # and subnet. Shards are created when the others are full, or have
+        # wg_shard_max_peers peers (0: as many as the subnet holds).
+        self.wg_max_shards = int(self._load_optional_env_var("WG_MAX_SHARDS", "1"))
+        if self.wg_max_shards < 1:
+            raise AppSettingsError(f"WG_MAX_SHARDS must be at least 1, got {self.wg_max_shards}.")
+        self.wg_shard_max_peers = int(self._load_optional_env_var("WG_SHARD_MAX_PEERS", "0"))
+
+        # Local state of the API, e.g. the clients registry.
+        self.data_dir = self._load_optional_env_var("DATA_DIR", "data")
+        # The container's clientsTable is rewritten when this many new
+        # clients are pending, or when the container has been idle for
+        # clients_table_export_interval seconds.
+        self.clients_table_export_batch = int(
+                self._load_optional_env_var("CLIENTS_TABLE_EXPORT_BATCH", "100"))
+        self.clients_table_export_interval = float(
+                self._load_optional_env_var("CLIENTS_TABLE_EXPORT_INTERVAL", "5"))
+
+        # Number of spare WireGuard/AmneziaWG peers to keep ready for new
+        # clients (0 disables the warm pool), and how many to add at once.
+        self.warm_pool_size = int(self._load_optional_env_var("WARM_POOL_SIZE", "0"))
+        self.warm_pool_batch = int(self._load_optional_env_var("WARM_POOL_BATCH", "20"))
+
+        # Number of request threads (read by gunicorn.conf.py as well).
+        # The Docker client keeps as many connections, so that requests
+        # for different containers do not wait for a free connection.
+        self.worker_threads = int(self._load_optional_env_var("WORKER_THREADS", "8"))
+
+        # How long a request waits for another request (possibly in another
+        # worker process) to finish changing the same container, and how many
+        # times an operation is retried if the server config was changed
+        # by someone else (e.g. the AmneziaVPN app) in the meantime.
+        self.lock_timeout = float(self._load_optional_env_var("LOCK_TIMEOUT", "60"))
+        self.config_change_retries = int(
+                self._load_optional_env_var("CONFIG_CHANGE_RETRIES", "3"))
+        # How long a create-config request waits for its batch to be committed.
+        self.commit_timeout = float(self._load_optional_env_var("COMMIT_TIMEOUT", "300"))
+
+        # Results of create-config requests with an Idempotency-Key header
+        # are remembered for idempotency_ttl seconds. With
+        # IDEMPOTENCY_BY_CLIENT_NAME the client name is used as the key
+        # for requests without the header.
+        self.idempotency_ttl = float(self._load_optional_env_var("IDEMPOTENCY_TTL", "600"))
+        self.idempotency_cache_size = int(
+                self._load_optional_env_var("IDEMPOTENCY_CACHE_SIZE", "10000"))
+        self.idempotency_by_client_name = self._load_optional_env_var(
+                "IDEMPOTENCY_BY_CLIENT_NAME", "false").lower() == "true"
+
+        # Async create-config jobs: finished jobs are kept for job_ttl
+        # seconds, at most max_jobs jobs are kept at all.
+        self.job_ttl = float(self._load_optional_env_var("JOB_TTL", "3600"))
+        self.max_jobs = int(self._load_optional_env_var("MAX_JOBS", "10000"))
+        self.job_callback_timeout = float(
+                self._load_optional_env_var("JOB_CALLBACK_TIMEOUT", "10"))
+
+        # JSON file with the Docker hosts of the fleet (see fleet.py), and
+        # how often the load of each host is read for client placement.
+        self.fleet_config = self._load_optional_env_var("FLEET_CONFIG")
+        self.fleet_load_ttl = float(self._load_optional_env_var("FLEET_LOAD_TTL", "30"))
+
+        # Add a Server-Timing header with the durations of the request stages.
+        self.server_timing = self._load_optional_env_var(
+                "SERVER_TIMING", "false").lower() == "true"
+        # Allow to profile requests through the /profile endpoint.
+        self.profiling_enabled = self._load_optional_env_var(
+                "PROFILING_ENABLED", "false").lower() == "true"
+
+        self.xray_use_api = self._load_optional_env_var(
+                "XRAY_USE_API", "true").lower() == "true"
+
 
     def _read_text_file(self, filepath: str) -> str:
         with open(filepath, "r") as file:
@@ -23,6 +113,15 @@ class Settings:
         return result
 
 
+    def _load_optional_env_var(self, env_var: str,
+                               default: str | None = None) -> str | None:
+        result = os.environ.get(env_var)
+        if result is None or result == "":
+            return default
+
+        return result
+
+
     def get_logging_config(self) -> dict[str, str]:
 
         match self.logging_mode:
@@ -3,10 +3,19 @@ from enum import Enum
 import re
 import codecs
 import base64
+import logging
+import threading
+import time
+from typing import Callable
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
 import urllib.request
+import urllib.error
 
+from amnezia_api.metrics import measure
+
+
+logger = logging.getLogger("amnezia_api")
 
 def generate_wg_key_pair() -> tuple[str, str]:
 
@@ -47,24 +56,100 @@ def convert_string_to_base64_vpn_link(string: str) -> str:
     return "vpn://" + base64_bytes.decode("ascii")
 
 
-def get_server_public_ip() -> str:
+def get_server_public_ip(checkers: list[str] | None = None,
+                         timeout: float = 5) -> str:
     # The way we find out public IP is like in the Outline installer script
     # (function set_hostname()).
     # https://raw.githubusercontent.com/Jigsaw-Code/outline-server/master/src/server_manager/install_scripts/install_server.sh
 
-    checkers = [
-            "https://icanhazip.com",
-            "https://ipinfo.io/ip"
-            ]
+    if checkers is None:
+        checkers = [
+                "https://icanhazip.com",
+                "https://ipinfo.io/ip"
+                ]
 
     for url in checkers:
-        ip_string = urllib.request.urlopen(url).read().decode().strip("\n")
+        try:
+            with urllib.request.urlopen(url, timeout=timeout) as response:
+                ip_string = response.read().decode().strip("\n")
+        except (urllib.error.URLError, OSError) as e:
+            logger.warning(f"Could not get public ip from '{url}'. Details: {e}")
+            continue
+
         if _validate_ip_address(ip_string):
             return ip_string
 
     raise HostnameError("Could not define what server public ip shoud be")
 
 
+class PublicIpResolver:
+    # Resolves the server public IP once and then keeps it cached.
+    # The cached value is refreshed by a background thread every
+    # refresh_interval seconds. If override is given, no lookups are made at all.
+    # The resolve function can be replaced, e.g. with a lookup against
+    # a local HTTP endpoint in tests.
+
+    def __init__(self, override: str | None = None, refresh_interval: float = 3600,
+                 resolve: Callable[[], str] = get_server_public_ip):
+        if override is not None and not _validate_ip_address(override):
+            raise AppSettingsError(f"Got an invalid server public ip: '{override}'.")
+
+        self.override = override
+        self.refresh_interval = refresh_interval
+        self.resolve = resolve
+        self._ip = override
+        self._lock = threading.Lock()
+        self._refresh_thread: threading.Thread | None = None
+
+
+    def get(self) -> str:
+        with self._lock:
+            ip = self._ip
+
+        if ip is None:
+            ip = self.refresh()
+        return ip
+
+
+    def refresh(self) -> str:
+        if self.override is not None:
+            return self.override
+
+        with measure("public_ip"):
+            ip = self.resolve()
+        with self._lock:
+            self._ip = ip
+        return ip
+
+
+    def start(self) -> None:
+        if self.override is not None or self._refresh_thread is not None:
+            return
+
+        try:
+            self.refresh()
+        except HostnameError as e:
+            # Not fatal: the next get() will try again.
+            logger.error(e)
+
+        if self.refresh_interval <= 0:
+            return
+
+        self._refresh_thread = threading.Thread(
+                target=self._refresh_loop, name="public-ip-refresh", daemon=True)
+        self._refresh_thread.start()
+
+
+    def _refresh_loop(self) -> None:
+        while True:
+            time.sleep(self.refresh_interval)
+            try:
+                self.refresh()
+            except HostnameError as e:
+                # Keep serving the last known ip.
+                logger.error(e)
+
+
 def remove_line_breaks(string: str) -> str:
     out = ""
     for s in string.split():
@@ -78,6 +163,14 @@ class ContainerName(str, Enum):
     AMNEZIA_WG  = "amnezia-awg"
 
 
+# Protocol names in the API URLs.
+PROTOCOLS = {
+        "xray": ContainerName.XRAY,
+        "wireguard": ContainerName.WIREGUARD,
+        "amnezia-wg": ContainerName.AMNEZIA_WG
+        }
+
+
 class UserConfigError(Exception):
     pass
 
@@ -110,6 +203,27 @@ class ClientsTableError(Exception):
 class AddressPoolError(Exception):
     pass
 
+
+class ClientNotFoundError(Exception):
+    pass
+
+
+class ConfigChangedError(Exception):
+    # The server config was changed by someone else since it was read.
+    pass
+
+
+class LockTimeoutError(Exception):
+    pass
+
+
+class JobLimitError(Exception):
+    pass
+
+
+class FleetCapacityError(Exception):
+    pass
+
 class ServerControllerInitializationError(Exception):
     pass
 
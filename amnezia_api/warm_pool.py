@@ -0,0 +1,81 @@
+from __future__ import annotations
+import os
+import sqlite3
+import threading
+
+from amnezia_api.settings import settings
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS warm_peers (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    container TEXT NOT NULL,
+    public_key TEXT NOT NULL,
+    private_key TEXT NOT NULL,
+    client_ip TEXT NOT NULL,
+    UNIQUE (container, public_key)
+);
+"""
+
+
+class WarmPool:
+    # Spare WireGuard peers which are already in the server config and on the
+    # running interface, but not given to any client yet. The private keys
+    # are needed to render client configs, so they are stored here
+    # (in a file readable only by the owner) until a peer is claimed.
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._connection: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+
+
+    def add(self, container: str, peers: list[tuple[str, str, str]]) -> None:
+        # peers are (private_key, public_key, client_ip)
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.executemany(
+                        """INSERT OR REPLACE INTO warm_peers
+                        (container, private_key, public_key, client_ip)
+                        VALUES (?, ?, ?, ?)""",
+                        [(container, *peer) for peer in peers])
+
+
+    def claim(self, container: str, count: int) -> list[tuple[str, str, str]]:
+        # Takes up to count peers out of the pool, oldest first.
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                rows = connection.execute(
+                        """SELECT seq, private_key, public_key, client_ip FROM warm_peers
+                        WHERE container = ? ORDER BY seq LIMIT ?""",
+                        (container, count)).fetchall()
+                connection.executemany("DELETE FROM warm_peers WHERE seq = ?",
+                                       [(row[0],) for row in rows])
+
+        return [(private_key, public_key, client_ip)
+                for seq, private_key, public_key, client_ip in rows]
+
+
+    def count(self, container: str) -> int:
+        with self._lock:
+            (count,) = self._connect().execute(
+                "SELECT COUNT(*) FROM warm_peers WHERE container = ?",
+                (container,)).fetchone()
+        return count
+
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            directory = os.path.dirname(self.db_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # Create the file beforehand, so it is never readable by others.
+            os.close(os.open(self.db_path, os.O_CREAT | os.O_WRONLY, 0o600))
+            self._connection = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._connection.executescript(SCHEMA)
+        return self._connection
+
+
+warm_pool = WarmPool(os.path.join(settings.data_dir, "warm_pool.sqlite3"))
@@ -0,0 +1,119 @@
+from amnezia_api.utils import ServerConfigError
+
+
+class WgPeer:
+    def __init__(self, lines: list[str]):
+        # lines are the stripped non-empty lines of the section,
+        # starting with the '[Peer]' header.
+        self.lines = lines
+        self.values = _parse_values(lines)
+
+        public_keys = self.values.get("PublicKey")
+        if not public_keys:
+            raise ServerConfigError(f"Peer without PublicKey in server config: {lines}")
+        self.public_key = public_keys[0]
+
+        allowed_ips = self.values.get("AllowedIPs")
+        # Only the first address is the client address, in case
+        # other AllowedIPs are configured for the peer.
+        self.ip = allowed_ips[0].split(",")[0].strip().split("/")[0] \
+                if allowed_ips else None
+
+
+    def serialize(self) -> str:
+        return "\n".join(self.lines)
+
+
+class WgServerConfig:
+    # Parsed wg0.conf: the interface section plus the peers, indexed by
+    # public key. Serialization is deterministic: sections are separated
+    # by one empty line, other empty lines are dropped. Lines before the
+    # first section (e.g. comments) are kept verbatim.
+
+    def __init__(self, text: str):
+        self.preamble, text = _split_preamble(text)
+        self.interface_lines: list[str] = []
+        self.interface: dict[str, list[str]] = {}
+        self.peers: dict[str, WgPeer] = {}
+        self._serialized: str | None = None
+
+        sections = _split_sections(text)
+        if sections and not sections[0][0].startswith("[Peer]"):
+            self.interface_lines = sections.pop(0)
+            self.interface = _parse_values(self.interface_lines)
+
+        for lines in sections:
+            peer = WgPeer(lines)
+            self.peers[peer.public_key] = peer
+
+
+    def get_interface_values(self, key: str) -> list[str]:
+        return self.interface.get(key, [])
+
+
+    def add_peer_section(self, text: str) -> WgPeer:
+        sections = _split_sections(text)
+        if len(sections) != 1 or not sections[0][0].startswith("[Peer]"):
+            raise ServerConfigError(f"Expected exactly one peer section, got: '{text}'")
+
+        peer = WgPeer(sections[0])
+        if peer.public_key in self.peers:
+            raise ServerConfigError(f"Peer '{peer.public_key}' is already in server config.")
+
+        self.peers[peer.public_key] = peer
+        self._serialized = None
+        return peer
+
+
+    def remove_peer(self, public_key: str) -> WgPeer | None:
+        peer = self.peers.pop(public_key, None)
+        if peer is not None:
+            self._serialized = None
+        return peer
+
+
+    def serialize(self) -> str:
+        if self._serialized is None:
+            sections = [peer.serialize() for peer in self.peers.values()]
+            if self.interface_lines:
+                sections.insert(0, "\n".join(self.interface_lines))
+            self._serialized = self.preamble + "\n\n".join(sections)
+        return self._serialized
+
+
+    def serialize_peers(self, peers: list[WgPeer]) -> str:
+        return "\n\n".join(peer.serialize() for peer in peers)
+
+
+def _split_preamble(text: str) -> tuple[str, str]:
+    # Splits the text before the first section header off.
+    offset = 0
+    for line in text.splitlines(keepends=True):
+        if line.strip().startswith("["):
+            break
+        offset += len(line)
+    return text[:offset], text[offset:]
+
+
+def _split_sections(text: str) -> list[list[str]]:
+    sections: list[list[str]] = []
+    for line in text.splitlines():
+        line = line.strip()
+        if line == "":
+            continue
+
+        if line.startswith("[") or not sections:
+            sections.append([])
+        sections[-1].append(line)
+    return sections
+
+
+def _parse_values(lines: list[str]) -> dict[str, list[str]]:
+    values: dict[str, list[str]] = {}
+    for line in lines:
+        if line.startswith("#") or "=" not in line:
+            continue
+
+        key, value = line.split("=", 1)
+        values.setdefault(key.strip(), []).append(value.strip())
+    return values
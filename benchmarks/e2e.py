@@ -0,0 +1,240 @@
+# End-to-end benchmark of create-config against the fake Docker client.
+#
+# Every scenario (protocol x number of seeded peers) runs in a fresh
+# process, with its own DATA_DIR, through the same path as the API:
+# the commit queue, the configurator registry and the configurators.
+# With --hosts, the requests go through fleet placement to that many
+# fake Docker hosts, each seeded with the same number of peers.
+# Reports throughput and p50/p99 latency, and optionally fails if the
+# results are worse than a saved baseline.
+#
+# Run from the repository root:
+#   python -m benchmarks.e2e
+#   python -m benchmarks.e2e --output results.json
+#   python -m benchmarks.e2e --baseline results.json --max-regression 0.2
+
+from __future__ import annotations
+import argparse
+import json
+import multiprocessing
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+
+# protocol: (container name, working dir)
+PROTOCOLS = {
+        "xray": ("amnezia-xray", "/opt/amnezia/xray"),
+        "wireguard": ("amnezia-wireguard", "/opt/amnezia/wireguard"),
+        "amnezia-wg": ("amnezia-awg", "/opt/amnezia/awg"),
+        }
+
+DEFAULT_SEEDS = (0, 250, 5000, 50000)
+
+
+def run_scenario(protocol: str, seed: int, requests: int, concurrency: int,
+                 latency_ms: dict[str, float], hosts: int = 1) -> dict:
+    # Runs in a child process: the settings are read from the environment
+    # when amnezia_api is imported, so it is imported here. The API logs
+    # to log.txt in the working directory, which is the data dir here.
+    data_dir = tempfile.mkdtemp(prefix="amnezia-api-bench-")
+    os.environ.setdefault("SECRET_URL_STRING", "benchmark")
+    os.environ.setdefault("LOGGING_MODE", "PROD")
+    os.environ.setdefault("SERVER_PUBLIC_IP", "203.0.113.1")
+    os.environ["DATA_DIR"] = data_dir
+    os.chdir(data_dir)
+    if hosts > 1:
+        # The Docker endpoints are never connected to, the registries
+        # get the fake clients below.
+        with open("fleet.json", "w") as file:
+            json.dump({"hosts": [{"name": f"host-{index}",
+                                  "docker_url": f"tcp://fake-{index}:2375",
+                                  "public_ip": f"203.0.113.{index}",
+                                  "protocols": [protocol]}
+                                 for index in range(1, hosts + 1)]}, file)
+        os.environ["FLEET_CONFIG"] = os.path.join(data_dir, "fleet.json")
+
+    from amnezia_api.commit_queue import get_commit_queue
+    from amnezia_api.fleet import fleet
+    from amnezia_api.registry import configurator_registry
+    from amnezia_api.utils import ContainerName
+    from benchmarks.fake_docker import (
+            FakeContainer, FakeDockerClient, Latency, seed_wg_files, seed_xray_files
+            )
+
+    container_name, working_dir = PROTOCOLS[protocol]
+    latency = Latency(**latency_ms)
+
+    def make_container() -> FakeContainer:
+        if protocol == "xray":
+            files = seed_xray_files(working_dir, seed)
+        else:
+            files = seed_wg_files(working_dir, seed, awg=protocol == "amnezia-wg")
+        return FakeContainer(container_name, files, latency)
+
+    containers = []
+    if fleet is None:
+        containers.append(make_container())
+        configurator_registry.docker_client = FakeDockerClient(containers, latency)
+        submit = get_commit_queue(ContainerName(container_name)).submit
+    else:
+        for host in fleet.hosts.values():
+            containers.append(make_container())
+            host.registry.docker_client = FakeDockerClient(containers[-1:], latency)
+        submit = lambda client_names: fleet.create_configs(
+                ContainerName(container_name), client_names)[1]
+
+    # The first request also reads the container and initializes
+    # the configurator, it is reported separately.
+    start = time.perf_counter()
+    submit(["bench-init"])
+    init_seconds = time.perf_counter() - start
+
+    latencies: list[float] = []
+    errors: list[str] = []
+    lock = threading.Lock()
+
+    def make_requests(first: int) -> None:
+        for index in range(first, requests, concurrency):
+            request_start = time.perf_counter()
+            try:
+                submit([f"bench-{index}"])
+            except Exception as e:
+                with lock:
+                    errors.append(str(e))
+                continue
+            with lock:
+                latencies.append(time.perf_counter() - request_start)
+
+    threads = [threading.Thread(target=make_requests, args=(first,))
+               for first in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    percentiles = statistics.quantiles(latencies, n=100, method="inclusive") \
+            if len(latencies) > 1 else [latencies[0] if latencies else 0] * 99
+    return {
+        "protocol": protocol,
+        "seed": seed,
+        "hosts": hosts,
+        "requests": requests,
+        "concurrency": concurrency,
+        "errors": len(errors),
+        "init_ms": init_seconds * 1000,
+        "throughput": len(latencies) / elapsed if elapsed > 0 else 0,
+        "p50_ms": percentiles[49] * 1000,
+        "p99_ms": percentiles[98] * 1000,
+        "docker_execs": sum(container.exec_count for container in containers),
+        "restarts": sum(container.restart_count for container in containers),
+        }
+
+
+def compare_with_baseline(results: list[dict], baseline: list[dict],
+                          max_regression: float) -> list[str]:
+    # Returns the regressions: throughput lower, or latency higher,
+    # than the baseline by more than max_regression (a fraction).
+    def key(result: dict) -> tuple[str, int, int]:
+        return result["protocol"], result["seed"], result.get("hosts", 1)
+
+    baseline_by_key = {key(result): result for result in baseline}
+    regressions = []
+    for result in results:
+        base = baseline_by_key.get(key(result))
+        if base is None:
+            continue
+
+        name = f"{result['protocol']}/{result['seed']}/{result['hosts']}"
+        if result["throughput"] < base["throughput"] * (1 - max_regression):
+            regressions.append(f"{name}: throughput {result['throughput']:.1f} req/s, "
+                               f"baseline {base['throughput']:.1f} req/s")
+        for metric in ("p50_ms", "p99_ms"):
+            if result[metric] > base[metric] * (1 + max_regression):
+                regressions.append(f"{name}: {metric} {result[metric]:.1f}, "
+                                   f"baseline {base[metric]:.1f}")
+    return regressions
+
+
+def print_results(results: list[dict]) -> None:
+    header = f"{'protocol':<12}{'seed':>8}{'hosts':>7}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}" \
+             f"{'init ms':>10}{'execs':>8}{'restarts':>10}{'errors':>8}"
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        print(f"{result['protocol']:<12}{result['seed']:>8}{result['hosts']:>7}"
+              f"{result['throughput']:>10.1f}"
+              f"{result['p50_ms']:>10.1f}{result['p99_ms']:>10.1f}{result['init_ms']:>10.1f}"
+              f"{result['docker_execs']:>8}{result['restarts']:>10}{result['errors']:>8}")
+
+
+def parse_args(argv: list[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+            description="End-to-end create-config benchmark against a fake Docker client.")
+    parser.add_argument("--protocols", default=",".join(PROTOCOLS),
+                        help="Comma-separated protocols. Default: all.")
+    parser.add_argument("--seeds", default=",".join(str(seed) for seed in DEFAULT_SEEDS),
+                        help="Comma-separated numbers of existing peers. Default: %(default)s.")
+    parser.add_argument("--requests", type=int, default=200,
+                        help="create-config requests per scenario. Default: %(default)s.")
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="Concurrent requests. Default: %(default)s.")
+    parser.add_argument("--hosts", type=int, default=1,
+                        help="Number of fake Docker hosts. With more than one, requests "
+                             "go through fleet placement. Default: %(default)s.")
+    parser.add_argument("--list-latency-ms", type=float, default=2)
+    parser.add_argument("--exec-latency-ms", type=float, default=5)
+    parser.add_argument("--archive-latency-ms", type=float, default=5)
+    parser.add_argument("--restart-latency-ms", type=float, default=1000)
+    parser.add_argument("--output", help="Write the results as JSON to this file.")
+    parser.add_argument("--baseline", help="Compare with results saved by --output.")
+    parser.add_argument("--max-regression", type=float, default=0.2,
+                        help="Allowed regression against the baseline, as a fraction. "
+                             "Default: %(default)s.")
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str]) -> int:
+    args = parse_args(argv)
+    latency_ms = {
+        "list_ms": args.list_latency_ms,
+        "exec_ms": args.exec_latency_ms,
+        "archive_ms": args.archive_latency_ms,
+        "restart_ms": args.restart_latency_ms,
+        }
+
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for protocol in args.protocols.split(","):
+        if protocol not in PROTOCOLS:
+            print(f"Unknown protocol '{protocol}'.", file=sys.stderr)
+            return 2
+        for seed in (int(seed) for seed in args.seeds.split(",")):
+            with context.Pool(1) as pool:
+                results.append(pool.apply(run_scenario, (
+                    protocol, seed, args.requests, args.concurrency, latency_ms, args.hosts)))
+
+    print_results(results)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=4)
+
+    if args.baseline:
+        with open(args.baseline, "r") as file:
+            regressions = compare_with_baseline(results, json.load(file), args.max_regression)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
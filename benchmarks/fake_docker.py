@@ -0,0 +1,265 @@
+from __future__ import annotations
+import base64
+import hashlib
+import io
+import ipaddress
+import json
+import math
+import os
+import re
+import shlex
+import tarfile
+import threading
+import time
+import uuid
+
+import docker.errors
+
+
+# In-process stand-in for the parts of the docker SDK the API uses:
+# containers.list/get, exec_run, restart, reload, get_archive and
+# put_archive. Files live in a dict, and the shell commands the API runs
+# in the containers are emulated. Every call sleeps for the configured
+# latency, so the numbers include a realistic Docker round trip.
+
+
+class Latency:
+    def __init__(self, list_ms: float = 2, exec_ms: float = 5,
+                 archive_ms: float = 5, restart_ms: float = 1000):
+        self.list = list_ms / 1000
+        self.exec = exec_ms / 1000
+        self.archive = archive_ms / 1000
+        self.restart = restart_ms / 1000
+
+
+class FakeExecError(Exception):
+    pass
+
+
+class FakeContainer:
+    def __init__(self, name: str, files: dict[str, str], latency: Latency):
+        self.name = name
+        self.id = uuid.uuid4().hex
+        self.files = dict(files)
+        self.latency = latency
+        self.attrs = {"State": {"StartedAt": _now()}}
+        self.exec_count = 0
+        self.restart_count = 0
+        # Interfaces brought up by the API, besides wg0.
+        self.interfaces_up: set[str] = set()
+        self._lock = threading.Lock()
+
+
+    def reload(self) -> None:
+        time.sleep(self.latency.exec)
+
+
+    def restart(self) -> None:
+        time.sleep(self.latency.restart)
+        with self._lock:
+            self.restart_count += 1
+            self.attrs["State"]["StartedAt"] = _now()
+
+
+    def exec_run(self, cmd: str, **kwargs) -> tuple[int, bytes]:
+        time.sleep(self.latency.exec)
+        with self._lock:
+            self.exec_count += 1
+            try:
+                return self._run(shlex.split(cmd))
+            except FakeExecError as e:
+                return 1, str(e).encode()
+
+
+    def get_archive(self, path: str) -> tuple[list[bytes], dict]:
+        time.sleep(self.latency.archive)
+        path = path.rstrip("/")
+        base = os.path.basename(path)
+        buffer = io.BytesIO()
+        with self._lock, tarfile.open(fileobj=buffer, mode="w") as tar:
+            for filepath, content in self.files.items():
+                if filepath == path:
+                    name = base
+                elif filepath.startswith(path + "/"):
+                    name = base + filepath[len(path):]
+                else:
+                    continue
+                data = content.encode()
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+
+        if not any(filepath == path or filepath.startswith(path + "/")
+                   for filepath in self.files):
+            raise docker.errors.NotFound(f"Could not find the file {path} in container {self.name}")
+        return [buffer.getvalue()], {}
+
+
+    def put_archive(self, path: str, data: bytes) -> bool:
+        time.sleep(self.latency.archive)
+        with self._lock, tarfile.open(fileobj=io.BytesIO(data)) as tar:
+            for member in tar.getmembers():
+                self.files[os.path.join(path, member.name)] = \
+                        tar.extractfile(member).read().decode()
+        return True
+
+
+    def _run(self, argv: list[str]) -> tuple[int, bytes]:
+        if argv[:2] in (["sh", "-c"], ["bash", "-c"]):
+            return self._run_script(argv[2])
+
+        if argv[0] in ("wg", "awg") and argv[1] == "set":
+            return 0, b""
+
+        if argv[:3] == ["xray", "api", "adu"]:
+            users = json.loads(self.files[argv[-1]])["inbounds"][0]["settings"]["clients"]
+            return 0, f"Added {len(users)} user(s) in total.".encode()
+
+        if argv[:3] == ["xray", "api", "rmu"]:
+            return 0, b""
+
+        raise FakeExecError(f"Unknown command: {argv}")
+
+
+    def _run_script(self, script: str) -> tuple[int, bytes]:
+        # Only the scripts the API actually runs are understood.
+        guard = re.match(r'\[ "\$\(cat (.+?) 2>/dev/null \| sha256sum\)" = "(\w+)  -" \] '
+                         r'\|\| exit (\d+); (.*)$', script, re.S)
+        if guard:
+            paths, expected, exit_code, script = guard.groups()
+            if self._hash(paths.split()) != expected:
+                return int(exit_code), b""
+
+        cleanup = re.match(r"(.+); status=\$\?; rm -f (\S+); exit \$status$", script)
+        if cleanup:
+            try:
+                return self._run(shlex.split(cleanup.group(1)))
+            finally:
+                self.files.pop(cleanup.group(2), None)
+
+        hash_command = re.match(r"cat (.+) 2>/dev/null \| sha256sum$", script)
+        if hash_command:
+            return 0, f"{self._hash(hash_command.group(1).split())}  -".encode()
+
+        if re.match(r"(wg|awg) syncconf ", script):
+            return 0, b""
+
+        interface_up = re.match(r"(wg|awg) show (\w+) >/dev/null 2>&1 \|\| (wg|awg)-quick up (\S+)$", script)
+        if interface_up:
+            if interface_up.group(4) not in self.files:
+                raise FakeExecError(f"Config {interface_up.group(4)} not found.")
+            self.interfaces_up.add(interface_up.group(2))
+            return 0, b""
+
+        for command in script.split(" && "):
+            argv = shlex.split(command)
+            if argv[0] == "mv":
+                self.files[argv[2]] = self.files.pop(argv[1])
+            elif argv[0] == "rm":
+                self.files.pop(argv[1], None)
+            elif argv[0] == "cat" and argv[2] == ">>":
+                self.files[argv[3]] = self.files.get(argv[3], "") + self.files[argv[1]]
+            else:
+                raise FakeExecError(f"Unknown script: {script}")
+        return 0, b""
+
+
+    def _hash(self, paths: list[str]) -> str:
+        data = "".join(self.files.get(path, "") for path in paths).encode()
+        return hashlib.sha256(data).hexdigest()
+
+
+class _FakeContainers:
+    def __init__(self, client: "FakeDockerClient"):
+        self.client = client
+
+
+    def list(self) -> list[FakeContainer]:
+        time.sleep(self.client.latency.list)
+        return list(self.client.containers_by_name.values())
+
+
+    def get(self, name: str) -> FakeContainer:
+        time.sleep(self.client.latency.list)
+        return self.client.containers_by_name[name]
+
+
+class FakeDockerClient:
+    def __init__(self, containers: list[FakeContainer], latency: Latency):
+        self.latency = latency
+        self.containers_by_name = {container.name: container for container in containers}
+        self.containers = _FakeContainers(self)
+
+
+def seed_wg_files(working_dir: str, peers: int, awg: bool = False) -> dict[str, str]:
+    # A server config like the AmneziaVPN app makes, with a subnet big
+    # enough for the seeded peers plus new ones.
+    prefix = min(24, 32 - math.ceil(math.log2(peers * 2 + 256)))
+    network = ipaddress.IPv4Network(f"10.8.0.0/{prefix}")
+    hosts = network.hosts()
+    server_ip = next(hosts)
+
+    lines = ["[Interface]",
+             f"PrivateKey = {_fake_key()}",
+             f"Address = {server_ip}/{prefix}",
+             "ListenPort = 51820"]
+    if awg:
+        lines += ["Jc = 4", "Jmin = 10", "Jmax = 50", "S1 = 83", "S2 = 47",
+                  "H1 = 1184745731", "H2 = 1623512847", "H3 = 916253413", "H4 = 2014523721"]
+
+    clients_table = []
+    for index in range(peers):
+        public_key = _fake_key()
+        lines += ["", "[Peer]", f"PublicKey = {public_key}",
+                  f"PresharedKey = {_fake_key()}", f"AllowedIPs = {next(hosts)}/32"]
+        clients_table.append(_clients_table_entry(public_key, index))
+
+    return {
+        f"{working_dir}/wg0.conf": "\n".join(lines) + "\n",
+        f"{working_dir}/wireguard_server_public_key.key": _fake_key() + "\n",
+        f"{working_dir}/wireguard_psk.key": _fake_key() + "\n",
+        f"{working_dir}/clientsTable": json.dumps(clients_table, indent=4) + "\n",
+        }
+
+
+def seed_xray_files(working_dir: str, clients: int) -> dict[str, str]:
+    # XRay server.json with the API enabled, so new users are added
+    # through 'xray api adu' (set XRAY_USE_API=false to measure restarts).
+    server_config = {
+        "log": {"loglevel": "error"},
+        "api": {"tag": "api", "listen": "127.0.0.1:10085", "services": ["HandlerService"]},
+        "inbounds": [{
+            "tag": "vless-in",
+            "port": 443,
+            "protocol": "vless",
+            "settings": {
+                "clients": [{"id": str(uuid.uuid4()), "flow": "xtls-rprx-vision"}
+                            for index in range(clients)],
+                "decryption": "none"
+                },
+            "streamSettings": {"network": "tcp", "security": "reality"}
+            }],
+        "outbounds": [{"protocol": "freedom"}]
+        }
+    clients_table = [_clients_table_entry(client["id"], index) for index, client
+                     in enumerate(server_config["inbounds"][0]["settings"]["clients"])]
+
+    return {
+        f"{working_dir}/server.json": json.dumps(server_config, indent=4) + "\n",
+        f"{working_dir}/xray_public.key": _fake_key() + "\n",
+        f"{working_dir}/xray_short_id.key": os.urandom(8).hex() + "\n",
+        f"{working_dir}/clientsTable": json.dumps(clients_table, indent=4) + "\n",
+        }
+
+
+def _clients_table_entry(client_id: str, index: int) -> dict:
+    return {"clientId": client_id,
+            "userData": {"clientName": f"seed-{index}", "creationDate": _now()}}
+
+
+def _fake_key() -> str:
+    return base64.b64encode(os.urandom(32)).decode()
+
+
+def _now() -> str:
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime())
@@ -0,0 +1,222 @@
+# Microbenchmarks of the CPU-bound functions on the create-config path,
+# on server configs of realistic size. The configurators are initialized
+# from the fake Docker client without latency, so only the Python code
+# is measured.
+#
+# Run from the repository root:
+#   python -m benchmarks.micro
+#   python -m benchmarks.micro --baseline benchmarks/micro_baseline.json
+#   python -m benchmarks.micro --output benchmarks/micro_baseline.json
+#
+# Timings depend on the machine: update the baseline on the machine that
+# compares against it, and commit it with the change that moved it.
+
+from __future__ import annotations
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import timeit
+from typing import Callable
+
+from benchmarks.e2e import PROTOCOLS
+
+
+DEFAULT_SIZES = (10000, 60000)
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), "micro_baseline.json")
+
+
+def measure_per_call(func: Callable[[], object], repeat: int,
+                     setup: Callable[[], object] | None = None) -> dict[str, float]:
+    # Seconds per call: the best and the median of the repeats.
+    # setup runs untimed before each timing round.
+    timer = timeit.Timer(func, setup=setup or "pass")
+    number, total = timer.autorange()
+    timings = [total / number] + [seconds / number
+                                  for seconds in timer.repeat(repeat - 1, number)]
+    return {"best": min(timings), "median": statistics.median(timings), "number": number}
+
+
+Benchmark = tuple[str, Callable[[], object], Callable[[], object] | None]
+
+
+def collect_benchmarks(sizes: list[int]) -> list[Benchmark]:
+    # Imported here: settings are read from the environment at import.
+    from amnezia_api import utils
+    from amnezia_api.address_pool import AddressPool
+    from amnezia_api.clients_registry import clients_registry
+    from amnezia_api.config_templates import (
+            AMNEZIA_WG_CLIENT_CONFIG_PLAN, WIREGUARD_CLIENT_CONFIG_PLAN,
+            WIREGUARD_SERVER_PEER_PLAN, XRAY_CLIENT_PLAN
+            )
+    from amnezia_api.controllers import ServerController
+    from amnezia_api.utils import ContainerName
+    from benchmarks.fake_docker import (
+            FakeContainer, FakeDockerClient, Latency, seed_wg_files, seed_xray_files
+            )
+
+    latency = Latency(list_ms=0, exec_ms=0, archive_ms=0, restart_ms=0)
+
+    def make_configurator(protocol: str, files: dict[str, str]):
+        container_name, working_dir = PROTOCOLS[protocol]
+        container = FakeContainer(container_name, files, latency)
+        return ServerController(ContainerName(container_name),
+                                FakeDockerClient([container], latency)).configurator
+
+    benchmarks: list[Benchmark] = []
+
+    message = """Error while reading allowed ips from server config:
+                 parsed AllowedIP does not match with server's address.
+                 Parsed ip is '10.8.1.17', while server's subnet is '10.8.0.0/24'."""
+    benchmarks.append(("remove_line_breaks", lambda: utils.remove_line_breaks(message), None))
+    benchmarks.append(("generate_wg_key_pair", utils.generate_wg_key_pair, None))
+
+    wg = make_configurator("wireguard", seed_wg_files(PROTOCOLS["wireguard"][1], 0))
+    for name, plan in (("xray", XRAY_CLIENT_PLAN),
+                       ("wireguard_peer", WIREGUARD_SERVER_PEER_PLAN),
+                       ("wireguard", WIREGUARD_CLIENT_CONFIG_PLAN),
+                       ("amnezia-wg", AMNEZIA_WG_CLIENT_CONFIG_PLAN)):
+        values = {placeholder: "dGhpcyBpcyBhIGZha2Uga2V5IGZvciBiZW5jaG1hcmtzLg=="
+                  for placeholder in plan.placeholders}
+        benchmarks.append((f"replace_variables_in_config[{name}]",
+                           lambda template=plan.template, values=values:
+                           wg._replace_variables_in_config(template, values), None))
+
+    # Every clients_table_export_batch-th call exports the whole clientsTable,
+    # so each round starts from an empty registry and a new container:
+    # otherwise the timing grows with the rows left by the earlier rounds.
+    clients_table = {}
+
+    def reset_clients_table():
+        configurator = make_configurator("wireguard",
+                                         seed_wg_files(PROTOCOLS["wireguard"][1], 0))
+        clients_key = configurator.controller.clients_key
+        entries = clients_registry.export_clients_table(clients_key)[0]
+        clients_registry.remove_clients(clients_key,
+                                        [entry["clientId"] for entry in entries])
+        clients_table["configurator"] = configurator
+
+    benchmarks.append(("add_entry_to_clients_table",
+                       lambda: clients_table["configurator"]._add_entry_to_clients_table(
+                           utils.generate_wg_key_pair()[1], "benchmark"),
+                       reset_clients_table))
+
+    for size in sizes:
+        wg = make_configurator("wireguard", seed_wg_files(PROTOCOLS["wireguard"][1], size))
+        interface_address = wg._get_interface_address_from_server_config(wg.wg_config)
+        benchmarks.append((f"get_existed_client_ips_from_server_config[{size}]",
+                           lambda wg=wg, interface_address=interface_address:
+                           wg._get_existed_client_ips_from_server_config(
+                               wg.wg_config, AddressPool(interface_address)), None))
+
+        # clientsTable is exported from the local registry, and read back
+        # from the container when a configurator is initialized.
+        clients_table_string = wg.controller.container.files[
+                wg.controller.working_dir + "/clientsTable"]
+        benchmarks.append((f"clients_table_round_trip[{size}]",
+                           lambda wg=wg, clients_table_string=clients_table_string:
+                           wg._dump_clients_table(json.loads(clients_table_string)), None))
+
+        xray = make_configurator("xray", seed_xray_files(PROTOCOLS["xray"][1], size))
+        benchmarks.append((f"validate_and_dump_xray_server_config[{size}]",
+                           lambda xray=xray: xray._dump_server_config(
+                               xray._validate_server_config()), None))
+
+    return benchmarks
+
+
+def compare_with_baseline(results: list[dict], baseline: list[dict],
+                          max_regression: float) -> list[str]:
+    # Best times are compared, they are the least noisy.
+    baseline_by_name = {result["name"]: result for result in baseline}
+    regressions = []
+    for result in results:
+        base = baseline_by_name.get(result["name"])
+        if base is not None and result["best"] > base["best"] * (1 + max_regression):
+            regressions.append(f"{result['name']}: {result['best'] * 1e6:.1f} us, "
+                               f"baseline {base['best'] * 1e6:.1f} us")
+    return regressions
+
+
+def print_results(results: list[dict], baseline: list[dict] | None) -> None:
+    baseline_by_name = {result["name"]: result for result in baseline or []}
+    header = f"{'benchmark':<56}{'best us':>14}{'median us':>14}{'vs baseline':>14}"
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        base = baseline_by_name.get(result["name"])
+        change = f"{result['best'] / base['best'] - 1:+.1%}" if base else "-"
+        print(f"{result['name']:<56}{result['best'] * 1e6:>14.1f}"
+              f"{result['median'] * 1e6:>14.1f}{change:>14}")
+
+
+def parse_args(argv: list[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+            description="Microbenchmarks of the CPU-bound create-config functions.")
+    parser.add_argument("--sizes", default=",".join(str(size) for size in DEFAULT_SIZES),
+                        help="Comma-separated numbers of peers in the server configs. "
+                             "Default: %(default)s.")
+    parser.add_argument("--filter", default="",
+                        help="Run only the benchmarks with this substring in the name.")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="Timing repeats per benchmark. Default: %(default)s.")
+    parser.add_argument("--output", help="Write the results as JSON to this file.")
+    parser.add_argument("--baseline", help="Compare with results saved by --output, "
+                                           f"e.g. {os.path.relpath(DEFAULT_BASELINE)}.")
+    parser.add_argument("--max-regression", type=float, default=0.25,
+                        help="Allowed slowdown against the baseline, as a fraction. "
+                             "Default: %(default)s.")
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str]) -> int:
+    args = parse_args(argv)
+    if args.repeat < 1:
+        print("--repeat must be at least 1.", file=sys.stderr)
+        return 2
+    output = os.path.abspath(args.output) if args.output else None
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+
+    # The API logs to log.txt in the working directory.
+    data_dir = tempfile.mkdtemp(prefix="amnezia-api-micro-")
+    os.environ.setdefault("SECRET_URL_STRING", "benchmark")
+    os.environ.setdefault("LOGGING_MODE", "PROD")
+    os.environ.setdefault("SERVER_PUBLIC_IP", "203.0.113.1")
+    os.environ["DATA_DIR"] = data_dir
+    os.chdir(data_dir)
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    results = []
+    for name, func, setup in collect_benchmarks(sizes):
+        if args.filter in name:
+            results.append({"name": name, **measure_per_call(func, args.repeat, setup)})
+
+    baseline = None
+    if baseline_path:
+        with open(baseline_path, "r") as file:
+            baseline = json.load(file)["results"]
+
+    print_results(results, baseline)
+
+    if output:
+        with open(output, "w") as file:
+            json.dump({"python": platform.python_version(),
+                       "machine": platform.machine(),
+                       "results": results}, file, indent=4)
+            file.write("\n")
+
+    if baseline is not None:
+        regressions = compare_with_baseline(results, baseline, args.max_regression)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
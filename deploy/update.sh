@@ -12,6 +12,7 @@ LAST_ERROR="$(mktemp -t amnezia-api_update_last_errorXXXXXXXXXX)"
 
 export CONTAINER_NAME="amnezia-api"
 export IMAGE_NAME="omramj/amnezia-api-dev:0.2.0"
+export DATA_VOLUME="amnezia-api-data"
 
 
 readonly FULL_LOG LAST_ERROR
@@ -102,6 +103,11 @@ docker_command=(
   # Connect to docker API socket
    -v /var/run/docker.sock:/var/run/docker.sock
 
+  # Keep the API's local state (clients registry, warm pool keys)
+  # in a named volume, so that it survives updates.
+  -v "${DATA_VOLUME}":/opt/amnezia_api/data
+  -e "DATA_DIR=/opt/amnezia_api/data"
+
   # Use log rotation. See https://docs.docker.com/config/containers/logging/configure/.
   --log-driver local
 
@@ -14,6 +14,7 @@ mkdir -p "${NGINX_DIR}" 2> /dev/null
 
 cp -r ./amnezia_api "${AMNEZIAAPI_DIR}/amnezia_api"
 cp ./wsgi.py "${AMNEZIAAPI_DIR}/wsgi.py"
+cp ./gunicorn.conf.py "${AMNEZIAAPI_DIR}/gunicorn.conf.py"
 
 function create_nginx_config() {
   NGINX_CONFIG="${NGINX_DIR}/nginx.conf"
@@ -113,8 +114,9 @@ RUN pip install --no-cache-dir cryptography
 
 COPY ./amnezia_api ./amnezia_api
 COPY wsgi.py .
+COPY gunicorn.conf.py .
 
-CMD ["gunicorn", "-w", "1", "-b", "127.0.0.1:42674", "wsgi:app"]
+CMD ["gunicorn", "-c", "gunicorn.conf.py", "wsgi:app"]
 EOF
     return 
 }
@@ -128,7 +130,7 @@ function build_amnezia_api() {
 }
 
 function run_amnezia_api() {
-    docker run --rm -v /var/run/docker.sock:/var/run/docker.sock --network container:nginx-${AMNEZIAAPI_IMAGE_NAME} -e SECRET_URL_STRING="dev" -e LOGGING_MODE="PROD" --name=${AMNEZIAAPI_IMAGE_NAME} ${AMNEZIAAPI_IMAGE_NAME}
+    docker run --rm -v /var/run/docker.sock:/var/run/docker.sock -v ${AMNEZIAAPI_IMAGE_NAME}-data:/opt/amnezia_api/data -e DATA_DIR="/opt/amnezia_api/data" --network container:nginx-${AMNEZIAAPI_IMAGE_NAME} -e SECRET_URL_STRING="dev" -e LOGGING_MODE="PROD" --name=${AMNEZIAAPI_IMAGE_NAME} ${AMNEZIAAPI_IMAGE_NAME}
     return 
 }
 
@@ -0,0 +1,23 @@
+# Gunicorn reads this file from the working directory on start.
+# https://docs.gunicorn.org/en/latest/settings.html
+import os
+
+
+bind = "127.0.0.1:42674"
+
+# Changes of a container are serialized between the worker processes with
+# lock files in DATA_DIR, so more than one worker can be run. Each worker
+# keeps its own cached configurators, which are re-read after another
+# worker changes the container.
+workers = int(os.environ.get("WORKERS") or 1)
+
+# Requests are served by a pool of threads, so a slow Docker operation
+# (e.g. an XRay restart) only blocks the requests for the same container,
+# which are serialized by the API anyway. Other requests are served meanwhile.
+worker_class = "gthread"
+threads = int(os.environ.get("WORKER_THREADS") or 8)
+
+# With gthread the worker reports to the master from its main loop, so long
+# requests (big batches, restarts) do not get the worker killed.
+timeout = 30
+graceful_timeout = 30
@@ -0,0 +1,19 @@
+# Tests run against the fake Docker client of the benchmarks, so no Docker
+# daemon is needed. Run from the repository root:
+#   python -m unittest discover -s tests -t .
+#
+# Settings are read from the environment when amnezia_api is imported, and
+# the API logs to log.txt in the working directory, so both are set up here,
+# before any test module imports it.
+
+import os
+import tempfile
+
+
+_data_dir = tempfile.mkdtemp(prefix="amnezia-api-tests-")
+os.environ.setdefault("SECRET_URL_STRING", "tests")
+os.environ.setdefault("LOGGING_MODE", "PROD")
+os.environ.setdefault("SERVER_PUBLIC_IP", "203.0.113.1")
+os.environ["DATA_DIR"] = _data_dir
+os.environ.pop("FLEET_CONFIG", None)
+os.chdir(_data_dir)
@@ -0,0 +1,88 @@
+import unittest
+
+from amnezia_api.address_pool import AddressPool
+from amnezia_api.utils import AddressPoolError
+
+
+class AddressPoolTest(unittest.TestCase):
+
+    def test_allocates_lowest_free_addresses(self):
+        pool = AddressPool("10.8.1.1/24")
+
+        self.assertEqual([pool.allocate() for index in range(3)],
+                         ["10.8.1.2", "10.8.1.3", "10.8.1.4"])
+        self.assertEqual(pool.free_count, 256 - 3 - 3)
+
+
+    def test_skips_taken_addresses(self):
+        pool = AddressPool("10.8.1.1/24")
+        pool.take("10.8.1.2")
+        pool.take("10.8.1.4")
+
+        self.assertEqual([pool.allocate() for index in range(2)], ["10.8.1.3", "10.8.1.5"])
+
+
+    def test_released_address_is_reused(self):
+        pool = AddressPool("10.8.1.1/24")
+        ips = [pool.allocate() for index in range(5)]
+
+        pool.release(ips[1])
+        self.assertEqual(pool.free_count, 256 - 3 - 4)
+        self.assertEqual(pool.allocate(), ips[1])
+        self.assertEqual(pool.allocate(), "10.8.1.7")
+
+
+    def test_release_of_free_address_is_ignored(self):
+        pool = AddressPool("10.8.1.1/24")
+
+        pool.release("10.8.1.2")
+
+        self.assertEqual(pool.free_count, 256 - 3)
+
+
+    def test_reserved_addresses_are_never_allocated(self):
+        # Network, broadcast and server addresses of a /29 (server in the middle).
+        pool = AddressPool("10.8.1.4/29")
+
+        ips = [pool.allocate() for index in range(pool.free_count)]
+
+        self.assertEqual(ips, ["10.8.1.1", "10.8.1.2", "10.8.1.3", "10.8.1.5", "10.8.1.6"])
+
+
+    def test_reserved_addresses_are_not_released(self):
+        pool = AddressPool("10.8.1.1/30")
+
+        for ip in ("10.8.1.0", "10.8.1.1", "10.8.1.3"):
+            pool.release(ip)
+
+        self.assertEqual(pool.allocate(), "10.8.1.2")
+        with self.assertRaises(AddressPoolError):
+            pool.allocate()
+
+
+    def test_exhaustion_raises(self):
+        pool = AddressPool("10.8.1.1/30")
+        pool.allocate()
+
+        with self.assertRaises(AddressPoolError):
+            pool.allocate()
+        self.assertEqual(pool.free_count, 0)
+
+
+    def test_addresses_outside_subnet(self):
+        pool = AddressPool("10.8.1.1/24")
+
+        self.assertIn("10.8.1.200", pool)
+        self.assertNotIn("10.8.2.1", pool)
+        self.assertNotIn("not an ip", pool)
+        with self.assertRaises(AddressPoolError):
+            pool.take("10.8.2.1")
+
+
+    def test_invalid_interface_address(self):
+        with self.assertRaises(AddressPoolError):
+            AddressPool("10.8.1.1/33")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,131 @@
+import threading
+import unittest
+from unittest import mock
+
+from amnezia_api.commit_queue import CommitQueue
+from amnezia_api.settings import settings
+from amnezia_api.utils import AddressPoolError, ContainerName, LockTimeoutError
+
+
+class FakeConfigurator:
+    # Has room for max_clients clients per commit.
+
+    def __init__(self, max_clients: int = 1000):
+        self.max_clients = max_clients
+
+
+    def create_configs(self, client_names: list[str]) -> list[str]:
+        if len(client_names) > self.max_clients:
+            raise AddressPoolError("No free addresses left.")
+        return [f"config of {name}" for name in client_names]
+
+
+class FakeRegistry:
+    # Stands for ConfiguratorRegistry: runs the operations on one configurator
+    # and counts them. An error, if set, is raised instead.
+
+    def __init__(self, configurator: FakeConfigurator):
+        self.host_name = None
+        self.configurator = configurator
+        self.error: Exception | None = None
+        self.result = None
+        self.runs = 0
+        self.release = threading.Event()
+        self.release.set()
+
+
+    def run(self, container_name: ContainerName, operation):
+        self.runs += 1
+        self.release.wait()
+        if self.error is not None:
+            raise self.error
+        if self.result is not None:
+            return self.result
+        return operation(self.configurator)
+
+
+class CommitQueueTest(unittest.TestCase):
+
+    def make_queue(self, registry: FakeRegistry) -> CommitQueue:
+        # The window makes the requests submitted together one batch.
+        return CommitQueue(ContainerName.XRAY, window=0.1, registry=registry)
+
+
+    def submit_all(self, queue: CommitQueue, requests: list[list[str]]) -> list:
+        # Results or errors of the requests, in order.
+        results = [None] * len(requests)
+
+        def submit(index: int) -> None:
+            try:
+                results[index] = queue.submit(requests[index])
+            except Exception as e:
+                results[index] = e
+
+        threads = [threading.Thread(target=submit, args=(index,))
+                   for index in range(len(requests))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=10)
+        return results
+
+
+    def test_batch_is_committed_once(self):
+        registry = FakeRegistry(FakeConfigurator())
+        queue = self.make_queue(registry)
+
+        results = self.submit_all(queue, [["a"], ["b", "c"], ["d"]])
+
+        self.assertEqual(results, [["config of a"], ["config of b", "config of c"],
+                                   ["config of d"]])
+        self.assertEqual(registry.runs, 1)
+
+
+    def test_request_too_big_for_free_addresses_fails_alone(self):
+        registry = FakeRegistry(FakeConfigurator(max_clients=2))
+        queue = self.make_queue(registry)
+
+        results = self.submit_all(queue, [["a"], ["b", "c", "d"], ["e"]])
+
+        self.assertEqual(results[0], ["config of a"])
+        self.assertIsInstance(results[1], AddressPoolError)
+        self.assertEqual(results[2], ["config of e"])
+
+
+    def test_infrastructure_error_fails_batch_without_retries(self):
+        registry = FakeRegistry(FakeConfigurator())
+        registry.error = LockTimeoutError("Timed out waiting for the lock.")
+        queue = self.make_queue(registry)
+
+        results = self.submit_all(queue, [["a"], ["b"], ["c"]])
+
+        self.assertTrue(all(result is registry.error for result in results))
+        self.assertEqual(registry.runs, 1)
+
+
+    def test_worker_survives_unexpected_error(self):
+        registry = FakeRegistry(FakeConfigurator())
+        # Not a list of configs: splitting it between the requests fails.
+        registry.result = 42
+        queue = self.make_queue(registry)
+
+        results = self.submit_all(queue, [["a"], ["b"]])
+        self.assertTrue(all(isinstance(result, TypeError) for result in results))
+
+        registry.result = None
+        self.assertEqual(queue.submit(["c"]), ["config of c"])
+
+
+    def test_submit_times_out(self):
+        registry = FakeRegistry(FakeConfigurator())
+        registry.release.clear()
+        self.addCleanup(registry.release.set)
+        queue = self.make_queue(registry)
+
+        with mock.patch.object(settings, "commit_timeout", 0.2), \
+                self.assertRaises(LockTimeoutError):
+            queue.submit(["a"])
+
+
+if __name__ == "__main__":
+    unittest.main()
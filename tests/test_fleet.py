@@ -0,0 +1,145 @@
+import json
+import os
+import tempfile
+import unittest
+
+from amnezia_api.fleet import Fleet, FleetHost, load_fleet
+from amnezia_api.utils import AppSettingsError, ContainerName, FleetCapacityError
+from benchmarks.fake_docker import (
+        FakeContainer, FakeDockerClient, Latency, seed_wg_files, seed_xray_files
+        )
+
+
+LATENCY = Latency(list_ms=0, exec_ms=0, archive_ms=0, restart_ms=0)
+
+
+def make_host(name: str, wg_peers: int | None = None,
+              xray_clients: int | None = None) -> FleetHost:
+    # A remote fleet host whose Docker client is the fake one. A host
+    # without containers stands for one that does not run the protocol.
+    containers = []
+    protocols = set()
+    if wg_peers is not None:
+        containers.append(FakeContainer(ContainerName.WIREGUARD.value,
+                                        seed_wg_files("/opt/amnezia/wireguard", wg_peers),
+                                        LATENCY))
+        protocols.add(ContainerName.WIREGUARD)
+    if xray_clients is not None:
+        containers.append(FakeContainer(ContainerName.XRAY.value,
+                                        seed_xray_files("/opt/amnezia/xray", xray_clients),
+                                        LATENCY))
+        protocols.add(ContainerName.XRAY)
+
+    host = FleetHost(name, protocols or {ContainerName.WIREGUARD},
+                     docker_url=f"tcp://{name}:2375", public_ip="203.0.113.10")
+    host.registry.docker_client = FakeDockerClient(containers, LATENCY)
+    return host
+
+
+class FleetPlacementTest(unittest.TestCase):
+
+    def test_place_picks_least_used_host(self):
+        fleet = Fleet([make_host("busy", wg_peers=200), make_host("idle", wg_peers=10)])
+
+        self.assertEqual(fleet.place(ContainerName.WIREGUARD).name, "idle")
+
+
+    def test_place_spreads_clients_placed_before_next_load_read(self):
+        fleet = Fleet([make_host("a", wg_peers=0), make_host("b", wg_peers=0)])
+
+        names = [fleet.place(ContainerName.WIREGUARD, count=100).name for index in range(2)]
+
+        self.assertEqual(sorted(names), ["a", "b"])
+
+
+    def test_place_skips_hosts_without_the_protocol(self):
+        fleet = Fleet([make_host("wg-only", wg_peers=0), make_host("xray", xray_clients=50)])
+
+        self.assertEqual(fleet.place(ContainerName.XRAY).name, "xray")
+
+
+    def test_place_skips_unavailable_hosts(self):
+        # 'down' lists wireguard but has no such container.
+        fleet = Fleet([make_host("down"), make_host("up", wg_peers=200)])
+
+        self.assertEqual(fleet.place(ContainerName.WIREGUARD).name, "up")
+        self.assertFalse(fleet.get_status()["down"][ContainerName.WIREGUARD.value]["available"])
+
+
+    def test_place_raises_capacity_error_when_no_host_fits(self):
+        fleet = Fleet([make_host("a", wg_peers=10), make_host("b", wg_peers=10)])
+
+        with self.assertRaises(FleetCapacityError):
+            fleet.place(ContainerName.WIREGUARD, count=1000)
+
+        # Nothing was reserved by the failed placement.
+        self.assertEqual(fleet.get_status()["a"][ContainerName.WIREGUARD.value]["clients"], 10)
+
+
+    def test_place_raises_capacity_error_when_all_hosts_are_down(self):
+        fleet = Fleet([make_host("down")])
+
+        with self.assertRaises(FleetCapacityError):
+            fleet.place(ContainerName.WIREGUARD)
+
+
+    def test_create_configs_adds_clients_on_placed_host(self):
+        busy = make_host("busy", wg_peers=200)
+        idle = make_host("idle", wg_peers=10)
+        fleet = Fleet([busy, idle])
+
+        host_name, configs = fleet.create_configs(ContainerName.WIREGUARD, ["alice", "bob"])
+
+        self.assertEqual(host_name, "idle")
+        self.assertEqual(len(configs), 2)
+        self.assertEqual(idle.read_load(ContainerName.WIREGUARD)[0], 12)
+        self.assertEqual(busy.read_load(ContainerName.WIREGUARD)[0], 200)
+
+
+class LoadFleetTest(unittest.TestCase):
+
+    def load(self, config: dict) -> Fleet | None:
+        with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as file:
+            json.dump(config, file)
+        self.addCleanup(os.remove, file.name)
+        return load_fleet(file.name)
+
+
+    def test_no_config_means_no_fleet(self):
+        self.assertIsNone(load_fleet(None))
+
+
+    def test_valid_config(self):
+        fleet = self.load({"hosts": [
+            {"name": "local", "protocols": ["wireguard"]},
+            {"name": "de-1", "docker_url": "tcp://203.0.113.10:2375",
+             "public_ip": "203.0.113.10", "protocols": ["xray", "amnezia-wg"]}
+            ]})
+
+        self.assertEqual(sorted(fleet.hosts), ["de-1", "local"])
+        self.assertEqual(fleet.hosts["de-1"].protocols,
+                         {ContainerName.XRAY, ContainerName.AMNEZIA_WG})
+        self.assertIsNone(fleet.hosts["local"].docker_url)
+
+
+    def test_invalid_configs(self):
+        remote = {"docker_url": "tcp://203.0.113.10:2375", "public_ip": "203.0.113.10"}
+        for config in (
+                {"hosts": []},
+                {"hosts": [{"name": "../etc"}]},
+                {"hosts": [{"name": "a", **remote}, {"name": "a", **remote}]},
+                {"hosts": [{"name": "a", "protocols": ["openvpn"]}]},
+                {"hosts": [{"name": "a", "docker_url": "tcp://203.0.113.10:2375"}]},
+                {"hosts": [{"name": "a", "public_ip": "203.0.113.10"}]},
+                {"hosts": [{"name": "a"}, {"name": "b"}]}):
+            with self.subTest(config=config), self.assertRaises(AppSettingsError):
+                self.load(config)
+
+
+    def test_unreadable_config(self):
+        with self.assertRaises(AppSettingsError):
+            load_fleet(os.path.join(tempfile.gettempdir(), "no-such-fleet.json"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,134 @@
+import threading
+import unittest
+
+from amnezia_api.idempotency import IdempotencyCache
+
+
+class Operation:
+    # Counts its runs. Each run sets started, waits for release, then
+    # raises error if it is set.
+
+    def __init__(self, result: list[str] | None = None):
+        self.result = result or ["vpn://config"]
+        self.error: Exception | None = None
+        self.runs = 0
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+
+
+    def __call__(self) -> list[str]:
+        self.runs += 1
+        self.started.set()
+        self.release.wait(timeout=10)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class IdempotencyCacheTest(unittest.TestCase):
+
+    def test_same_key_returns_same_result(self):
+        cache = IdempotencyCache()
+        operation = Operation()
+
+        first = cache.run("key", operation)
+        second = cache.run("key", operation)
+
+        self.assertIs(second, first)
+        self.assertEqual(operation.runs, 1)
+
+
+    def test_different_keys_run_separately(self):
+        cache = IdempotencyCache()
+        operation = Operation()
+
+        cache.run("a", operation)
+        cache.run("b", operation)
+
+        self.assertEqual(operation.runs, 2)
+
+
+    def test_concurrent_duplicate_waits_for_first_request(self):
+        cache = IdempotencyCache()
+        operation = Operation()
+        operation.release.clear()
+        results = []
+        first = threading.Thread(target=lambda: results.append(cache.run("key", operation)))
+        first.start()
+        self.assertTrue(operation.started.wait(timeout=10))
+
+        duplicate = threading.Thread(target=lambda: results.append(cache.run("key", operation)))
+        duplicate.start()
+        duplicate.join(timeout=0.1)
+        self.assertTrue(duplicate.is_alive())
+
+        operation.release.set()
+        first.join(timeout=10)
+        duplicate.join(timeout=10)
+        self.assertEqual(results, [operation.result, operation.result])
+        self.assertEqual(operation.runs, 1)
+
+
+    def test_entries_expire(self):
+        cache = IdempotencyCache(ttl=0)
+        operation = Operation()
+
+        cache.run("key", operation)
+        cache.run("key", operation)
+
+        self.assertEqual(operation.runs, 2)
+
+
+    def test_oldest_entries_are_evicted_over_max_size(self):
+        cache = IdempotencyCache(max_size=2)
+        operation = Operation()
+
+        for key in ("a", "b", "c", "a"):
+            cache.run(key, operation)
+
+        self.assertEqual(operation.runs, 4)
+
+
+    def test_failed_request_is_not_remembered(self):
+        cache = IdempotencyCache()
+        operation = Operation()
+        operation.error = RuntimeError("Could not create config.")
+
+        with self.assertRaises(RuntimeError):
+            cache.run("key", operation)
+
+        operation.error = None
+        self.assertEqual(cache.run("key", operation), operation.result)
+        self.assertEqual(operation.runs, 2)
+
+
+    def test_concurrent_duplicate_gets_error_of_first_request(self):
+        cache = IdempotencyCache()
+        operation = Operation()
+        operation.error = RuntimeError("Could not create config.")
+        operation.release.clear()
+        errors = []
+
+        def run() -> None:
+            try:
+                cache.run("key", operation)
+            except RuntimeError as e:
+                errors.append(e)
+
+        first = threading.Thread(target=run)
+        first.start()
+        self.assertTrue(operation.started.wait(timeout=10))
+        duplicate = threading.Thread(target=run)
+        duplicate.start()
+        duplicate.join(timeout=0.1)
+
+        operation.release.set()
+        first.join(timeout=10)
+        duplicate.join(timeout=10)
+        self.assertEqual(errors, [operation.error, operation.error])
+        self.assertEqual(operation.runs, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
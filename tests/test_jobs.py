@@ -0,0 +1,172 @@
+import http.server
+import json
+import threading
+import time
+import unittest
+
+from amnezia_api import create_app
+from amnezia_api.jobs import JobStore
+from amnezia_api.registry import configurator_registry
+from amnezia_api.settings import settings
+from amnezia_api.utils import ContainerName, JobLimitError
+from benchmarks.fake_docker import FakeContainer, FakeDockerClient, Latency, seed_xray_files
+
+
+WORKING_DIR = "/opt/amnezia/xray"
+
+
+class CallbackServer(http.server.ThreadingHTTPServer):
+    # Local HTTP server that records the JSON bodies POSTed to it.
+
+    def __init__(self):
+        self.bodies: list[dict] = []
+        self.received = threading.Event()
+        super().__init__(("127.0.0.1", 0), CallbackHandler)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/hook"
+
+
+class CallbackHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.bodies.append(json.loads(body))
+        self.send_response(204)
+        self.end_headers()
+        self.server.received.set()
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+class JobsTest(unittest.TestCase):
+    # Jobs go through the XRay commit queue of the default registry, which
+    # is pointed to a fake container here.
+
+    def setUp(self):
+        # Listing the containers is slow enough to see the jobs pending.
+        latency = Latency(list_ms=100, exec_ms=0, archive_ms=0, restart_ms=0)
+        self.container = FakeContainer(ContainerName.XRAY.value,
+                                       seed_xray_files(WORKING_DIR, 3), latency)
+        self.use_containers([self.container], latency)
+
+
+    def use_containers(self, containers: list[FakeContainer], latency: Latency) -> None:
+        configurator_registry.docker_client = FakeDockerClient(containers, latency)
+        configurator_registry._drop(ContainerName.XRAY)
+        self.addCleanup(configurator_registry._drop, ContainerName.XRAY)
+
+
+    def wait_for(self, describe, job_id: str) -> dict:
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            job = describe(job_id)
+            if job is None or job["status"] != "pending":
+                return job
+            time.sleep(0.01)
+        self.fail(f"Job {job_id} is still pending.")
+
+
+    def test_job_is_pending_then_done(self):
+        store = JobStore()
+
+        job = store.submit(ContainerName.XRAY, "xray", ["alice", "bob"])
+        self.assertEqual(job["status"], "pending")
+        self.assertIsNone(job["configs"])
+        self.assertIsNone(job["finished_at"])
+
+        job = self.wait_for(store.describe, job["job_id"])
+        self.assertEqual(job["status"], "done")
+        self.assertEqual(len(job["configs"]), 2)
+        self.assertTrue(all(config.startswith("vpn://") for config in job["configs"]))
+        self.assertIsNone(job["error"])
+        self.assertIsNotNone(job["finished_at"])
+
+        server_config = json.loads(self.container.files[f"{WORKING_DIR}/server.json"])
+        self.assertEqual(len(server_config["inbounds"][0]["settings"]["clients"]), 5)
+
+
+    def test_commit_error_fails_job(self):
+        # No XRay container on the host.
+        self.use_containers([], Latency(list_ms=0, exec_ms=0, archive_ms=0, restart_ms=0))
+        store = JobStore()
+
+        job = self.wait_for(store.describe,
+                            store.submit(ContainerName.XRAY, "xray", ["alice"])["job_id"])
+
+        self.assertEqual(job["status"], "failed")
+        self.assertIsNone(job["configs"])
+        self.assertIn(ContainerName.XRAY.value, job["error"])
+
+
+    def test_callback_is_posted(self):
+        server = CallbackServer()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        store = JobStore(callback_timeout=5)
+
+        job_id = store.submit(ContainerName.XRAY, "xray", ["alice"],
+                              callback_url=server.url)["job_id"]
+
+        self.assertTrue(server.received.wait(timeout=10))
+        self.assertEqual(server.bodies[0]["job_id"], job_id)
+        self.assertEqual(server.bodies[0]["status"], "done")
+        self.assertEqual(server.bodies[0]["configs"], store.describe(job_id)["configs"])
+
+
+    def test_pending_jobs_over_limit_are_refused(self):
+        store = JobStore(max_jobs=1)
+        job_id = store.submit(ContainerName.XRAY, "xray", ["alice"])["job_id"]
+
+        with self.assertRaises(JobLimitError):
+            store.submit(ContainerName.XRAY, "xray", ["bob"])
+
+        # A finished job is kept until a new job needs its place.
+        self.assertEqual(self.wait_for(store.describe, job_id)["status"], "done")
+        new_job_id = store.submit(ContainerName.XRAY, "xray", ["bob"])["job_id"]
+        self.assertIsNone(store.describe(job_id))
+        self.wait_for(store.describe, new_job_id)
+
+
+    def test_finished_jobs_expire(self):
+        store = JobStore(ttl=0)
+        job_id = store.submit(ContainerName.XRAY, "xray", ["alice"])["job_id"]
+
+        self.assertIsNone(self.wait_for(store.describe, job_id))
+
+
+    def test_async_create_config_route(self):
+        client = create_app().test_client()
+
+        response = client.post(f"/{settings.secret_url_string}/xray/create-config?async=1",
+                               data={"client-name": "alice"})
+        self.assertEqual(response.status_code, 202)
+        job_id = response.get_json()["job_id"]
+        self.assertEqual(response.headers["Location"],
+                         f"/{settings.secret_url_string}/jobs/{job_id}")
+
+        job = self.wait_for(lambda job_id: client.get(response.headers["Location"]).get_json(),
+                            job_id)
+        self.assertEqual(job["status"], "done")
+        self.assertEqual(len(job["configs"]), 1)
+
+        self.assertEqual(client.get(f"/{settings.secret_url_string}/jobs/unknown").status_code,
+                         404)
+
+
+    def test_async_route_rejects_invalid_callback_url(self):
+        client = create_app().test_client()
+
+        response = client.post(f"/{settings.secret_url_string}/xray/create-config?async=1",
+                               data={"client-name": "alice", "callback-url": "file:///etc/passwd"})
+
+        self.assertEqual(response.status_code, 400)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+import unittest
+from unittest import mock
+
+from amnezia_api import create_app
+from amnezia_api.metrics import collect_timings, format_server_timing, measure, metrics_registry
+from amnezia_api.registry import configurator_registry
+from amnezia_api.settings import settings
+from amnezia_api.utils import ContainerName
+from benchmarks.fake_docker import FakeContainer, FakeDockerClient, Latency, seed_wg_files
+
+
+LATENCY = Latency(list_ms=0, exec_ms=0, archive_ms=0, restart_ms=0)
+
+
+class ServerTimingTest(unittest.TestCase):
+
+    def test_stages_are_summed_up_by_kind(self):
+        with collect_timings() as timings:
+            for stage, operation in (("docker_list", ""), ("read_files", ""),
+                                     ("exec", "hash"), ("exec", "write_config"),
+                                     ("exec", "wg_add_peers"), ("exec", "wg_syncconf"),
+                                     ("restart_container", ""), ("render", ""),
+                                     ("public_ip", ""), ("exec", "other")):
+                with measure(stage, operation):
+                    pass
+
+        self.assertEqual(list(timings), ["docker-list", "exec-read", "exec-write", "sync",
+                                         "restart", "render", "public-ip", "exec-other"])
+
+
+    def test_format(self):
+        self.assertEqual(format_server_timing({"render": 0.0012, "total": 0.25}),
+                         "render;dur=1.2, total;dur=250.0")
+
+
+    def test_create_config_response_has_server_timing(self):
+        container = FakeContainer(ContainerName.WIREGUARD.value,
+                                  seed_wg_files("/opt/amnezia/wireguard", 3), LATENCY)
+        configurator_registry.docker_client = FakeDockerClient([container], LATENCY)
+        configurator_registry._drop(ContainerName.WIREGUARD)
+        self.addCleanup(configurator_registry._drop, ContainerName.WIREGUARD)
+
+        with mock.patch.object(settings, "server_timing", True):
+            response = create_app().test_client().post(
+                    f"/{settings.secret_url_string}/wireguard/create-config",
+                    data={"client-name": "alice"})
+
+        self.assertEqual(response.status_code, 200)
+        names = [entry.split(";")[0] for entry in response.headers["Server-Timing"].split(", ")]
+        for name in ("queue", "docker-list", "exec-read", "exec-write", "sync", "render", "total"):
+            self.assertIn(name, names)
+
+
+    def test_metrics_keep_stage_labels(self):
+        with measure("exec", "wg_add_peers"):
+            pass
+
+        self.assertIn('amnezia_api_stage_duration_seconds_count{stage="exec",operation="wg_add_peers"}',
+                      metrics_registry.render())
+
+
+if __name__ == "__main__":
+    unittest.main()
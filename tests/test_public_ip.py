@@ -0,0 +1,62 @@
+import json
+import unittest
+from unittest import mock
+
+from amnezia_api import controllers
+from amnezia_api.registry import ConfiguratorRegistry
+from amnezia_api.utils import ContainerName, HostnameError, PublicIpResolver
+from benchmarks.fake_docker import (
+        FakeContainer, FakeDockerClient, Latency, seed_wg_files, seed_xray_files
+        )
+
+
+LATENCY = Latency(list_ms=0, exec_ms=0, archive_ms=0, restart_ms=0)
+
+
+def fail_lookup() -> str:
+    raise HostnameError("Could not define what server public ip shoud be")
+
+
+class FailedPublicIpLookupTest(unittest.TestCase):
+    # The public IP is resolved before the server config is changed, so a
+    # failed lookup leaves no clients without configs behind.
+
+    def setUp(self):
+        patcher = mock.patch.object(controllers, "public_ip_resolver",
+                                    PublicIpResolver(resolve=fail_lookup))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+    def create_configs(self, container: FakeContainer, container_name: ContainerName) -> None:
+        registry = ConfiguratorRegistry()
+        registry.docker_client = FakeDockerClient([container], LATENCY)
+        with self.assertRaises(HostnameError):
+            registry.run(container_name,
+                         lambda configurator: configurator.create_configs(["alice", "bob"]))
+
+
+    def test_wireguard_peers_are_not_added(self):
+        config_path = "/opt/amnezia/wireguard/wg0.conf"
+        container = FakeContainer(ContainerName.WIREGUARD.value,
+                                  seed_wg_files("/opt/amnezia/wireguard", 3), LATENCY)
+        server_config = container.files[config_path]
+
+        self.create_configs(container, ContainerName.WIREGUARD)
+
+        self.assertEqual(container.files[config_path], server_config)
+
+
+    def test_xray_clients_are_not_added(self):
+        config_path = "/opt/amnezia/xray/server.json"
+        container = FakeContainer(ContainerName.XRAY.value,
+                                  seed_xray_files("/opt/amnezia/xray", 3), LATENCY)
+
+        self.create_configs(container, ContainerName.XRAY)
+
+        server_config = json.loads(container.files[config_path])
+        self.assertEqual(len(server_config["inbounds"][0]["settings"]["clients"]), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
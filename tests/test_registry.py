@@ -0,0 +1,59 @@
+import unittest
+
+from amnezia_api.registry import ConfiguratorRegistry
+from amnezia_api.utils import ClientNotFoundError, ContainerName, ExecRunError
+from benchmarks.fake_docker import FakeContainer, FakeDockerClient, Latency, seed_wg_files
+
+
+LATENCY = Latency(list_ms=0, exec_ms=0, archive_ms=0, restart_ms=0)
+
+
+class ConfiguratorRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.container = FakeContainer(ContainerName.WIREGUARD.value,
+                                       seed_wg_files("/opt/amnezia/wireguard", 3), LATENCY)
+        self.registry = ConfiguratorRegistry()
+        self.registry.docker_client = FakeDockerClient([self.container], LATENCY)
+
+
+    def get_configurator(self):
+        return self.registry.run(ContainerName.WIREGUARD, lambda configurator: configurator)
+
+
+    def test_configurator_is_reused(self):
+        self.assertIs(self.get_configurator(), self.get_configurator())
+
+
+    def test_configurator_is_kept_after_expected_error(self):
+        configurator = self.get_configurator()
+
+        with self.assertRaises(ClientNotFoundError):
+            self.registry.run(ContainerName.WIREGUARD,
+                              lambda configurator: configurator.revoke_config(client_id="missing"))
+
+        self.assertIs(self.get_configurator(), configurator)
+
+
+    def test_configurator_is_dropped_after_container_error(self):
+        configurator = self.get_configurator()
+
+        def fail(configurator):
+            raise ExecRunError("Error performing exec_run.")
+
+        with self.assertRaises(ExecRunError):
+            self.registry.run(ContainerName.WIREGUARD, fail)
+
+        self.assertIsNot(self.get_configurator(), configurator)
+
+
+    def test_configurator_is_dropped_when_config_changed_outside(self):
+        configurator = self.get_configurator()
+        config_path = "/opt/amnezia/wireguard/wg0.conf"
+        self.container.files[config_path] += "\n# changed by the AmneziaVPN app\n"
+
+        self.assertIsNot(self.get_configurator(), configurator)
+
+
+if __name__ == "__main__":
+    unittest.main()
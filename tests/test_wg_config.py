@@ -0,0 +1,63 @@
+import unittest
+
+from amnezia_api.utils import ServerConfigError
+from amnezia_api.wg_config import WgServerConfig
+
+
+INTERFACE = """[Interface]
+PrivateKey = c2VydmVyIHByaXZhdGUga2V5
+Address = 10.8.1.0/24
+ListenPort = 51820"""
+
+PEER = """[Peer]
+PublicKey = {public_key}
+PresharedKey = cHJlc2hhcmVkIGtleQ==
+AllowedIPs = {ip}/32"""
+
+
+def make_peer(public_key: str, ip: str) -> str:
+    return PEER.format(public_key=public_key, ip=ip)
+
+
+class WgServerConfigTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        text = "\n\n".join([INTERFACE, make_peer("a", "10.8.1.2"), make_peer("b", "10.8.1.3")])
+
+        config = WgServerConfig(text)
+
+        self.assertEqual(config.serialize(), text)
+        self.assertEqual(config.get_interface_values("ListenPort"), ["51820"])
+        self.assertEqual([peer.ip for peer in config.peers.values()], ["10.8.1.2", "10.8.1.3"])
+
+
+    def test_preamble_is_kept_verbatim(self):
+        preamble = "# Managed by AmneziaVPN\n  # indented comment\n\n"
+        text = preamble + "\n\n".join([INTERFACE, make_peer("a", "10.8.1.2")])
+
+        config = WgServerConfig(text)
+
+        self.assertEqual(config.serialize(), text)
+        self.assertEqual(config.interface_lines[0], "[Interface]")
+
+
+    def test_add_and_remove_peer(self):
+        config = WgServerConfig(INTERFACE)
+
+        peer = config.add_peer_section(make_peer("a", "10.8.1.2"))
+        self.assertEqual(config.serialize(), INTERFACE + "\n\n" + make_peer("a", "10.8.1.2"))
+
+        self.assertIs(config.remove_peer("a"), peer)
+        self.assertIsNone(config.remove_peer("a"))
+        self.assertEqual(config.serialize(), INTERFACE)
+
+
+    def test_duplicate_peer_is_rejected(self):
+        config = WgServerConfig(INTERFACE + "\n\n" + make_peer("a", "10.8.1.2"))
+
+        with self.assertRaises(ServerConfigError):
+            config.add_peer_section(make_peer("a", "10.8.1.3"))
+
+
+if __name__ == "__main__":
+    unittest.main()
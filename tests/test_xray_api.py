@@ -0,0 +1,124 @@
+import json
+import unittest
+
+from amnezia_api.registry import ConfiguratorRegistry
+from amnezia_api.settings import settings
+from amnezia_api.utils import ContainerName
+from benchmarks.fake_docker import FakeContainer, FakeDockerClient, Latency, seed_xray_files
+
+
+WORKING_DIR = "/opt/amnezia/xray"
+USERS_FILE = f"{WORKING_DIR}/api_add_users.json"
+LATENCY = Latency(list_ms=0, exec_ms=0, archive_ms=0, restart_ms=0)
+
+
+class XrayApiTest(unittest.TestCase):
+    # New clients are hot-added to the running inbound with 'xray api adu'
+    # and revoked ones removed with 'xray api rmu'; the container is
+    # restarted only when the API cannot be used.
+
+    def setUp(self):
+        self.container = FakeContainer(ContainerName.XRAY.value,
+                                       seed_xray_files(WORKING_DIR, 3), LATENCY)
+        self.commands: list[str] = []
+        # Contents of the users file when 'xray api adu' is run.
+        self.added_users: list[dict] = []
+        self.api_fails = False
+        exec_run = self.container.exec_run
+
+        def recording_exec_run(cmd: str, **kwargs):
+            self.commands.append(cmd)
+            if "xray api adu" in cmd:
+                self.added_users.append(json.loads(self.container.files[USERS_FILE]))
+            result = exec_run(cmd, **kwargs)
+            if self.api_fails and "xray api" in cmd:
+                return 1, b"failed to dial 127.0.0.1:10085"
+            return result
+
+        self.container.exec_run = recording_exec_run
+        self.registry = ConfiguratorRegistry()
+        self.registry.docker_client = FakeDockerClient([self.container], LATENCY)
+        self.xray_use_api = settings.xray_use_api
+        settings.xray_use_api = True
+
+
+    def tearDown(self):
+        settings.xray_use_api = self.xray_use_api
+
+
+    def run_operation(self, operation):
+        return self.registry.run(ContainerName.XRAY, operation)
+
+
+    def get_api_commands(self, subcommand: str) -> list[str]:
+        return [cmd for cmd in self.commands if f"xray api {subcommand}" in cmd]
+
+
+    def get_server_clients(self) -> list[dict]:
+        server_config = json.loads(self.container.files[f"{WORKING_DIR}/server.json"])
+        return server_config["inbounds"][0]["settings"]["clients"]
+
+
+    def test_create_configs_adds_clients_through_api(self):
+        configs = self.run_operation(
+                lambda configurator: configurator.create_configs(["alice", "bob"]))
+
+        self.assertEqual(len(configs), 2)
+        self.assertEqual(len(self.get_api_commands("adu")), 1)
+        self.assertEqual(self.container.restart_count, 0)
+        self.assertEqual(len(self.get_server_clients()), 5)
+
+        self.assertNotIn(USERS_FILE, self.container.files)
+        inbound = self.added_users[0]["inbounds"][0]
+        self.assertEqual(inbound["tag"], "vless-in")
+        self.assertEqual([client["email"] for client in inbound["settings"]["clients"]],
+                         [client["id"] for client in inbound["settings"]["clients"]])
+
+
+    def test_revoke_config_removes_clients_through_api(self):
+        self.run_operation(lambda configurator: configurator.create_configs(["alice"]))
+
+        removed = self.run_operation(
+                lambda configurator: configurator.revoke_config(client_name="alice"))
+
+        self.assertEqual(len(removed), 1)
+        self.assertEqual(self.get_api_commands("rmu"),
+                         [f"xray api rmu --server=127.0.0.1:10085 -tag=vless-in {removed[0]}"])
+        self.assertEqual(self.container.restart_count, 0)
+        self.assertNotIn(removed[0], [client["id"] for client in self.get_server_clients()])
+
+
+    def test_revoke_client_without_email_restarts_container(self):
+        # Clients made by the AmneziaVPN app have no email to remove them by.
+        client_id = self.get_server_clients()[0]["id"]
+
+        self.run_operation(lambda configurator: configurator.revoke_config(client_id=client_id))
+
+        self.assertEqual(self.get_api_commands("rmu"), [])
+        self.assertEqual(self.container.restart_count, 1)
+
+
+    def test_api_failure_falls_back_to_restart(self):
+        self.api_fails = True
+
+        configs = self.run_operation(
+                lambda configurator: configurator.create_configs(["alice"]))
+
+        self.assertEqual(len(configs), 1)
+        self.assertEqual(len(self.get_api_commands("adu")), 1)
+        self.assertEqual(self.container.restart_count, 1)
+        self.assertEqual(len(self.get_server_clients()), 4)
+        self.assertNotIn(USERS_FILE, self.container.files)
+
+
+    def test_api_disabled_restarts_container(self):
+        settings.xray_use_api = False
+
+        self.run_operation(lambda configurator: configurator.create_configs(["alice"]))
+
+        self.assertEqual(self.get_api_commands(""), [])
+        self.assertEqual(self.container.restart_count, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()